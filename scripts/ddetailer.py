@@ -1,7 +1,9 @@
 import gc
 import os
+import time
 import re
 import sys
+import threading
 import cv2
 import hashlib
 from PIL import Image, ImageColor
@@ -11,16 +13,33 @@ import numpy as np
 import gradio as gr
 import importlib
 import json
-import requests
 import shutil
+import sqlite3
 from tqdm import tqdm
 from collections import OrderedDict
-from fastapi import FastAPI
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pathlib import Path
 
 import scripts.detectors
+from scripts.mudd import metrics, timing
+from scripts.mudd.jobs import JobQueue, QueueFull
+from scripts.mudd.model_index import ModelIndex
+from scripts.mudd.download import DownloadItem, download_all, load_manifest
+from scripts.mudd.startup import StartupChecks
+from scripts.mudd.presets import TsvPresetStore, SQLitePresetStore, PresetExists
+from scripts.mudd.args import DetailerArgs, parse_select_masks
+from scripts.mudd.schedule import run_grouped
+from scripts.mudd.writer import BackgroundWriter
+from scripts.detectors.masks import sort_results, is_allblack, bitwise_and_masks, subtract_masks, dilate_masks, offset_masks, combine_masks
+from scripts.detectors.masks import create_segmasks, create_polyline_from_segms, mask_to_rle, save_mask
+from scripts.detectors.masks import create_segmask_preview as _create_segmask_preview
+from scripts.detectors.backends import Detections, DetectorBackend, register_backend, get_backend, find_backend, builtin_models
 
 from copy import copy, deepcopy
+from functools import lru_cache
 from modules import processing, images, img2img
 from modules import safe, script_loading
 from modules import scripts, script_callbacks, shared, devices, modelloader, sd_models, sd_samplers_common, sd_vae, sd_samplers
@@ -33,42 +52,6 @@ from modules.sd_models import model_hash as old_model_hash
 from modules.paths import models_path, data_path
 from modules.ui import create_refresh_button, plaintext_to_html
 
-from torch.hub import download_url_to_file, get_dir
-from urllib.parse import urlparse
-
-# from basicsr
-def load_file_from_url(url, model_dir=None, progress=True, file_name=None):
-    """Load file form http url, will download models if necessary.
-
-    Ref:https://github.com/1adrianb/face-alignment/blob/master/face_alignment/utils.py
-
-    Args:
-        url (str): URL to be downloaded.
-        model_dir (str): The path to save the downloaded model. Should be a full path. If None, use pytorch hub_dir.
-            Default: None.
-        progress (bool): Whether to show the download progress. Default: True.
-        file_name (str): The downloaded file name. If None, use the file name in the url. Default: None.
-
-    Returns:
-        str: The path to the downloaded file.
-    """
-    if model_dir is None:  # use the pytorch hub_dir
-        hub_dir = get_dir()
-        model_dir = os.path.join(hub_dir, 'checkpoints')
-
-    os.makedirs(model_dir, exist_ok=True)
-
-    parts = urlparse(url)
-    filename = os.path.basename(parts.path)
-    if file_name is not None:
-        filename = file_name
-    cached_file = os.path.abspath(os.path.join(model_dir, filename))
-    if not os.path.exists(cached_file):
-        print(f'Downloading: "{url}" to {cached_file}\n')
-        download_url_to_file(url, cached_file, hash_prefix=None, progress=progress)
-    return cached_file
-
-
 dd_models_path = os.path.join(models_path, "mmdet")
 dd_yolo_path = os.path.join(models_path, "yolo")
 
@@ -76,6 +59,10 @@ scriptdir = scripts.basedir()
 
 # model caches
 model_loaded = OrderedDict()
+# guards model_loaded. detections run on the API job workers as well
+model_cache_lock = threading.RLock()
+# GPU detectors run one at a time
+detector_lock = threading.Lock()
 
 
 # check mmdet compatibility
@@ -139,72 +126,38 @@ def get_dependency_modules():
     return None, None, None, None
 
 
-models_list = {}
 models_alias = {}
 model_list = None
-def list_models(real=True, refresh=False):
-    global model_list
-
-    if refresh or model_list is None:
-        model_list = modelloader.load_models(model_path=dd_models_path, ext_filter=[".pth"])
-        model_list += modelloader.load_models(model_path=dd_yolo_path, ext_filter=[".pt", ".onnx"])
+def modeltitle(path):
+    abspath = os.path.abspath(path)
 
-    def modeltitle(path, shorthash=None):
-        abspath = os.path.abspath(path)
+    if abspath.startswith(dd_models_path):
+        name = abspath.replace(dd_models_path, '')
+    elif abspath.startswith(dd_yolo_path):
+        name = abspath.replace(models_path, '')
+    else:
+        name = os.path.basename(path)
 
-        if abspath.startswith(dd_models_path):
-            name = abspath.replace(dd_models_path, '')
-        elif abspath.startswith(dd_yolo_path):
-            name = abspath.replace(models_path, '')
-        else:
-            name = os.path.basename(path)
+    # fix path separator
+    name = name.replace('\\', '/')
+    if name.startswith("/"):
+        name = name[1:]
 
-        # fix path separator
-        name = name.replace('\\', '/')
-        if name.startswith("/"):
-            name = name[1:]
+    return name
 
-        shortname = os.path.splitext(name.replace("/", "_"))[0]
 
-        if shorthash is not None:
-            return f'{name} [{shorthash}]', shortname
-        return name
+def list_models(real=True, refresh=False):
+    global model_list
 
-    models = []
-    for filename in model_list:
-        config = filename.rsplit(".", 1)[0] + ".py"
-        name = modeltitle(filename)
-        # check if config.py file exists or not
-        if (filename.startswith("bbox/") or filename.startswith("segm/")) and not os.path.exists(config):
-            continue
+    if refresh or model_list is None:
+        model_list = modelloader.load_models(model_path=dd_models_path, ext_filter=[".pth", ".onnx"])
+        model_list += modelloader.load_models(model_path=dd_yolo_path, ext_filter=[".pt", ".onnx"])
+        # only new or changed files are hashed
+        model_index.refresh(model_list)
+        models_alias.clear()
+        models_alias.update(model_index.aliases())
 
-        if filename not in models_list:
-            h = model_hash(filename)
-            if "bbox" in filename or "segm" in filename:
-                mtime = os.path.getmtime(os.path.join(dd_models_path, filename))
-            else: # yolo
-                mtime = os.path.getmtime(os.path.join(models_path, filename))
-            models_list[filename] = { "hash": h, "mtime": mtime }
-        else:
-            h = models_list[filename]["hash"]
-            if "bbox" in filename or "segm" in filename:
-                mtime = os.path.getmtime(os.path.join(dd_models_path, filename))
-            else: # yolo
-                mtime = os.path.getmtime(os.path.join(models_path, filename))
-            old_mtime = models_list[filename]["mtime"]
-            if mtime > old_mtime:
-                # update hash, mtime
-                h = model_hash(filename)
-                models_list[filename] = { "hash": h, "mtime": mtime }
-
-        title, short_model_name = modeltitle(filename, h)
-        models.append(title)
-        models_alias[title] = filename
-        models_alias[filename] = title # reverse index
-
-        old_h = old_model_hash(filename)
-        title, _ = modeltitle(filename, old_h)
-        models_alias[title] = filename
+    models = model_index.titles()
 
     def sortkey(name):
         order2 = [ "bbox", "mediapipe", "yolo/", "segm" ]
@@ -231,7 +184,7 @@ def list_models(real=True, refresh=False):
         models = list(set(models) - set(excluded))
 
     if real is False:
-        models = models + ["mediapipe_face_short", "mediapipe_face_full", "mediapipe_face_mesh"]
+        models = models + builtin_models()
         models = sorted(models, key=sortkey)
 
     return models
@@ -268,6 +221,36 @@ def model_hash(path):
         return 'NOFILE'
 
 
+model_index = ModelIndex(modeltitle, model_hash, old_model_hash, cache_path=os.path.join(data_path, "cache", "uddetailer-hashes.json"))
+startup_checks = StartupChecks(cache_path=os.path.join(data_path, "cache", "uddetailer-startup.json"))
+
+
+def download_models(downloads):
+    """download a list of (url, path, filename) in parallel. return {dest: error} of failed files"""
+    manifest = load_manifest(shared.opts.data.get("mudd_download_manifest", ""))
+    items = [DownloadItem(url, os.path.join(path, filename), manifest.get(filename, None)) for url, path, filename in downloads]
+
+    bars = {}
+    lock = threading.Lock()
+    def progress(filename, done, total):
+        with lock:
+            bar = bars.get(filename, None)
+            if bar is None:
+                bar = bars[filename] = tqdm(desc=filename, total=total, initial=done, unit='iB', unit_scale=True, unit_divisor=1024)
+            bar.update(done - bar.n)
+
+    try:
+        errors = download_all(items,
+            max_workers=int(shared.opts.data.get("mudd_download_workers", 4)),
+            mirror=shared.opts.data.get("mudd_download_mirror", ""),
+            progress=progress)
+    finally:
+        for bar in bars.values():
+            bar.close()
+
+    return errors
+
+
 def compat_model_hash(modelname):
     if models_alias.get(modelname, None) is not None:
         filename = models_alias[modelname]
@@ -325,53 +308,51 @@ def startup():
                 need_download = True
                 break
 
-    while need_download:
+    if need_download:
         if len(list_model) == 0:
             print("No detection models found, downloading...")
         else:
             print("Check detection models and downloading...")
 
-        if not os.path.exists(os.path.join(bbox_path, "mmdet_anime-face_yolov3.pth")):
-            load_file_from_url("https://huggingface.co/dustysys/ddetailer/resolve/main/mmdet/bbox/mmdet_anime-face_yolov3.pth", bbox_path)
-        if not os.path.exists(os.path.join(segm_path, "mmdet_dd-person_mask2former.pth")):
-            if legacy:
-                load_file_from_url("https://huggingface.co/dustysys/ddetailer/resolve/main/mmdet/segm/mmdet_dd-person_mask2former.pth", segm_path)
-            else:
-                load_file_from_url(
-                    #"https://download.openmmlab.com/mmdetection/v3.0/mask2former/mask2former_r50_8xb2-lsj-50e_coco/mask2former_r50_8xb2-lsj-50e_coco_20220506_191028-41b088b6.pth",
-                    "https://huggingface.co/wkpark/muddetailer/resolve/main/mmdet/segm/mmdet_dd-person_mask2former.pth", # the same copy
-                    segm_path,
-                    file_name="mmdet_dd-person_mask2former.pth")
-        if not legacy and not os.path.exists(os.path.join(segm_path, "yolov5_ins_n.pth")):
-                load_file_from_url(
-                    "https://download.openmmlab.com/mmyolo/v0/yolov5/ins_seg/yolov5_ins_n-v61_syncbn_fast_8xb16-300e_coco_instance/yolov5_ins_n-v61_syncbn_fast_8xb16-300e_coco_instance_20230424_104807-84cc9240.pth",
-                    segm_path,
-                    file_name="yolov5_ins_n.pth")
-        if not legacy and not os.path.exists(os.path.join(segm_path, "yolov5_ins_s.pth")):
-                load_file_from_url(
-                    "https://download.openmmlab.com/mmyolo/v0/yolov5/ins_seg/yolov5_ins_s-v61_syncbn_fast_8xb16-300e_coco_instance/yolov5_ins_s-v61_syncbn_fast_8xb16-300e_coco_instance_20230426_012542-3e570436.pth",
-                    segm_path,
-                    file_name="yolov5_ins_s.pth")
-
+        downloads = [
+            ("https://huggingface.co/dustysys/ddetailer/resolve/main/mmdet/bbox/mmdet_anime-face_yolov3.pth", bbox_path, "mmdet_anime-face_yolov3.pth"),
+        ]
         if legacy:
-            break
+            downloads.append(("https://huggingface.co/dustysys/ddetailer/resolve/main/mmdet/segm/mmdet_dd-person_mask2former.pth", segm_path, "mmdet_dd-person_mask2former.pth"))
+        else:
+            downloads += [
+                #"https://download.openmmlab.com/mmdetection/v3.0/mask2former/mask2former_r50_8xb2-lsj-50e_coco/mask2former_r50_8xb2-lsj-50e_coco_20220506_191028-41b088b6.pth",
+                ("https://huggingface.co/wkpark/muddetailer/resolve/main/mmdet/segm/mmdet_dd-person_mask2former.pth", # the same copy
+                    segm_path, "mmdet_dd-person_mask2former.pth"),
+                ("https://download.openmmlab.com/mmyolo/v0/yolov5/ins_seg/yolov5_ins_n-v61_syncbn_fast_8xb16-300e_coco_instance/yolov5_ins_n-v61_syncbn_fast_8xb16-300e_coco_instance_20230424_104807-84cc9240.pth",
+                    segm_path, "yolov5_ins_n.pth"),
+                ("https://download.openmmlab.com/mmyolo/v0/yolov5/ins_seg/yolov5_ins_s-v61_syncbn_fast_8xb16-300e_coco_instance/yolov5_ins_s-v61_syncbn_fast_8xb16-300e_coco_instance_20230426_012542-3e570436.pth",
+                    segm_path, "yolov5_ins_s.pth"),
+            ]
 
-        # optional models
-        huggingface_src_path = "https://huggingface.co/wkpark/mmyolo-yolov8/resolve/main"
-        for path, model in optional:
-            if not os.path.exists(os.path.join(path, model)):
-                load_file_from_url(f"{huggingface_src_path}/{model}", path)
+            # optional models
+            huggingface_src_path = "https://huggingface.co/wkpark/mmyolo-yolov8/resolve/main"
+            downloads += [(f"{huggingface_src_path}/{model}", path, model) for path, model in optional]
 
-        break
+        download_models(downloads)
+        list_models(refresh=True)
 
     inference_detector, init_detector, get_classes, Config = get_dependency_modules()
 
-    # check validity of models
-    check_validity()
+    if shared.opts.data.get("mudd_verify_model_hashes", False):
+        model_index.verify(background=True)
 
-    check = shared.opts.data.get("mudd_check_validity", True)
-    if not check:
-        return
+    # configs are needed by the first detection. cheap to copy
+    if shared.opts.data.get("mudd_check_validity", True):
+        copy_configs(legacy)
+
+    # check validity of models in the background
+    startup_checks.start(check_validity)
+
+
+def copy_configs(legacy):
+    bbox_path = os.path.join(dd_models_path, "bbox")
+    segm_path = os.path.join(dd_models_path, "segm")
 
     print("Check config files...")
     config_dir = os.path.join(scriptdir, "config")
@@ -419,130 +400,109 @@ def gr_enable(interactive=True):
 def gr_open(open=True):
     return {"open": open, "__type__": "update"}
 
-def ddetailer_extra_params(
-    use_prompt_edit,
-    use_prompt_edit_2,
-    dd_model_a, dd_classes_a,
-    dd_conf_a, dd_max_per_img_a,
-    dd_detect_order_a, dd_select_masks_a,
-    dd_dilation_factor_a,
-    dd_offset_x_a, dd_offset_y_a,
-    dd_prompt, dd_neg_prompt,
-    dd_preprocess_b, dd_bitwise_op,
-    dd_model_b, dd_classes_b,
-    dd_conf_b, dd_max_per_img_b,
-    dd_detect_order_b, dd_select_masks_b,
-    dd_dilation_factor_b,
-    dd_offset_x_b, dd_offset_y_b,
-    dd_prompt_2, dd_neg_prompt_2,
-    dd_mask_blur, dd_denoising_strength,
-    dd_inpaint_full_res, dd_inpaint_full_res_padding,
-    dd_inpaint_width, dd_inpaint_height,
-    dd_cfg_scale, dd_steps, dd_noise_multiplier,
-    dd_sampler, dd_scheduler, dd_checkpoint, dd_vae, dd_clipskip,
-    dd_states,
-):
+def ddetailer_extra_params(args, max_per_img_a=None, max_per_img_b=None):
+    """infotext params of the DetailerArgs. max_per_img_* are the effective max detections"""
     cn_module = get_controlnet_module()
 
     params = {
-        "MuDDetailer use prompt edit": use_prompt_edit,
-        "MuDDetailer use prompt edit b": use_prompt_edit_2,
-        "MuDDetailer prompt": dd_prompt,
-        "MuDDetailer neg prompt": dd_neg_prompt,
-        "MuDDetailer prompt b": dd_prompt_2,
-        "MuDDetailer neg prompt b": dd_neg_prompt_2,
-        "MuDDetailer model a": dd_model_a,
-        "MuDDetailer conf a": dd_conf_a,
-        "MuDDetailer max detection a": dd_max_per_img_a,
-        "MuDDetailer dilation a": dd_dilation_factor_a,
-        "MuDDetailer offset x a": dd_offset_x_a,
-        "MuDDetailer offset y a": dd_offset_y_a,
-        "MuDDetailer mask blur": dd_mask_blur,
-        "MuDDetailer denoising": dd_denoising_strength,
-        "MuDDetailer inpaint full": dd_inpaint_full_res,
-        "MuDDetailer inpaint padding": dd_inpaint_full_res_padding,
-        "MuDDetailer inpaint width": dd_inpaint_width,
-        "MuDDetailer inpaint height": dd_inpaint_height,
+        "MuDDetailer use prompt edit": args.use_prompt_edit,
+        "MuDDetailer use prompt edit b": args.use_prompt_edit_2,
+        "MuDDetailer prompt": args.dd_prompt,
+        "MuDDetailer neg prompt": args.dd_neg_prompt,
+        "MuDDetailer prompt b": args.dd_prompt_2,
+        "MuDDetailer neg prompt b": args.dd_neg_prompt_2,
+        "MuDDetailer model a": args.dd_model_a,
+        "MuDDetailer conf a": args.dd_conf_a,
+        "MuDDetailer max detection a": args.dd_max_per_img_a if max_per_img_a is None else max_per_img_a,
+        "MuDDetailer dilation a": args.dd_dilation_factor_a,
+        "MuDDetailer offset x a": args.dd_offset_x_a,
+        "MuDDetailer offset y a": args.dd_offset_y_a,
+        "MuDDetailer mask blur": args.dd_mask_blur,
+        "MuDDetailer denoising": args.dd_denoising_strength,
+        "MuDDetailer inpaint full": args.dd_inpaint_full_res,
+        "MuDDetailer inpaint padding": args.dd_inpaint_full_res_padding,
+        "MuDDetailer inpaint width": args.dd_inpaint_width,
+        "MuDDetailer inpaint height": args.dd_inpaint_height,
         # DDtailer extension
-        "MuDDetailer CFG scale": dd_cfg_scale,
-        "MuDDetailer steps": dd_steps,
-        "MuDDetailer noise multiplier": dd_noise_multiplier,
-        "MuDDetailer sampler": dd_sampler,
-        "MuDDetailer scheduler": dd_scheduler,
-        "MuDDetailer checkpoint": dd_checkpoint,
-        "MuDDetailer VAE": dd_vae,
-        "MuDDetailer CLIP skip": dd_clipskip,
+        "MuDDetailer CFG scale": args.dd_cfg_scale,
+        "MuDDetailer steps": args.dd_steps,
+        "MuDDetailer noise multiplier": args.dd_noise_multiplier,
+        "MuDDetailer sampler": args.dd_sampler,
+        "MuDDetailer scheduler": args.dd_scheduler,
+        "MuDDetailer checkpoint": args.dd_checkpoint,
+        "MuDDetailer VAE": args.dd_vae,
+        "MuDDetailer CLIP skip": args.dd_clipskip,
     }
-    if dd_classes_a is not None and len(dd_classes_a) > 0:
-        params["MuDDetailer classes a"] = ",".join(dd_classes_a)
-    if dd_detect_order_a is not None and len(dd_detect_order_a) > 0:
-        params["MuDDetailer detect order a"] = ",".join(dd_detect_order_a)
-    if dd_select_masks_a is not None and dd_select_masks_a != "":
-        params["MuDDetailer select masks a"] = dd_select_masks_a
-
-    if dd_model_b != "None":
-        params["MuDDetailer model b"] = dd_model_b
-        if dd_classes_b is not None and len(dd_classes_b) > 0:
-            params["MuDDetailer classes b"] = ",".join(dd_classes_b)
-        if dd_detect_order_b is not None and len(dd_detect_order_b) > 0:
-            params["MuDDetailer detect order b"] = ",".join(dd_detect_order_b)
-        if dd_select_masks_b is not None and dd_select_masks_b != "":
-            params["MuDDetailer select masks b"] = dd_select_masks_b
-        params["MuDDetailer preprocess b"] = dd_preprocess_b
-        params["MuDDetailer bitwise"] = dd_bitwise_op
-        params["MuDDetailer conf b"] = dd_conf_b
-        params["MuDDetailer max detection b"] = dd_max_per_img_b
-        params["MuDDetailer dilation b"] = dd_dilation_factor_b
-        params["MuDDetailer offset x b"] = dd_offset_x_b
-        params["MuDDetailer offset y b"] = dd_offset_y_b
-
-    if not dd_prompt:
+    if args.dd_classes_a is not None and len(args.dd_classes_a) > 0:
+        params["MuDDetailer classes a"] = ",".join(args.dd_classes_a)
+    if args.dd_detect_order_a is not None and len(args.dd_detect_order_a) > 0:
+        params["MuDDetailer detect order a"] = ",".join(args.dd_detect_order_a)
+    if args.dd_select_masks_a is not None and args.dd_select_masks_a != "":
+        params["MuDDetailer select masks a"] = args.dd_select_masks_a
+
+    if args.dd_model_b != "None":
+        params["MuDDetailer model b"] = args.dd_model_b
+        if args.dd_classes_b is not None and len(args.dd_classes_b) > 0:
+            params["MuDDetailer classes b"] = ",".join(args.dd_classes_b)
+        if args.dd_detect_order_b is not None and len(args.dd_detect_order_b) > 0:
+            params["MuDDetailer detect order b"] = ",".join(args.dd_detect_order_b)
+        if args.dd_select_masks_b is not None and args.dd_select_masks_b != "":
+            params["MuDDetailer select masks b"] = args.dd_select_masks_b
+        params["MuDDetailer preprocess b"] = args.dd_preprocess_b
+        params["MuDDetailer bitwise"] = args.dd_bitwise_op
+        params["MuDDetailer conf b"] = args.dd_conf_b
+        params["MuDDetailer max detection b"] = args.dd_max_per_img_b if max_per_img_b is None else max_per_img_b
+        params["MuDDetailer dilation b"] = args.dd_dilation_factor_b
+        params["MuDDetailer offset x b"] = args.dd_offset_x_b
+        params["MuDDetailer offset y b"] = args.dd_offset_y_b
+
+    if not args.dd_prompt:
         params.pop("MuDDetailer prompt")
-    if not dd_neg_prompt:
+    if not args.dd_neg_prompt:
         params.pop("MuDDetailer neg prompt")
-    if not dd_prompt_2:
+    if not args.dd_prompt_2:
         params.pop("MuDDetailer prompt b")
-    if not dd_neg_prompt_2:
+    if not args.dd_neg_prompt_2:
         params.pop("MuDDetailer neg prompt b")
 
-    if dd_clipskip == 0:
+    if args.dd_clipskip == 0:
         params.pop("MuDDetailer CLIP skip")
-    if dd_checkpoint in [ "Use same checkpoint", "Default", "None" ]:
+    if args.dd_checkpoint in [ "Use same checkpoint", "Default", "None" ]:
         params.pop("MuDDetailer checkpoint")
-    if dd_vae in [ "Use same VAE", "Default", "None" ]:
+    if args.dd_vae in [ "Use same VAE", "Default", "None" ]:
         params.pop("MuDDetailer VAE")
-    if dd_sampler in [ "Use same sampler", "Default", "None" ]:
+    if args.dd_sampler in [ "Use same sampler", "Default", "None" ]:
         params.pop("MuDDetailer sampler")
-    if dd_scheduler in [ "Use same scheduler", "Default", "None" ]:
+    if args.dd_scheduler in [ "Use same scheduler", "Default", "None" ]:
         params.pop("MuDDetailer scheduler")
 
     # setup from dd_states
-    params_a = dd_states.get("inpaint a", None)
+    params_a = args.dd_states.get("inpaint a", None)
     if params_a:
         params_a = (tuple(setting.split(":", 1)) for setting in params_a)
         params_a = dict((x, y.strip()) for x, y in params_a)
         params["MuDDetailer inpaint a"] = ", ".join([k if k == v else f'{k}: {quote(v)}' for k, v in params_a.items() if v is not None])
 
-    params_b = dd_states.get("inpaint b", None)
+    params_b = args.dd_states.get("inpaint b", None)
     if params_b:
         params_b = (tuple(setting.split(":", 1)) for setting in params_b)
         params_b = dict((x, y.strip()) for x, y in params_b)
         params["MuDDetailer inpaint b"] = ", ".join([k if k == v else f'{k}: {quote(v)}' for k, v in params_b.items() if v is not None])
 
-    params_a = dd_states.get("controlnet a", None)
+    params_a = args.dd_states.get("controlnet a", None)
     if params_a:
         params_a = (tuple(setting.split(":", 1)) for setting in params_a)
         params_a = dict((x, y.strip()) for x, y in params_a)
         params["MuDDetailer controlnet a"] = ", ".join([k if k == v else f'{k}: {quote(v)}' for k, v in params_a.items() if v is not None])
 
-    params_b = dd_states.get("controlnet b", None)
+    params_b = args.dd_states.get("controlnet b", None)
     if params_b:
         params_b = (tuple(setting.split(":", 1)) for setting in params_b)
         params_b = dict((x, y.strip()) for x, y in params_b)
         params["MuDDetailer controlnet b"] = ", ".join([k if k == v else f'{k}: {quote(v)}' for k, v in params_b.items() if v is not None])
 
     # controlnet
-    cn_params = cn_module.get_cn_extra_params(dd_states)
+    cn_params = cn_module.get_cn_extra_params(args.dd_states)
     if cn_params and cn_params.get("Model", "None") != "None" and cn_params.get("Module", "None") != "None":
         params["MuDDetailer ControlNet"] = ", ".join([k if k == v else f'{k}: {quote(v)}' for k, v in cn_params.items() if v is not None])
 
@@ -694,50 +654,21 @@ def export_controlnet_options(choices):
     return [gr.update(value=v) for v in outs]
 
 
-parsed_presets = {}
-def _load_presets():
-    raw = None
-    userfilepath = os.path.join(scriptdir, "data", "presets.tsv")
-    if os.path.isfile(userfilepath):
-        try:
-            with open(userfilepath) as f:
-                raw = f.read()
-        except OSError as e:
-            print(e)
-            pass
-    return raw
-
-
-def _dd_presets(raw=None):
-    if raw is None:
-        raw = _load_presets()
-        if raw is None:
-            return {}
+preset_store = None
+def get_preset_store():
+    global preset_store
 
-    lines = raw.splitlines()
-    presets = {}
-    for l in lines:
-        w = None
-        if "\t" in l:
-            k, w = l.split("\t", 1)
+    if preset_store is None:
+        userfilepath = os.path.join(scriptdir, "data", "presets.tsv")
+        if shared.opts.data.get("mudd_presets_backend", "tsv") == "sqlite":
+            preset_store = SQLitePresetStore(os.path.join(scriptdir, "data", "presets.sqlite3"), _get_preset_params, import_from=userfilepath)
         else:
-            continue
-
-        if w is not None:
-            k = k.strip()
-
-        # raw line
-        presets[k] = w
-
-    return presets
+            preset_store = TsvPresetStore(userfilepath, _get_preset_params)
+    return preset_store
 
 
 def dd_presets(reload=False):
-    global parsed_presets
-    if reload or len(parsed_presets) == 0:
-        parsed_presets = _dd_presets()
-
-    return parsed_presets
+    return get_preset_store().all(reload)
 
 
 def find_preset_by_name(preset, presets=None, reload=False):
@@ -750,6 +681,11 @@ def find_preset_by_name(preset, presets=None, reload=False):
     return None
 
 
+def find_preset_params(preset):
+    """parsed params of the preset. None if not found"""
+    return get_preset_store().params(preset)
+
+
 def prepare_load_preset(params):
     """set default preset params, type conversion"""
 
@@ -791,7 +727,7 @@ def prepare_load_preset(params):
                     "Max detection a", "Max detection b", "Offset x a", "Offfset y a", "Offset x b", "Offset y b",
                     "Inpaint padding", "Inpaint width", "Inpaint height"]:
                 outs[i] = int(outs[i])
-            elif k in ["Denoising", "CFG scale", "Conf a", "Conf b", "Dilation a", "Dilation b"]:
+            elif k in ["Denoising", "Noise multiplier", "CFG scale", "Conf a", "Conf b", "Dilation a", "Dilation b"]:
                 outs[i] = float(outs[i])
             elif k in ["Inpaint full", "Use prompt edit", "Use prompt edit 2", "Preprocess b"]:
                 outs[i] = eval(outs[i]) if outs[i] in ["True", "False"] else False
@@ -801,6 +737,106 @@ def prepare_load_preset(params):
 
     return params
 
+INPAINT_OVERRIDE_MAP = (
+    ("Mask blur", "mask_blur"),
+    ("Denoising", "denoising_strength"),
+    ("Inpaint full", "inpaint_full_res"),
+    ("Inpaint padding", "inpaint_full_res_padding"),
+    ("Inpaint width", "width"),
+    ("Inpaint height", "height"),
+    ("Sampler", "sampler_name"),
+    ("Scheduler", "scheduler"),
+    ("Steps", "steps"),
+    ("Noise multiplier", "initial_noise_multiplier"),
+    ("CFG scale", "cfg_scale"),
+)
+
+
+class InpaintOverride:
+    """parsed and validated overriding inpaint options. apply() only sets attributes"""
+    __slots__ = ("params", "fields", "override_settings", "gate")
+
+    def __init__(self, choices):
+        # parse and set/load default
+        params = (tuple(setting.split(":", 1)) for setting in choices if ":" in setting)
+        params = dict((x.strip(), y.strip()) for x, y in params)
+        params = prepare_load_preset(params)
+        if params["Noise multiplier"] < 0:
+            raise ValueError(f"Noise multiplier {params['Noise multiplier']} must be >= 0")
+
+        if params.get("Sampler", None) in ["None", "Default", "Use same sampler"]:
+            params.pop("Sampler")
+        if params.get("Scheduler", None) in ["None", "Default", "Use same scheduler"]:
+            params.pop("Scheduler")
+
+        override_settings = {}
+        checkpoint = params.get("Checkpoint", "None")
+        if checkpoint not in ["None", "Default", "Use same checkpoint"]:
+            override_settings["sd_model_checkpoint"] = checkpoint
+
+        vae = params.get("VAE", "None")
+        if vae not in ["None", "Default", "Use same VAE"]:
+            override_settings["sd_vae"] = vae
+
+        if params.get("CLIP skip", 0) > 0:
+            override_settings["CLIP_stop_at_last_layers"] = params.get("CLIP skip")
+
+        # detection gate. None for the global settings
+        gate_conf = params.get("Gate conf", None)
+        if gate_conf is not None:
+            gate_conf = float(gate_conf)
+            if not 0 <= gate_conf <= 100:
+                raise ValueError(f"Gate conf {gate_conf} must be in 0-100")
+        gate_size = params.get("Gate size", None)
+        if gate_size is not None:
+            gate_size = int(gate_size)
+            if gate_size < 0:
+                raise ValueError(f"Gate size {gate_size} must be >= 0")
+
+        self.params = params
+        self.fields = tuple((field, params[name]) for name, field in INPAINT_OVERRIDE_MAP if params.get(name, None))
+        self.override_settings = override_settings
+        self.gate = (params.get("Gate model", None), gate_conf, gate_size)
+
+    def apply(self, p):
+        for field, value in self.fields:
+            setattr(p, field, value)
+
+        if len(self.override_settings) > 0:
+            # do not update the shared override_settings of the copied p
+            p.override_settings = {**(p.override_settings or {}), **self.override_settings}
+
+
+@lru_cache(maxsize=64)
+def _compile_inpaint_override(choices):
+    return InpaintOverride(choices)
+
+
+def compile_inpaint_override(choices, label=""):
+    """compiled overriding inpaint options. raise gr.Error for invalid options"""
+    if choices is None:
+        return None
+    try:
+        return _compile_inpaint_override(tuple(choices))
+    except (ValueError, TypeError) as e:
+        raise gr.Error(f"Invalid inpaint {label} options - {e}")
+
+
+@lru_cache(maxsize=64)
+def _compile_controlnet_override(choices):
+    return _parse_controlnet_options(choices, remap=True)
+
+
+def compile_controlnet_override(choices, label=""):
+    """compiled overriding controlnet options. raise gr.Error for invalid options"""
+    if choices is None:
+        return None
+    try:
+        return _compile_controlnet_override(tuple(choices))
+    except (ValueError, TypeError) as e:
+        raise gr.Error(f"Invalid controlnet {label} options - {e}")
+
+
 def _get_preset_params(preset_line):
     global re_param
 
@@ -899,11 +935,15 @@ class MuDetectionDetailerScript(scripts.Script):
             from ultralytics import YOLO
 
             model_path = modelpath(modelname)
+            entry = find_model(modelname)
 
             # given text class names
             classes_path = model_path.rsplit(".", 1)[0] + ".json"
-            _classes = None
-            if os.path.exists(classes_path):
+            _classes = entry.classes
+            if _classes is not None:
+                # cached
+                pass
+            elif os.path.exists(classes_path):
                 with open(classes_path) as f:
                     _classes = json.load(f)
             else:
@@ -917,6 +957,7 @@ class MuDetectionDetailerScript(scripts.Script):
                 if model.names is not None:
                     _classes = list(model.names.values())
 
+            entry.classes = _classes
             if _classes is not None:
                 default = [_classes[0]] if _classes[0].lower() in ["person", "face", "hand", "human"] else []
                 return gr.update(visible=True), gr.update(visible=True, choices=["None"] + _classes, value=default)
@@ -926,12 +967,22 @@ class MuDetectionDetailerScript(scripts.Script):
         dataset = modeldataset(modelname)
         if dataset == "coco":
             path = modelpath(modelname)
-            all_classes = None
-            if os.path.exists(path):
+            entry = find_model(modelname)
+            all_classes = entry.classes
+            classes_path = path.rsplit(".", 1)[0] + ".json"
+            if all_classes is not None:
+                # cached
+                pass
+            elif path.endswith(".onnx") and os.path.exists(classes_path):
+                # exported model
+                with open(classes_path) as f:
+                    all_classes = json.load(f)
+            elif os.path.exists(path):
                 model = torch.load(path, map_location="cpu")
                 if "meta" in model and "CLASSES" in model["meta"]:
                     all_classes = list(model["meta"].get("CLASSES", ("None",)))
                 del model
+            entry.classes = all_classes
 
             if all_classes is None:
                 all_classes = get_classes(dataset)
@@ -1041,8 +1092,8 @@ class MuDetectionDetailerScript(scripts.Script):
                               with gr.Row(elem_classes="accordions"):
                                 with gr.Accordion("Override Inpainting", open=False, elem_classes=["dd-compact-accordion"]):
                                   with gr.Row():
-                                    dd_inpainting_options_a = gr.Dropdown(label='Override inpainting options', value=[], multiselect=True,
-                                        info="Override default inpainting options",
+                                    dd_inpainting_options_a = gr.Dropdown(label='Override inpainting options', value=[], multiselect=True, allow_custom_value=True,
+                                        info="Override default inpainting options (e.g. 'Adaptive steps: True', 'Min steps: 12')",
                                         interactive=True)
                                     import_inpainting_a = gr.Button(value="↑", elem_classes=["tool", "import"])
                                     export_inpainting_a = gr.Button(value="↓", elem_classes=["tool", "export"])
@@ -1153,8 +1204,8 @@ class MuDetectionDetailerScript(scripts.Script):
                               with gr.Row(elem_classes="accordions"):
                                 with gr.Accordion("Override Inpainting", open=False, elem_classes=["dd-compact-accordion"]):
                                   with gr.Row():
-                                    dd_inpainting_options_b = gr.Dropdown(label='Inpainting options (B)', value=[], multiselect=True,
-                                        info="Override default inpainting options",
+                                    dd_inpainting_options_b = gr.Dropdown(label='Inpainting options (B)', value=[], multiselect=True, allow_custom_value=True,
+                                        info="Override default inpainting options (e.g. 'Adaptive steps: True', 'Min steps: 12')",
                                         interactive=True)
                                     import_inpainting_b = gr.Button(value="↑", elem_classes=["tool", "import"])
                                     export_inpainting_b = gr.Button(value="↓", elem_classes=["tool", "export"])
@@ -1575,31 +1626,16 @@ class MuDetectionDetailerScript(scripts.Script):
                     ]
                     with gr.Row():
                         download_status = gr.Textbox(visible=True, label="message")
+                    with gr.Row():
+                        startup_status = gr.Textbox(value=startup_checks.summary, label="Startup checks", interactive=False)
+                        create_refresh_button(startup_status, lambda: None, lambda: {"value": startup_checks.summary()}, "mudd_refresh_startup_status")
 
                     def downloader(modelurl, destdir, filename): #, progress=gr.Progress(track_tqdm=False)):
-                        if not os.path.exists(destdir):
-                            os.mkdir(destdir)
-
-                        fname = os.path.join(destdir, filename)
-                        resp = requests.get(modelurl, stream=True)
-                        total = int(resp.headers.get('content-length', 0))
-                        try:
-                            with open(fname, 'wb') as file:
-                                bar = tqdm(desc=filename, total=total, unit='iB', unit_scale=True, unit_divisor=1024)
-                                bar.update(0)
-                                for data in resp.iter_content(chunk_size=1024):
-                                    size = file.write(data)
-                                    bar.update(size)
-                                bar.close()
-                        except:
-                            pass
-
-                        if os.path.exists(fname):
-                            downloaded = True
-                        else:
-                            downloaded = False
+                        errors = download_models([(modelurl, destdir, filename)])
+                        if len(errors) > 0:
+                            return gr.update(value=False), f"failed to download {filename} - {list(errors.values())[0]}"
 
-                        return gr.update(value=downloaded), filename + " downloaded!"
+                        return gr.update(value=True), filename + " downloaded!"
 
                     def download_ui(item):
                         with gr.Row():
@@ -2054,46 +2090,18 @@ class MuDetectionDetailerScript(scripts.Script):
             params = dict((x, y.strip()) for x, y in params)
             # make "Mask blur:4, Foo bar: ... " str
             save_preset = ", ".join([k if k == v else f'{k}: {quote(v)}' for k, v in params.items() if v is not None])
-            save_preset = preset + "\t" + save_preset
-
-            filepath = os.path.join(scriptdir, "data", "presets.tsv")
-            if w is not None:
-                replaced = False
-                # replace preset entry
-                with open(filepath, "r+") as f:
-                    raw = f.read()
-
-                    lines = raw.splitlines()
-                    for i, l in enumerate(lines):
-                        if "\t" in l:
-                            k, ws = l.split("\t", 1)
-                        else:
-                            continue
-                        if k.strip() == preset:
-                            lines[i] = save_preset
-                            replaced = True
-                            break
-
-                    if replaced:
-                        f.seek(0)
-                        raw = "\n".join(lines) + "\n"
-                        f.write(raw)
-                        f.truncate()
 
-                if not replaced:
-                    raise gr.Error("Fail to save. Preset not found or mismatched")
+            try:
+                get_preset_store().save(preset, save_preset, overwrite=overwrite)
+            except PresetExists:
+                raise gr.Error("Preset exists. Please enable overwrite or rename it before save a new preset")
+            except (OSError, sqlite3.Error) as e:
+                print(e)
+                raise gr.Error(f"Fail to save preset {preset} - {e}")
 
+            if w is not None:
                 gr.Info(f"Successfully preset saved {preset}")
 
-            else:
-                # append preset entry
-                try:
-                    with open(filepath, "a+") as f:
-                        f.write(save_preset + "\n")
-                except OSError as e:
-                    print(e)
-                    pass
-
             # update dropdown
             updated = list(dd_presets(True).keys())
             return gr.update(choices=updated)
@@ -2110,38 +2118,10 @@ class MuDetectionDetailerScript(scripts.Script):
             if not confirm:
                 raise gr.Error("Please confirm before delete entry")
 
-            filepath = os.path.join(scriptdir, "data", "presets.tsv")
-            deleted = False
-            if os.path.isfile(filepath):
-                # search preset entry
-                with open(filepath, "r+") as f:
-                    raw = f.read()
-
-                    lines = raw.splitlines()
-                    newlines = []
-                    for l in lines:
-                        if "\t" in l:
-                            k, ws = l.split("\t", 1)
-                        else:
-                            continue
-                        # check weight length
-                        if k.strip() == preset:
-                            # remove.
-                            deleted = True
-                            continue
-                        if len(l) > 0:
-                            newlines.append(l)
-
-                    if deleted:
-                        f.seek(0)
-                        raw = "\n".join(newlines) + "\n"
-                        f.write(raw)
-                        f.truncate()
-
-                if not deleted:
-                    raise gr.Error("Fail to delete. Preset not found or mismatched.")
-
-                gr.Info(f"Successfully deleted preset {preset}")
+            if not get_preset_store().delete(preset):
+                raise gr.Error("Fail to delete. Preset not found or mismatched.")
+
+            gr.Info(f"Successfully deleted preset {preset}")
 
             # update dropdown
             updated = list(dd_presets(True).keys())
@@ -2163,10 +2143,8 @@ class MuDetectionDetailerScript(scripts.Script):
                 # ignore
                 return [gr.update()] * len(fields)
             print(f"- load preset {name}...")
-            setting_line = find_preset_by_name(name)
-            if setting_line is not None:
-                params = _get_preset_params(setting_line)
-
+            params = find_preset_params(name)
+            if params is not None:
                 params = prepare_load_preset(params)
 
                 ret = []
@@ -2218,6 +2196,11 @@ class MuDetectionDetailerScript(scripts.Script):
             if gallery_idx < 0:
                 gallery_idx = 0
 
+            try:
+                dd_args = DetailerArgs.from_args(True, *_args[:len(all_args)])
+            except ValueError as e:
+                raise gr.Error(f"MuDDetailer: {e}")
+
             # image from gr.Image() or gr.Gallery()
             image = input if input is not None else import_image_from_gallery(gallery, gallery_idx)
             if image is None:
@@ -2278,7 +2261,11 @@ class MuDetectionDetailerScript(scripts.Script):
 
             # run inpainting
             pp = scripts.PostprocessImageArgs(image)
-            processed = self._postprocess_image(p, pp, *_args[:len(all_args)])
+            metrics.inc("mudd_queue_depth")
+            try:
+                processed = self._postprocess_image(p, pp, dd_args)
+            finally:
+                metrics.inc("mudd_queue_depth", -1)
             outimage = pp.image
             # update info
             info = outimage.info["parameters"]
@@ -2577,11 +2564,33 @@ class MuDetectionDetailerScript(scripts.Script):
         self._image_masks = []
         self._init_images = []
 
+        # validate arguments before the generation starts
+        p._mudd_args = None
+        if len(args) > 0:
+            try:
+                p._mudd_args = DetailerArgs.parse(args)
+            except ValueError as e:
+                enabled = args[0].get("enabled", False) if isinstance(args[0], dict) else args[0]
+                if enabled:
+                    raise gr.Error(f"MuDDetailer: {e}")
+                # ignore invalid arguments of the disabled script
+                p._disable_muddetailer = True
+
+        if p._mudd_args is not None and p._mudd_args.enabled:
+            # compiled and cached for all images
+            compile_inpaint_override(p._mudd_args.dd_states.get("inpaint a", None), "a")
+            compile_inpaint_override(p._mudd_args.dd_states.get("inpaint b", None), "b")
+
 
     def postprocess(self, p, processed, *args):
         if getattr(p, "_disable_muddetailer", False):
             return
 
+        # wait for masks, previews and originals saved in the background
+        if writer is not None:
+            with timing.span("save", kind="flush"):
+                writer.flush()
+
         final_count = len(processed.images)
         # fix grid infotext
         if (opts.return_grid or opts.grid_save) and not p.do_not_save_grid and (p.n_iter > 1 or p.batch_size > 1) and final_count > 1:
@@ -2589,6 +2598,8 @@ class MuDetectionDetailerScript(scripts.Script):
             # remove detection infos from the grid image
             p_txt.extra_generation_params.pop("MuDDetailer detection a", None)
             p_txt.extra_generation_params.pop("MuDDetailer detection b", None)
+            p_txt.extra_generation_params.pop("MuDDetailer timings", None)
+            p_txt.extra_generation_params.pop("MuDDetailer steps saved", None)
             info = processing.create_infotext(p_txt, p_txt.all_prompts, p_txt.all_seeds, p_txt.all_subseeds, None, 0, 0)
             # replace infotext
             processed.infotexts[0] = info
@@ -2668,29 +2679,22 @@ class MuDetectionDetailerScript(scripts.Script):
         return Image.fromarray(cv2_image)
 
 
-    def _postprocess_image(self, p, pp, use_prompt_edit, use_prompt_edit_2,
-                     dd_model_a, dd_classes_a,
-                     dd_conf_a, dd_max_per_img_a,
-                     dd_detect_order_a, dd_select_masks_a,
-                     dd_dilation_factor_a,
-                     dd_offset_x_a, dd_offset_y_a,
-                     dd_prompt, dd_neg_prompt,
-                     dd_preprocess_b, dd_bitwise_op,
-                     dd_model_b, dd_classes_b,
-                     dd_conf_b, dd_max_per_img_b,
-                     dd_detect_order_b, dd_select_masks_b,
-                     dd_dilation_factor_b,
-                     dd_offset_x_b, dd_offset_y_b,
-                     dd_prompt_2, dd_neg_prompt_2,
-                     dd_mask_blur, dd_denoising_strength,
-                     dd_inpaint_full_res, dd_inpaint_full_res_padding,
-                     dd_inpaint_width, dd_inpaint_height,
-                     dd_cfg_scale, dd_steps, dd_noise_multiplier,
-                     dd_sampler, dd_scheduler, dd_checkpoint, dd_vae, dd_clipskip, dd_states):
-
+    def _postprocess_image(self, p, pp, args):
+        stages = self._detail_stages(p, pp, args)
+        try:
+            while True:
+                next(stages)
+        except StopIteration as e:
+            return e.value
+
+    def _detail_stages(self, p, pp, args):
+        """detail the image. yield the stage key before each inpainting stage and a None before finishing.
+        regions of all images in the batch are grouped by the stage key in the batch schedule mode"""
         p._idx = getattr(p, "_idx", -1) + 1
         p._inpainting = getattr(p, "_inpainting", False)
 
+        timing.begin(shared.opts.data.get("mudd_timings", False))
+
         seed, subseed = self.get_seed(p)
         p.seed = seed
         p.subseed = subseed
@@ -2707,21 +2711,21 @@ class MuDetectionDetailerScript(scripts.Script):
         # get some global settings
         use_max_per_img = shared.opts.data.get("mudd_max_per_img", 20)
         # set max_per_img
-        dd_max_per_img_a = dd_max_per_img_a if dd_max_per_img_a > 0 else use_max_per_img
-        dd_max_per_img_b = dd_max_per_img_b if dd_max_per_img_b > 0 else use_max_per_img
+        max_per_img_a = args.dd_max_per_img_a if args.dd_max_per_img_a > 0 else use_max_per_img
+        max_per_img_b = args.dd_max_per_img_b if args.dd_max_per_img_b > 0 else use_max_per_img
 
-        sampler_name = dd_sampler if dd_sampler not in [ "Use same sampler", "Default", "None" ] else p.sampler_name
+        sampler_name = args.dd_sampler if args.dd_sampler not in [ "Use same sampler", "Default", "None" ] else p.sampler_name
         if sampler_name in ["PLMS", "UniPC"]:
             sampler_name = "Euler"
 
         scheduler_type = None
         if getattr(p, "scheduler", None):
-            scheduler_type = dd_scheduler if dd_scheduler not in [ "Use same scheduler", "Default", "None" ] else p.scheduler
+            scheduler_type = args.dd_scheduler if args.dd_scheduler not in [ "Use same scheduler", "Default", "None" ] else p.scheduler
 
         # setup override settings
-        checkpoint = dd_checkpoint if dd_checkpoint not in [ "Use same checkpoint", "Default", "None" ] else None
-        clipskip = dd_clipskip if dd_clipskip > 0 else None
-        vae = dd_vae if dd_vae not in [ "Use same VAE", "Default", "None" ] else None
+        checkpoint = args.dd_checkpoint if args.dd_checkpoint not in [ "Use same checkpoint", "Default", "None" ] else None
+        clipskip = args.dd_clipskip if args.dd_clipskip > 0 else None
+        vae = args.dd_vae if args.dd_vae not in [ "Use same VAE", "Default", "None" ] else None
         override_settings = {}
         if checkpoint is not None:
             override_settings["sd_model_checkpoint"] = checkpoint
@@ -2736,65 +2740,29 @@ class MuDetectionDetailerScript(scripts.Script):
 
         p_txt = copy(p)
 
-        prompt = dd_prompt if use_prompt_edit and dd_prompt else p_txt.prompt
-        neg_prompt = dd_neg_prompt if use_prompt_edit and dd_neg_prompt else p_txt.negative_prompt
-
-        # prepare dd_select_masks_*
-        selected_a = parse_select_masks(dd_select_masks_a, "A")
-        selected_b = parse_select_masks(dd_select_masks_b, "B")
-        select_masks_a = selected_a["A"]
-        select_masks_b = selected_b["B"]
-        #dd_select_masks_a = ",".join(zip_ranges(select_masks_a))
-        #dd_select_masks_b = ",".join(zip_ranges(select_masks_b))
-
-        # 0 could be acceptable.
-        select_masks_a = [x-1 for x in select_masks_a if x >= 0]
-        select_masks_b = [x-1 for x in select_masks_b if x >= 0]
-        select_masks_a = None if len(select_masks_a) == 0 else select_masks_a
-        select_masks_b = None if len(select_masks_b) == 0 else select_masks_b
+        prompt = args.dd_prompt if args.use_prompt_edit and args.dd_prompt else p_txt.prompt
+        neg_prompt = args.dd_neg_prompt if args.use_prompt_edit and args.dd_neg_prompt else p_txt.negative_prompt
 
         # ddetailer info
-        extra_params = ddetailer_extra_params(
-            use_prompt_edit,
-            use_prompt_edit_2,
-            dd_model_a, dd_classes_a,
-            dd_conf_a, dd_max_per_img_a,
-            dd_detect_order_a, dd_select_masks_a,
-            dd_dilation_factor_a,
-            dd_offset_x_a, dd_offset_y_a,
-            dd_prompt, dd_neg_prompt,
-            dd_preprocess_b, dd_bitwise_op,
-            dd_model_b, dd_classes_b,
-            dd_conf_b, dd_max_per_img_b,
-            dd_detect_order_b, dd_select_masks_b,
-            dd_dilation_factor_b,
-            dd_offset_x_b, dd_offset_y_b,
-            dd_prompt_2, dd_neg_prompt_2,
-            dd_mask_blur, dd_denoising_strength,
-            dd_inpaint_full_res, dd_inpaint_full_res_padding,
-            dd_inpaint_width, dd_inpaint_height,
-            dd_cfg_scale, dd_steps, dd_noise_multiplier,
-            dd_sampler, dd_scheduler, dd_checkpoint, dd_vae, dd_clipskip,
-            dd_states,
-        )
+        extra_params = ddetailer_extra_params(args, max_per_img_a, max_per_img_b)
         p_txt.extra_generation_params.update(extra_params)
 
-        cfg_scale = dd_cfg_scale if dd_cfg_scale > 0 else p_txt.cfg_scale
-        steps = dd_steps if dd_steps > 0 else p_txt.steps
-        initial_noise_multiplier = dd_noise_multiplier if dd_noise_multiplier > 0 else None
+        cfg_scale = args.dd_cfg_scale if args.dd_cfg_scale > 0 else p_txt.cfg_scale
+        steps = args.dd_steps if args.dd_steps > 0 else p_txt.steps
+        initial_noise_multiplier = args.dd_noise_multiplier if args.dd_noise_multiplier > 0 else None
 
-        inpaint_width = dd_inpaint_width if dd_inpaint_width > 0 else p_txt.width
-        inpaint_height  = dd_inpaint_height if dd_inpaint_height > 0 else p_txt.height
+        inpaint_width = args.dd_inpaint_width if args.dd_inpaint_width > 0 else p_txt.width
+        inpaint_height  = args.dd_inpaint_height if args.dd_inpaint_height > 0 else p_txt.height
 
         p = StableDiffusionProcessingImg2Img(
                 init_images = [pp.image],
                 resize_mode = 0,
-                denoising_strength = dd_denoising_strength,
+                denoising_strength = args.dd_denoising_strength,
                 mask = None,
-                mask_blur= dd_mask_blur,
+                mask_blur= args.dd_mask_blur,
                 inpainting_fill = 1,
-                inpaint_full_res = dd_inpaint_full_res,
-                inpaint_full_res_padding= dd_inpaint_full_res_padding,
+                inpaint_full_res = args.dd_inpaint_full_res,
+                inpaint_full_res_padding= args.dd_inpaint_full_res_padding,
                 inpainting_mask_invert= 0,
                 initial_noise_multiplier=initial_noise_multiplier,
                 sd_model=p_txt.sd_model,
@@ -2848,7 +2816,7 @@ class MuDetectionDetailerScript(scripts.Script):
 
         # controlnet
         cn_module = get_controlnet_module()
-        cn_controls = cn_module.get_cn_controls(dd_states)
+        cn_controls = cn_module.get_cn_controls(args.dd_states)
 
         # fix for sd-webui 1.9.0RC
         p.extra_generation_params.pop("Hires prompt", None)
@@ -2863,8 +2831,7 @@ class MuDetectionDetailerScript(scripts.Script):
                 scripts += ",controlnet"
 
                 if params is not None:
-                    params = _parse_controlnet_options(params, remap=True)
-                    controls = cn_module.get_cn_controls({"controlnet": params})
+                    controls = cn_module.get_cn_controls({"controlnet": dict(params)})
                 else:
                     controls = copy(cn_controls)
 
@@ -2879,6 +2846,12 @@ class MuDetectionDetailerScript(scripts.Script):
             if cn_units is not None:
                 cn_module.update_cn_script_in_processing(p, cn_units)
 
+        # compile overriding options once
+        inpaint_override_a = compile_inpaint_override(args.dd_states.get("inpaint a", None), "a")
+        inpaint_override_b = compile_inpaint_override(args.dd_states.get("inpaint b", None), "b")
+        cn_override_a = compile_controlnet_override(args.dd_states.get("controlnet a", None), "a") if cn_module.external_code else None
+        cn_override_b = compile_controlnet_override(args.dd_states.get("controlnet b", None), "b") if cn_module.external_code else None
+
         # reset tqdm for inpainting helper mode
         if p_txt._inpainting:
             shared.total_tqdm.updateTotal(0)
@@ -2894,7 +2867,7 @@ class MuDetectionDetailerScript(scripts.Script):
         output_images = []
         segmask_preview_a = None
         segmask_preview_b = None
-        save_jobcount = state.job_count
+        added_jobs = 0
 
         info = processing.create_infotext(p_txt, p_txt.all_prompts, p_txt.all_seeds, p_txt.all_subseeds, None, 0, 0)
         processed = Processed(
@@ -2925,60 +2898,9 @@ class MuDetectionDetailerScript(scripts.Script):
             return detected
 
 
-        def override_inpaint(p, params):
-            if params is None:
-                return
-
-            # parse and set/load default
-            params = (tuple(setting.split(":", 1)) for setting in params)
-            params = dict((x, y.strip()) for x, y in params)
-            params = prepare_load_preset(params)
-
-            sampler =  params.get("Sampler", None)
-            if sampler is not None and sampler in ["None", "Default", "Use same sampler"]:
-                params.pop("Sampler")
-
-            scheduler =  params.get("Scheduler", None)
-            if scheduler is not None and scheduler in ["None", "Default", "Use same scheduler"]:
-                params.pop("Scheduler")
-
-            override_map = (
-                ("Mask blur", "mask_blur"),
-                ("Denoising", "denoising_strength"),
-                ("Inpaint full", "inpaint_full_res"),
-                ("Inpaint padding", "inpaint_full_res_padding"),
-                ("Inpaint width", "width"),
-                ("Inpaint height", "height"),
-                ("Sampler", "sampler_name"),
-                ("Scheduler", "scheduler"),
-                ("Steps", "steps"),
-                ("Noise multiplier", "initial_noise_multiplier"),
-                ("CFG scale", "cfg_scale"),
-            )
-
-            override_settings = {}
-
-            checkpoint = params.get("Checkpoint", "None")
-            if checkpoint not in ["None", "Default", "Use same checkpoint"]:
-                override_settings["sd_model_checkpoint"] = checkpoint
-
-            vae = params.get("VAE", "None")
-            if vae not in ["None", "Default", "Use same VAE"]:
-                override_settings["sd_vae"] = vae
-
-            if params.get("CLIP skip", 0) > 0:
-                override_settings["CLIP_stop_at_last_layers"] = params.get("CLIP skip")
-
-            for name, field in override_map:
-                if params.get(name, None):
-                    setattr(p, field, params.get(name))
-
-            if len(override_settings) > 0:
-                p.override_settings = p.override_settings.update(override_settings)
-
         # check censored style
         use_censored = False
-        censor_params = dd_states.get("censored", {})
+        censor_params = args.dd_states.get("censored", {})
         censor_type = censor_params.get("type", None)
         censor_after = censor_params.get("after", None)
         if censor_params and censor_type in ["blur", "mosaic", "black"]:
@@ -2986,14 +2908,70 @@ class MuDetectionDetailerScript(scripts.Script):
 
         # face upside-down
         detect_upside_down = shared.opts.data.get("mudd_face_upside_down", False)
+        use_landmarks = shared.opts.data.get("mudd_face_upside_down_landmarks", True)
         if detect_upside_down:
-            from scripts.detectors.face_upside_down import is_face_upside_down
+            from scripts.detectors.face_upside_down import faces_upside_down
 
         # gender fix
         use_gender_fix = shared.opts.data.get("mudd_use_gender_fix", False)
         male_prompt = shared.opts.data.get("mudd_male_prompt", "(1 boy)")
         if use_gender_fix:
-            from scripts.detectors.gender import gender_info
+            from scripts.detectors.gender import gender_info_batch
+        elif "scripts.detectors.gender" in sys.modules:
+            # release the GPU copy of the gender model
+            sys.modules["scripts.detectors.gender"].unload()
+
+        # detection resolution
+        detect_resolution = shared.opts.data.get("mudd_detect_resolution", 0)
+
+        # detection gate
+        gate_model, gate_conf, gate_size = get_gate_settings(inpaint_override_a)
+
+        # adaptive inpaint resolution
+        use_adaptive_inpaint = shared.opts.data.get("mudd_adaptive_inpaint", False)
+        adaptive_min = shared.opts.data.get("mudd_adaptive_inpaint_min", 512)
+        adaptive_max = shared.opts.data.get("mudd_adaptive_inpaint_max", 1024)
+        adaptive_scale = shared.opts.data.get("mudd_adaptive_inpaint_scale", 2.0)
+        min_region_size = shared.opts.data.get("mudd_min_region_size", 0)
+
+        # adaptive steps, denoising strength
+        steps_saved = 0
+        image_area = pp.image.size[0] * pp.image.size[1]
+
+        def region_costs(policy, base, masks, results, selected):
+            """(steps, denoising strength) of the selected regions. known before the progress is reserved"""
+            costs = {}
+            for i in selected:
+                if masks[i] is None:
+                    continue
+                if policy is None:
+                    costs[i] = base
+                    continue
+                area = cv2.countNonZero(np.array(masks[i]))
+                costs[i] = region_cost(*base, policy, results[3][i], area, image_area, results[0][i])
+            return costs
+
+        def setup_region_cost(p, policy, base, cost):
+            """setup steps, denoising strength of the region. return saved sampler steps"""
+            if policy is None:
+                return 0
+
+            p.steps, p.denoising_strength = cost
+            print(f" - adaptive steps = {p.steps}, denoising = {p.denoising_strength}")
+            return img2img_sampler_steps(*base) - img2img_sampler_steps(*cost)
+
+        def setup_region(p, mask):
+            """setup inpaint size of the region. return False if the region should be skipped"""
+            bbox = mask.getbbox()
+            if bbox is None or is_small_region(bbox, min_region_size):
+                print(" - skip small region", bbox)
+                metrics.inc("mudd_regions_skipped_total")
+                return False
+
+            if use_adaptive_inpaint and p.inpaint_full_res:
+                p.width, p.height = adaptive_inpaint_size(bbox, p.inpaint_full_res_padding, adaptive_scale, adaptive_min, adaptive_max)
+                print(f" - adaptive inpaint size = {p.width}x{p.height}")
+            return True
 
         for n in range(ddetail_count):
             devices.torch_gc()
@@ -3004,38 +2982,52 @@ class MuDetectionDetailerScript(scripts.Script):
             masks_a = []
             masks_b = []
 
+            # downscaled detection image shared by all detection models
+            detect_image, detect_scale = resize_for_detection(init_image, detect_resolution)
+
+            # optional cheap pre-screen before running heavy detectors
+            gate_passed = True
+            if gate_model != "None" and (args.dd_model_a != "None" or args.dd_model_b != "None"):
+                gate_passed = detection_gate(detect_image, gate_model, gate_conf/100.0, gate_size)
+                if not gate_passed:
+                    print(f"No gate model detections for output generation {p_txt._idx + 1}. skip detection models.")
+
             # Primary run
-            if (dd_model_a != "None"):
+            if (args.dd_model_a != "None") and gate_passed:
                 label_a = "A"
-                results_a = inference(init_image, dd_model_a, dd_conf_a/100.0, label_a, dd_classes_a, dd_max_per_img_a)
-                results_a = sort_results(results_a, dd_detect_order_a)
+                results_a = inference(detect_image, args.dd_model_a, args.dd_conf_a/100.0, label_a, args.dd_classes_a, max_per_img_a)
+                with timing.span("masks", label=label_a, detections=len(results_a[1])):
+                    results_a = rescale_results(results_a, detect_scale, init_image.size)
+                    results_a = sort_results(results_a, args.dd_detect_order_a)
 
-                detected_a = info_results(results_a)
+                    detected_a = info_results(results_a)
 
-                detected = len(results_a[1])
-                print(f"Total {detected} {'was' if detected == 1 else 'were'} detected by model {label_a}...")
+                    detected = len(results_a[1])
+                    print(f"Total {detected} {'was' if detected == 1 else 'were'} detected by model {label_a}...")
 
-                masks_a = create_segmasks(gray_image, results_a)
-                masks_a = dilate_masks(masks_a, dd_dilation_factor_a, 1)
-                masks_a = offset_masks(masks_a,dd_offset_x_a, dd_offset_y_a)
+                    masks_a = create_segmasks(gray_image, results_a)
+                    masks_a = dilate_masks(masks_a, args.dd_dilation_factor_a, 1)
+                    masks_a = offset_masks(masks_a,args.dd_offset_x_a, args.dd_offset_y_a)
 
                 if len(masks_a) == 0:
                     print(f"No model {label_a} detections for output generation {p_txt._idx + 1} with current settings.")
 
             # Secondary run
-            if (dd_model_b != "None"):
+            if (args.dd_model_b != "None") and gate_passed:
                 label_b = "B"
-                results_b = inference(init_image, dd_model_b, dd_conf_b/100.0, label_b, dd_classes_b, dd_max_per_img_b)
-                results_b = sort_results(results_b, dd_detect_order_b)
+                results_b = inference(detect_image, args.dd_model_b, args.dd_conf_b/100.0, label_b, args.dd_classes_b, max_per_img_b)
+                with timing.span("masks", label=label_b, detections=len(results_b[1])):
+                    results_b = rescale_results(results_b, detect_scale, init_image.size)
+                    results_b = sort_results(results_b, args.dd_detect_order_b)
 
-                detected_b = info_results(results_b)
+                    detected_b = info_results(results_b)
 
-                detected = len(results_b[1])
-                print(f"Total {detected} {'was' if detected == 1 else 'were'} detected by model {label_b}...")
+                    detected = len(results_b[1])
+                    print(f"Total {detected} {'was' if detected == 1 else 'were'} detected by model {label_b}...")
 
-                masks_b = create_segmasks(gray_image, results_b)
-                masks_b = dilate_masks(masks_b, dd_dilation_factor_b, 1)
-                masks_b = offset_masks(masks_b,dd_offset_x_b, dd_offset_y_b)
+                    masks_b = create_segmasks(gray_image, results_b)
+                    masks_b = dilate_masks(masks_b, args.dd_dilation_factor_b, 1)
+                    masks_b = offset_masks(masks_b,args.dd_offset_x_b, args.dd_offset_y_b)
 
                 if len(masks_b) == 0:
                     print(f"No model {label_b} detection for output generation {p_txt._idx + 1} with current settings.")
@@ -3045,18 +3037,20 @@ class MuDetectionDetailerScript(scripts.Script):
                 results_ab = [None]*len(results_a)
 
             # Optional secondary pre-processing run
-            if len(masks_b) > 0 and dd_preprocess_b == "before":
+            if len(masks_b) > 0 and args.dd_preprocess_b == "before":
                 results_b = update_result_masks(results_b, masks_b)
-                segmask_preview_b = create_segmask_preview(results_b, init_image, select_masks_b)
+                with timing.span("preview", label=label_b):
+                    segmask_preview_b = create_detection_preview(results_b, init_image, detect_image, detect_scale, args.select_masks_b)
                 shared.state.assign_current_image(segmask_preview_b)
                 if ( opts.mudd_save_previews):
-                    images.save_image(segmask_preview_b, p_txt.outpath_samples, "", start_seed, p.prompt, opts.samples_format, info=info, p=p)
+                    save_aux_image("preview", segmask_preview_b, p_txt.outpath_samples, start_seed, p.prompt, info, p)
 
-                if select_masks_b:
-                    gen_selected = [i for i in select_masks_b if i < len(masks_b) and i >= 0]
+                if args.select_masks_b:
+                    gen_selected = [i for i in args.select_masks_b if i < len(masks_b) and i >= 0]
                 else:
                     gen_selected = range(len(masks_b))
                 state.job_count += len(gen_selected)
+                added_jobs += len(gen_selected)
 
                 selected = len(gen_selected)
                 print(f"Processing {selected} detection{'s' if selected > 1 else ''} of model {label_b} for output generation {p_txt._idx + 1}.")
@@ -3066,11 +3060,11 @@ class MuDetectionDetailerScript(scripts.Script):
                 # prepare controlnet
                 if cn_module.external_code:
                     # get optional controlnet
-                    cn_params = dd_states.get("controlnet b", None)
-                    if cn_params is not None:
-                        cn_prepare(p2, cn_params)
-                    elif cn_controls is not None and "hand" in dd_model_b and "hand_refiner" in cn_controls[1]:
-                        cn_prepare(p2)
+                    with timing.span("controlnet", label=label_b):
+                        if cn_override_b is not None:
+                            cn_prepare(p2, cn_override_b)
+                        elif cn_controls is not None and "hand" in args.dd_model_b and "hand_refiner" in cn_controls[1]:
+                            cn_prepare(p2)
                 # reset cache
                 p2.cached_c = p_txt.cached_c
                 p2.cached_uc = p_txt.cached_uc
@@ -3084,24 +3078,43 @@ class MuDetectionDetailerScript(scripts.Script):
                 p2.init_images = [init_image]
 
                 # check override inpaint settings
-                inpaint_params = dd_states.get("inpaint b", None)
-                override_inpaint(p2, inpaint_params)
+                inpaint_params = None
+                if inpaint_override_b is not None:
+                    inpaint_override_b.apply(p2)
+                    inpaint_params = inpaint_override_b.params
+                policy_b = get_cost_policy(inpaint_params)
+                base_b = (p2.steps, p2.denoising_strength)
 
                 # prompt/negative_prompt for pre-processing
-                p2.prompt = dd_prompt_2 if use_prompt_edit_2 and dd_prompt_2 else p_txt.prompt
-                p2.negative_prompt = dd_neg_prompt_2 if use_prompt_edit_2 and dd_neg_prompt_2 else p_txt.negative_prompt
+                p2.prompt = args.dd_prompt_2 if args.use_prompt_edit_2 and args.dd_prompt_2 else p_txt.prompt
+                p2.negative_prompt = args.dd_neg_prompt_2 if args.use_prompt_edit_2 and args.dd_neg_prompt_2 else p_txt.negative_prompt
 
-                # get img2img sampler steps and update total tqdm
-                _, sampler_steps = sd_samplers_common.setup_img2img_steps(p)
-                if len(gen_selected) > 0 and getattr(shared.total_tqdm, "_tqdm", None) is not None:
-                    shared.total_tqdm.updateTotal(shared.total_tqdm._tqdm.total + (sampler_steps + 1) * len(gen_selected))
+                # reserve total tqdm by the sampler steps of each region
+                costs_b = region_costs(policy_b, base_b, masks_b, results_b, gen_selected)
+                reserve_region_progress(costs_b.values())
+
+                keep_batch_settings(p2, getattr(p_txt, "_mudd_batch_settings", None))
+                yield region_stage_key(p2)
 
                 self.cn_hijack_undo(p2)
+                inpainted = 0
                 for i in gen_selected:
+                    if not setup_region(p2, masks_b[i]):
+                        state.job_count -= 1
+                        added_jobs -= 1
+                        release_region_progress(costs_b[i])
+                        continue
+
+                    steps_saved += setup_region_cost(p2, policy_b, base_b, costs_b[i])
+
                     p2.image_mask = masks_b[i]
                     if ( opts.mudd_save_masks):
-                        images.save_image(masks_b[i], p_txt.outpath_samples, "", start_seed, p2.prompt, opts.samples_format, info=info, p=p2)
-                    processed = processing.process_images(p2)
+                        save_aux_image("mask", masks_b[i], p_txt.outpath_samples, start_seed, p2.prompt, info, p2, f"{label_b}{i}")
+                    with timing.span("sample", label=label_b, region=i, steps=p2.steps, size=(p2.width, p2.height)):
+                        processed = processing.process_images(p2)
+                    inpainted += 1
+                    metrics.inc("mudd_regions_inpainted_total", label=label_b)
+                    metrics.inc("mudd_sampler_steps_total", img2img_sampler_steps(p2.steps, p2.denoising_strength), label=label_b)
 
                     p2.seed = processed.seed + 1
                     p2.subseed = processed.subseed + 1
@@ -3109,23 +3122,24 @@ class MuDetectionDetailerScript(scripts.Script):
 
                 self.cn_hijack_redo(p2)
 
-                if (len(gen_selected) > 0):
+                if inpainted > 0:
                     init_image = copy(processed.images[0])
                     output_images[n] = init_image
 
 
-            if dd_model_a != "None" and len(masks_a) > 0 and dd_model_b != "None" and dd_bitwise_op != "None":
-                label_ab = dd_bitwise_op
+            if args.dd_model_a != "None" and len(masks_a) > 0 and args.dd_model_b != "None" and args.dd_bitwise_op != "None":
+                label_ab = args.dd_bitwise_op
 
                 if len(masks_b) > 0:
-                    combined_mask_b = combine_masks(masks_b)
-                    for i in reversed(range(len(masks_a))):
-                        if (dd_bitwise_op == "A&B"):
-                            masks_ab[i] = bitwise_and_masks(masks_a[i], combined_mask_b)
-                        elif (dd_bitwise_op == "A-B"):
-                            masks_ab[i] = subtract_masks(masks_a[i], combined_mask_b)
-                        if (is_allblack(masks_ab[i])):
-                            masks_ab[i] = None
+                    with timing.span("masks", label=label_ab, detections=len(masks_a)):
+                        combined_mask_b = combine_masks(masks_b)
+                        for i in reversed(range(len(masks_a))):
+                            if (args.dd_bitwise_op == "A&B"):
+                                masks_ab[i] = bitwise_and_masks(masks_a[i], combined_mask_b)
+                            elif (args.dd_bitwise_op == "A-B"):
+                                masks_ab[i] = subtract_masks(masks_a[i], combined_mask_b)
+                            if (is_allblack(masks_ab[i])):
+                                masks_ab[i] = None
                 else:
                     print("No model B detection to overlap with model A masks")
                     results_ab = []
@@ -3134,23 +3148,25 @@ class MuDetectionDetailerScript(scripts.Script):
             # make censored image
             censored_image = None
             if len(masks_a) > 0 and use_censored and not censor_after:
-                censored_image = self.make_censored(init_image, masks_a, results_a, censor_params, select_masks_a)
+                censored_image = self.make_censored(init_image, masks_a, results_a, censor_params, args.select_masks_a)
 
-            elif (dd_model_b != "None" and dd_bitwise_op != "None" and len(masks_ab) > 0) or (dd_bitwise_op == "None" and len(masks_a) > 0):
-                masks = masks_a if dd_bitwise_op == "None" else masks_ab
-                label = label_a if dd_bitwise_op == "None" else label_ab
+            elif (args.dd_model_b != "None" and args.dd_bitwise_op != "None" and len(masks_ab) > 0) or (args.dd_bitwise_op == "None" and len(masks_a) > 0):
+                masks = masks_a if args.dd_bitwise_op == "None" else masks_ab
+                label = label_a if args.dd_bitwise_op == "None" else label_ab
                 results = update_result_masks(results_a, masks)
-                segmask_preview_a = create_segmask_preview(results, init_image, select_masks_a)
+                with timing.span("preview", label=label):
+                    segmask_preview_a = create_detection_preview(results, init_image, detect_image, detect_scale, args.select_masks_a)
                 shared.state.assign_current_image(segmask_preview_a)
                 if ( opts.mudd_save_previews):
-                    images.save_image(segmask_preview_a, p_txt.outpath_samples, "", start_seed, p.prompt, opts.samples_format, info=info, p=p)
+                    save_aux_image("preview", segmask_preview_a, p_txt.outpath_samples, start_seed, p.prompt, info, p)
 
-                if select_masks_a:
-                    gen_selected = [i for i in select_masks_a if i < len(masks) and i >= 0]
+                if args.select_masks_a:
+                    gen_selected = [i for i in args.select_masks_a if i < len(masks) and i >= 0]
                 else:
                     gen_selected = range(len(masks))
 
                 state.job_count += len(gen_selected)
+                added_jobs += len(gen_selected)
 
                 selected = len(gen_selected)
                 print(f"Processing {selected} detection{'s' if selected > 1 else ''} of model {label} for output generation {p_txt._idx + 1}.")
@@ -3161,14 +3177,14 @@ class MuDetectionDetailerScript(scripts.Script):
                 # hand_refiner with model_a == face, model_b == hand, preprocess_b is True -> control_net: disable
                 if cn_module.external_code:
                     # get optional controlnet
-                    cn_params = dd_states.get("controlnet a", None)
-                    if cn_params is not None:
-                        cn_prepare(p, cn_params)
-                    elif cn_controls is not None:
-                        if "hand" in dd_model_b and "hand_refiner" in cn_controls[1] and (dd_bitwise_op == "None" or dd_preprocess_b == "before"):
-                            pass
-                        else:
-                            cn_prepare(p)
+                    with timing.span("controlnet", label=label):
+                        if cn_override_a is not None:
+                            cn_prepare(p, cn_override_a)
+                        elif cn_controls is not None:
+                            if "hand" in args.dd_model_b and "hand_refiner" in cn_controls[1] and (args.dd_bitwise_op == "None" or args.dd_preprocess_b == "before"):
+                                pass
+                            else:
+                                cn_prepare(p)
 
                 # reset cache
                 p.cached_c = p_txt.cached_c
@@ -3183,44 +3199,81 @@ class MuDetectionDetailerScript(scripts.Script):
                 p.init_images = [init_image]
 
                 # check override inpaint settings
-                inpaint_params = dd_states.get("inpaint a", None)
-                override_inpaint(p, inpaint_params)
-
-                # get img2img sampler steps and update total tqdm
-                _, sampler_steps = sd_samplers_common.setup_img2img_steps(p)
-                if len(gen_selected) > 0 and getattr(shared.total_tqdm, "_tqdm", None) is not None:
-                    shared.total_tqdm.updateTotal(shared.total_tqdm._tqdm.total + (sampler_steps + 1) * len(gen_selected))
+                inpaint_params = None
+                if inpaint_override_a is not None:
+                    inpaint_override_a.apply(p)
+                    inpaint_params = inpaint_override_a.params
+                policy_a = get_cost_policy(inpaint_params)
+                base_a = (p.steps, p.denoising_strength)
+
+                # reserve total tqdm by the sampler steps of each region
+                costs_a = region_costs(policy_a, base_a, masks, results, gen_selected)
+                reserve_region_progress(costs_a.values())
+
+                # get gender info of all selected faces at once
+                genders = {}
+                base_prompt = p.prompt
+                if use_gender_fix:
+                    faces = [i for i in gen_selected if masks[i] is not None]
+                    with timing.span("gender", faces=len(faces)):
+                        infos = gender_info_batch(init_image, [results[1][i] for i in faces])
+                    genders = {i: info[0] for i, info in zip(faces, infos)}
+
+                # check orientation of all selected faces at once
+                flipped = {}
+                if detect_upside_down:
+                    faces = [i for i in gen_selected if masks[i] is not None]
+                    landmarks = None
+                    if use_landmarks and len(results) > 5:
+                        landmarks = [results[5][i] for i in faces]
+                    with timing.span("upside_down", faces=len(faces)):
+                        flipped = dict(zip(faces, faces_upside_down(init_image, [results[1][i] for i in faces], landmarks)))
+
+                keep_batch_settings(p, getattr(p_txt, "_mudd_batch_settings", None))
+                yield region_stage_key(p)
 
                 self.cn_hijack_undo(p)
+                inpainted = 0
                 for i in gen_selected:
                     if masks[i] is None:
+                        # no progress is reserved
+                        continue
+
+                    if not setup_region(p, masks[i]):
+                        state.job_count -= 1
+                        added_jobs -= 1
+                        release_region_progress(costs_a[i])
                         continue
 
+                    steps_saved += setup_region_cost(p, policy_a, base_a, costs_a[i])
+
                     if use_gender_fix:
-                        # cropped face image to torch
-                        bbox = results[1][i]
-                        gender = gender_info(init_image, bbox)[0]
+                        p.prompt = base_prompt
+                        gender = genders.get(i, None)
                         if gender in ["male"]:
                             print(" - gender =", gender)
-                            p.prompt = male_prompt + ", " + p.prompt
+                            p.prompt = male_prompt + ", " + base_prompt
 
                     # check upside down face
                     is_face_flipped = None
                     if detect_upside_down:
-                        bbox = results[1][i]
-                        is_face_flipped = is_face_upside_down(init_image, bbox)
+                        is_face_flipped = flipped.get(i, None)
                         print(" - flipped face = ", is_face_flipped)
 
                     p.image_mask = masks[i]
                     if ( opts.mudd_save_masks):
-                        images.save_image(masks[i], p_txt.outpath_samples, "", start_seed, p.prompt, opts.samples_format, info=info, p=p)
+                        save_aux_image("mask", masks[i], p_txt.outpath_samples, start_seed, p.prompt, info, p, f"{label}{i}")
 
                     # rotate mask and image before process_images()
                     if is_face_flipped:
                         p.image_mask = masks[i].rotate(180)
                         p.init_images = [init_image.rotate(180)]
 
-                    processed = processing.process_images(p)
+                    with timing.span("sample", label=label, region=i, steps=p.steps, size=(p.width, p.height)):
+                        processed = processing.process_images(p)
+                    inpainted += 1
+                    metrics.inc("mudd_regions_inpainted_total", label=label)
+                    metrics.inc("mudd_sampler_steps_total", img2img_sampler_steps(p.steps, p.denoising_strength), label=label)
                     p.seed = processed.seed + 1
                     p.subseed = processed.subseed + 1
 
@@ -3234,15 +3287,22 @@ class MuDetectionDetailerScript(scripts.Script):
 
                 self.cn_hijack_redo(p)
 
-                if len(gen_selected) > 0 and len(processed.images) > 0:
+                if inpainted > 0 and len(processed.images) > 0:
                     output_images[n] = processed.images[0]
 
                 # make censored image
                 if use_censored and censor_after and len(masks_b) > 0 and len(processed.images) > 0:
-                    censored_image = self.make_censored(processed.images[0], masks_b, results_b, censor_params, select_masks_b)
+                    censored_image = self.make_censored(processed.images[0], masks_b, results_b, censor_params, args.select_masks_b)
 
             state.job = f"Generation {p_txt._idx + 1} out of {state.job_count}"
 
+        # finish images of the batch in order
+        yield None
+
+        if steps_saved != 0:
+            print(f"Total {steps_saved} sampler steps saved by adaptive steps.")
+            p_txt.extra_generation_params["MuDDetailer steps saved"] = steps_saved
+
         # remove ControlNet Unit info
         if cn_controls is not None:
             p_txt.extra_generation_params.pop("ControlNet 0", None)
@@ -3260,6 +3320,10 @@ class MuDetectionDetailerScript(scripts.Script):
             if p_txt.extra_generation_params.get(k) is not None:
                 p_txt.extra_generation_params.pop(k)
 
+        timings = timing.current()
+        if timings is not None and timings.enabled and shared.opts.data.get("mudd_timings_infotext", False):
+            p_txt.extra_generation_params["MuDDetailer timings"] = timings.infotext()
+
         info = processing.create_infotext(p_txt, p_txt.all_prompts, p_txt.all_seeds, p_txt.all_subseeds, None, 0, 0)
 
         processed.masks_a = detected_a
@@ -3275,15 +3339,15 @@ class MuDetectionDetailerScript(scripts.Script):
 
         if len(output_images) > 0:
             if shared.opts.data.get("mudd_save_original", False) and not p_txt._inpainting:
-                images.save_image(pp.image, p_txt.outpath_samples, "", p_txt.seed, p_txt.prompt, opts.samples_format, info=orig_info, p=p_txt)
+                save_aux_image("original", pp.image, p_txt.outpath_samples, p_txt.seed, p_txt.prompt, orig_info, p_txt)
 
-            if state.job_count != save_jobcount and not p_txt._inpainting:
+            if added_jobs != 0 and not p_txt._inpainting:
                 self._init_images[-1].append(pp.image)
 
             pp.image = output_images[0]
 
             # postprocess some stuff
-            params = dd_states.get("extra", {})
+            params = args.dd_states.get("extra", {})
             if "noise_alpha" in params and params["noise_alpha"] != 0:
                 alpha = params["noise_alpha"]
                 img_noise = gaussian_noise(pp.image.size[0], pp.image.size[1])
@@ -3310,7 +3374,7 @@ class MuDetectionDetailerScript(scripts.Script):
 
             pp.image.info["parameters"] = info
 
-        if state.job_count == save_jobcount and getattr(self, "_image_masks", None) is not None:
+        if added_jobs == 0 and getattr(self, "_image_masks", None) is not None:
             if segmask_preview_a is not None:
                 segmask_preview_a.info["parameters"] = info
                 self._image_masks[-1].append(segmask_preview_a)
@@ -3333,137 +3397,172 @@ class MuDetectionDetailerScript(scripts.Script):
         if p_txt._fix_nextjob:
             # fix for webui behavior
             state.job_no -= 1
+
+        timings = timing.end()
+        if timings is not None and timings.enabled:
+            report_timings(timings, size=pp.image.size, model_a=args.dd_model_a, model_b=args.dd_model_b)
         return processed
 
+    def postprocess_batch_list(self, p, pp, *_args, **kwargs):
+        """detail all images of the batch at once, grouping regions by checkpoint, VAE, CLIP skip and sampler"""
+        p._mudd_batch = None
+        if getattr(p, "_disable_muddetailer", False) or not shared.opts.data.get("mudd_batch_schedule", False):
+            return
+        if len(pp.images) < 2 or p.restore_faces:
+            # face restoration runs before postprocess_image(). keep the per image order
+            return
+
+        args = getattr(p, "_mudd_args", None)
+        if args is None:
+            try:
+                args = DetailerArgs.parse(_args)
+            except ValueError as e:
+                raise gr.Error(f"MuDDetailer: {e}")
+        if not args.enabled:
+            return
+
+        pps = [scripts.PostprocessImageArgs(sample_to_image(x)) for x in pp.images]
+        timings = [None] * len(pps)
+
+        def step(i, stages):
+            prev = timing.activate(timings[i])
+            try:
+                return next(stages)
+            finally:
+                timings[i] = timing.activate(prev)
+
+        # checkpoint, VAE and CLIP skip are switched once per group and restored once after the batch
+        p._mudd_batch_settings = {k: getattr(shared.opts, k) for k in BATCH_SETTINGS if k in shared.opts.data_labels}
+        metrics.inc("mudd_queue_depth", len(pps))
+        try:
+            run_grouped([self._detail_stages(p, pp_i, args) for pp_i in pps], step)
+        finally:
+            metrics.inc("mudd_queue_depth", -len(pps))
+            restore_batch_settings(p._mudd_batch_settings)
+            p._mudd_batch_settings = None
+
+        # used by postprocess_image() of each image
+        p._mudd_batch = {i: pp_i.image for i, pp_i in enumerate(pps)}
+        p.close()
+
     def postprocess_image(self, p, pp, *_args):
         if getattr(p, "_disable_muddetailer", False):
             return
 
-        if type(_args[0]) is bool:
-            (enabled, use_prompt_edit, use_prompt_edit_2,
-                     dd_model_a, dd_classes_a,
-                     dd_conf_a, dd_max_per_img_a,
-                     dd_detect_order_a, dd_select_masks_a,
-                     dd_dilation_factor_a,
-                     dd_offset_x_a, dd_offset_y_a,
-                     dd_prompt, dd_neg_prompt,
-                     dd_preprocess_b, dd_bitwise_op,
-                     dd_model_b, dd_classes_b,
-                     dd_conf_b, dd_max_per_img_b,
-                     dd_detect_order_b, dd_select_masks_b,
-                     dd_dilation_factor_b,
-                     dd_offset_x_b, dd_offset_y_b,
-                     dd_prompt_2, dd_neg_prompt_2,
-                     dd_mask_blur, dd_denoising_strength,
-                     dd_inpaint_full_res, dd_inpaint_full_res_padding,
-                     dd_inpaint_width, dd_inpaint_height,
-                     dd_cfg_scale, dd_steps, dd_noise_multiplier,
-                     dd_sampler, dd_scheduler, dd_checkpoint, dd_vae, dd_clipskip, dd_states) = (*_args,)
-        else:
-            # for API
-            args = _args[0]
-
-            enabled = args.get("enabled", False)
-            use_prompt_edit = args.get("use prompt edit", False)
-            use_prompt_edit_2 = args.get("use prompt edit b", False)
-            dd_model_a = args.get("model a", "None")
-            dd_classes_a = args.get("classes a", [])
-            dd_conf_a = args.get("conf a", 30)
-            dd_max_per_img_a = args.get("max detection a", 0)
-            dd_detect_order_a = args.get("detect order a", [])
-            dd_select_masks_a = args.get("select masks a", '')
-            dd_dilation_factor_a = args.get("dilation a", 4)
-            dd_offset_x_a = args.get("offset x a", 0)
-            dd_offset_y_a = args.get("offset y a", 0)
-            dd_prompt = args.get("prompt", "")
-            dd_neg_prompt = args.get("negative prompt", "")
-
-            dd_preprocess_b = args.get("preprocess b", "none")
-            dd_bitwise_op = args.get("bitwise", "None")
-
-            dd_model_b = args.get("model b", "None")
-            dd_classes_b = args.get("classes b", [])
-            dd_conf_b = args.get("conf b", 30)
-            dd_max_per_img_b = args.get("max detection b", 0)
-            dd_detect_order_b = args.get("detect order b", [])
-            dd_select_masks_b = args.get("select masks b", '')
-            dd_dilation_factor_b = args.get("dilation b", 4)
-            dd_offset_x_b = args.get("offset x b", 0)
-            dd_offset_y_b = args.get("offset y b", 0)
-            dd_prompt_2 = args.get("prompt b", "")
-            dd_neg_prompt_2 = args.get("negative prompt b", "")
-
-            dd_mask_blur = args.get("mask blur", 4)
-            dd_denoising_strength = args.get("denoising strength", 0.4)
-            dd_inpaint_full_res = args.get("inpaint full", True)
-            dd_inpaint_full_res_padding = args.get("inpaint full padding", 32)
-            dd_inpaint_width = args.get("inpaint width", 0)
-            dd_inpaint_height = args.get("inpaint height", 0)
-            dd_cfg_scale = args.get("CFG scale", 0)
-            dd_steps = args.get("steps", 0)
-            dd_noise_multiplier = args.get("noise multiplier", 0)
-            dd_sampler = args.get("sampler", "None")
-            dd_scheduler = args.get("scheduler", "None")
-            dd_checkpoint = args.get("checkpoint", "None")
-            dd_vae = args.get("VAE", "None")
-            dd_clipskip = args.get("CLIP skip", 0)
-            dd_states = args.get("options", {})
-
-        # some check for API
-        if dd_classes_a is str:
-            if dd_classes_a.find(",") != -1:
-                dd_classes_a = [x.strip() for x in dd_classes_a.split(",")]
-        if dd_classes_a == "None":
-            dd_classes_a = None
-
-        if dd_classes_b is str:
-            if dd_classes_b.find(",") != -1:
-                dd_classes_b = [x.strip() for x in dd_classes_b.split(",")]
-        if dd_classes_b == "None":
-            dd_classes_b = None
-
-        if dd_detect_order_a is str:
-            if dd_detect_order_a.find(",") != -1:
-                dd_detect_order_a = [x.strip() for x in dd_detect_order_a.split(",")]
-        if dd_detect_order_a == "None":
-            dd_detect_order_a = None
-
-        if dd_detect_order_b is str:
-            if dd_detect_order_b.find(",") != -1:
-                dd_detect_order_b = [x.strip() for x in dd_detect_order_b.split(",")]
-        if dd_detect_order_b == "None":
-            dd_detect_order_b = None
-
-        valid_orders = ["area", "position"]
-        dd_detect_order_a = list(set(valid_orders) & set(dd_detect_order_a))
-        dd_detect_order_b = list(set(valid_orders) & set(dd_detect_order_b))
-
-        if not enabled:
+        # already detailed by postprocess_batch_list()
+        batch = getattr(p, "_mudd_batch", None)
+        if batch is not None and getattr(p, "batch_index", None) in batch:
+            pp.image = batch.pop(p.batch_index)
+            return
+
+        # parsed once in process() and shared by all images
+        args = getattr(p, "_mudd_args", None)
+        if args is None:
+            try:
+                args = DetailerArgs.parse(_args)
+            except ValueError as e:
+                raise gr.Error(f"MuDDetailer: {e}")
+
+        if not args.enabled:
             return
 
-        self._postprocess_image(p, pp, use_prompt_edit, use_prompt_edit_2,
-                     dd_model_a, dd_classes_a,
-                     dd_conf_a, dd_max_per_img_a,
-                     dd_detect_order_a, dd_select_masks_a,
-                     dd_dilation_factor_a,
-                     dd_offset_x_a, dd_offset_y_a,
-                     dd_prompt, dd_neg_prompt,
-                     dd_preprocess_b, dd_bitwise_op,
-                     dd_model_b, dd_classes_b,
-                     dd_conf_b, dd_max_per_img_b,
-                     dd_detect_order_b, dd_select_masks_b,
-                     dd_dilation_factor_b,
-                     dd_offset_x_b, dd_offset_y_b,
-                     dd_prompt_2, dd_neg_prompt_2,
-                     dd_mask_blur, dd_denoising_strength,
-                     dd_inpaint_full_res, dd_inpaint_full_res_padding,
-                     dd_inpaint_width, dd_inpaint_height,
-                     dd_cfg_scale, dd_steps, dd_noise_multiplier,
-                     dd_sampler, dd_scheduler, dd_checkpoint, dd_vae, dd_clipskip, dd_states)
+        metrics.inc("mudd_queue_depth")
+        try:
+            self._postprocess_image(p, pp, args)
+        finally:
+            metrics.inc("mudd_queue_depth", -1)
 
         p.close()
 
 
+writer = None
+
+def get_writer():
+    global writer
+
+    if writer is None:
+        writer = BackgroundWriter(max_pending=shared.opts.data.get("mudd_background_save_queue", 16))
+    return writer
+
+
+def pending_writes_count():
+    return writer.pending() if writer is not None else 0
+
+
+metrics.gauge_callback("mudd_writes_pending", pending_writes_count)
+
+
+def save_aux_image(kind, image, path, seed, prompt, info, p, region=None):
+    """save masks, previews and original images. in the background if mudd_background_save is enabled"""
+    background = shared.opts.data.get("mudd_background_save", True)
+    mask_format = shared.opts.data.get("mudd_mask_format", "image")
+
+    if kind == "mask" and mask_format != "image":
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{seed}-{region}"
+        func, args, kwargs = save_mask, (image, os.path.join(path, "masks", name), mask_format), {}
+    else:
+        func, args = images.save_image, (image, path, "", seed, prompt, opts.samples_format)
+        kwargs = {"info": info, "p": p}
+        if background:
+            # p could be changed before the image is saved. distinct names from the images saved by webui at the same time
+            kwargs = {"info": info, "p": copy(p), "suffix": f"-{kind}"}
+
+    with timing.span("save", kind=kind):
+        if background:
+            get_writer().submit(func, *args, **kwargs)
+        else:
+            func(*args, **kwargs)
+
+
+BATCH_SETTINGS = ("sd_model_checkpoint", "sd_vae", "CLIP_stop_at_last_layers")
+
+
+def keep_batch_settings(p, saved):
+    """do not restore the settings after each region of the batch. unset settings are the saved ones,
+    so a region never runs with the checkpoint/VAE left by the previous group"""
+    if saved is None:
+        return
+    p.override_settings = {**saved, **(p.override_settings or {})}
+    p.override_settings_restore_afterwards = False
+
+
+def restore_batch_settings(saved):
+    """restore the settings left by the regions of the batch"""
+    for k, v in saved.items():
+        if getattr(shared.opts, k) == v:
+            continue
+        setattr(shared.opts, k, v)
+        if k == "sd_model_checkpoint":
+            sd_models.reload_model_weights()
+        elif k == "sd_vae":
+            sd_vae.reload_vae_weights()
+
+
+def region_stage_key(p):
+    """(checkpoint, VAE, CLIP skip, sampler) of the inpainting. used to group regions of the batch"""
+    overrides = p.override_settings or {}
+    return (overrides.get("sd_model_checkpoint", None), overrides.get("sd_vae", None),
+            overrides.get("CLIP_stop_at_last_layers", None), p.sampler_name)
+
+
+def sample_to_image(x):
+    """PIL image of the decoded sample (C, H, W) in [0, 1], the same as process_images() does"""
+    x = x.cpu().numpy() if hasattr(x, "cpu") else np.asarray(x)
+    return Image.fromarray((255. * np.moveaxis(x, 0, 2)).astype(np.uint8))
+
+
+def report_timings(timings, **tags):
+    """write timings to the JSON lines log file or print a summary"""
+    path = shared.opts.data.get("mudd_timings_log", "")
+    if path:
+        try:
+            timings.dump(path, **tags)
+        except OSError as e:
+            print(f" - failed to write timings to {path} - {e}")
+    else:
+        print(f" - MuDDetailer timings: {timings.infotext()}")
+
+
 def gaussian_noise(width, height):
     img = np.zeros((height, width, 3), np.uint8)
     # mean = 0
@@ -3563,47 +3662,6 @@ def parse_prompt(x: str):
     return res
 
 
-def parse_select_masks(line, default_lab="A"):
-    """
-    Parse selected masks line
-
-    A:1,B:2-4,A:3-7 => A:[1,3,4,5,6,7] B:[2,3,4]
-    """
-    tmp = [x.strip() for x in line.strip().split(",")]
-
-    parts = {"A": [], "B": []}
-    for x in tmp:
-        if ":" in x:
-            lab, num = x.rsplit(":", 1)
-        else:
-            lab = default_lab
-            num = x
-
-        if '-' in num:
-            nums = [
-                int(x.strip()) for x in num.split("-") if x.strip().isdigit()
-            ]
-            if len(nums) == 2:
-                nums = list(range(nums[0], nums[1] + 1))
-            else:
-                continue
-        elif num != '':
-            nums = [int(num)]
-        else:
-            continue
-
-        if lab.startswith("B"):
-            parts["B"] = parts["B"] + nums
-        elif lab.startswith("A"):
-            parts["A"] = parts["A"] + nums
-        else:
-            continue
-
-    parts["A"] = list(set(parts["A"]))
-    parts["B"] = list(set(parts["B"]))
-    return parts
-
-
 def zip_ranges(inp):
     """
     Zip ranges
@@ -3646,79 +3704,90 @@ def zip_ranges(inp):
 
 
 def modeldataset(model_shortname):
-    path = modelpath(model_shortname)
-    if "mmdet" in path and ("segm" in path or "coco" in model_shortname):
-        dataset = 'coco'
-    else:
-        dataset = 'bbox'
-    return dataset
+    entry = find_model(model_shortname)
+    if entry is None:
+        raise gr.Error("No matched model found.")
+    if entry.dataset == "coco" or ("mmdet" in entry.path and "coco" in model_shortname):
+        return "coco"
+    return "bbox"
 
-def match_modelname(modelname):
-    model_list = list_models()
 
-    if modelname.find("[") == -1:
-        for model in model_list:
-            if modelname in model:
-                tmp = model.split(" ")[0]
-                if "/" in modelname and modelname == tmp:
-                    modelname = model
-                elif modelname == tmp.split("/")[-1]:
-                    modelname = model
-                    break
-
-    if modelname in models_alias:
-        return modelname
-    return None
+def find_model(modelname):
+    """find the model entry by title, name, basename or path"""
+    if model_list is None:
+        list_models()
+    return model_index.lookup(modelname)
 
 
-def modelpath(modelname):
-    model = match_modelname(modelname)
+def match_modelname(modelname):
+    entry = find_model(modelname)
+    if entry is None:
+        return None
+    return entry.title
+
 
-    if model in models_alias:
-        path = models_alias[model]
-        model_h = model.split("[")[-1].split("]")[0]
-        if model_hash(path) == model_h:
-            return path
-        if old_model_hash(path) == model_h:
-            return path
+def modelpath(modelname):
+    if model_list is None:
+        list_models()
+    # the cached hash is validated by stat()
+    entry = model_index.resolve(modelname)
+    if entry is not None:
+        return entry.path
 
     raise gr.Error("No matched model found.")
 
 
-def sort_results(results, orders):
-    if len(results[1]) <= 1 or orders is None or len(orders) == 0:
+def resize_for_detection(image, resolution=0):
+    """resize image to the given detection resolution (long side). return resized image and scale"""
+    if resolution <= 0 or max(image.size) <= resolution:
+        return image, 1.0
+
+    scale = resolution / max(image.size)
+    size = (max(int(round(image.size[0] * scale)), 1), max(int(round(image.size[1] * scale)), 1))
+    return image.resize(size, Image.BILINEAR), scale
+
+
+def rescale_results(results, scale, size, pad=2):
+    """rescale bboxes and masks of the detection results to the original image size"""
+    if scale == 1.0 or len(results[1]) == 0:
         return results
 
-    bboxes = results[1]
-    items = len(bboxes)
-    order = range(items)
-
-    # get max size bbox
-    sortkey = lambda bbox: -(bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
-    tmpord = sorted(order, key=lambda i: sortkey(bboxes[i]))
-    # setup marginal variables ~0.2
-    bbox = bboxes[tmpord[0]]
-    area = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
-    marginarea = int(area * 0.2)
-    marginwidth = int(math.sqrt(area) * 0.2)
-
-    # sort by position (left to light)
-    if "position" in orders:
-        sortkey = lambda bbox: int(int((bbox[0] + (bbox[2] - bbox[0]) * 0.5)/marginwidth)*marginwidth)
-        order = sorted(order, key=lambda i: sortkey(bboxes[i]))
-
-    # sort by area
-    if "area" in orders:
-        sortkey = lambda bbox: -int(int((bbox[2] - bbox[0]) * (bbox[3] - bbox[1])/marginarea)*marginarea)
-        order = sorted(order, key=lambda i: sortkey(bboxes[i]))
-
-    # sort all results
-    results[1] = [bboxes[i] for i in order]
-    results[0] = [results[0][i] for i in order]
-    if len(results[2]) > 0:
-        results[2] = [results[2][i] for i in order]
-    results[3] = [results[3][i] for i in order]
-    return results
+    w, h = size
+    bboxes = []
+    segms = []
+    for i, bbox in enumerate(results[1]):
+        rescaled = np.array(bbox[:4], dtype=np.float32) / scale
+        rescaled[0::2] = np.clip(rescaled[0::2], 0, w)
+        rescaled[1::2] = np.clip(rescaled[1::2], 0, h)
+        bboxes.append(rescaled)
+
+        if len(results[2]) == 0:
+            continue
+
+        # upsample mask only inside its (padded) bbox
+        segm = results[2][i]
+        sh, sw = segm.shape[:2]
+        x1, y1 = max(int(bbox[0]) - pad, 0), max(int(bbox[1]) - pad, 0)
+        x2, y2 = min(int(math.ceil(bbox[2])) + pad, sw), min(int(math.ceil(bbox[3])) + pad, sh)
+
+        mask = np.zeros((h, w), dtype=bool)
+        X1, Y1 = int(x1 / scale), int(y1 / scale)
+        X2, Y2 = min(int(math.ceil(x2 / scale)), w), min(int(math.ceil(y2 / scale)), h)
+        if x2 > x1 and y2 > y1 and X2 > X1 and Y2 > Y1:
+            crop = segm[y1:y2, x1:x2].astype(np.uint8) * 255
+            crop = cv2.resize(crop, (X2 - X1, Y2 - Y1), interpolation=cv2.INTER_LINEAR)
+            mask[Y1:Y2, X1:X2] = crop > 127
+        segms.append(mask)
+
+    results = Detections.from_list(results)
+    rescaled = Detections(results.labels, bboxes, segms, results.scores)
+    if results.preview is not None:
+        # detection preview
+        rescaled.preview = results.preview.resize(size, Image.BILINEAR)
+    if results.landmarks is not None:
+        # facial landmarks
+        rescaled.landmarks = [np.asarray(points) / scale for points in results.landmarks]
+    return rescaled
 
 
 def update_result_masks(results, masks):
@@ -3732,113 +3801,148 @@ def update_result_masks(results, masks):
 
 def create_segmask_preview(results, image, selected=None):
     use_mediapipe_preview = shared.opts.data.get("mudd_use_mediapipe_preview", False)
-    if use_mediapipe_preview and len(results) > 4:
-        image = results[4]
+    return _create_segmask_preview(results, image, selected, use_mediapipe_preview)
 
-    labels = results[0]
-    bboxes = results[1]
-    segms = results[2]
-    scores = results[3]
 
-    cv2_image = np.array(image)
-    cv2_image = cv2_image[:, :, ::-1].copy()
-    gray = cv2.cvtColor(cv2_image, cv2.COLOR_BGR2GRAY)
+def downscale_results(results, scale, size):
+    """downscale bboxes and masks of the detection results to the detection image size"""
+    results = Detections.from_list(results)
+    bboxes = [np.array(bbox[:4], dtype=np.float32) * scale for bbox in results.bboxes]
+    segms = [cv2.resize(np.asarray(segm, dtype=np.uint8), size, interpolation=cv2.INTER_NEAREST) > 0 for segm in results.segms]
+    scaled = Detections(results.labels, bboxes, segms, results.scores)
+    if results.preview is not None:
+        scaled.preview = results.preview.resize(size, Image.BILINEAR)
+    if results.landmarks is not None:
+        scaled.landmarks = [np.asarray(points) * scale for points in results.landmarks]
+    return scaled
 
-    # no segms? simply generate from bboxes
-    if len(segms) == 0:
-        segms = _create_segms(gray, bboxes)
-
-    if selected is None:
-        selected = []
-
-    for i in range(len(bboxes)):
-        color = np.full_like(cv2_image, np.random.randint(100, 256, (1, 3), dtype=np.uint8))
-        alpha = 0.2
-        if i in selected:
-            # selected masks change color to white and draw bbox rectangle on it
-            #color = np.full_like(cv2_image, np.array([[255, 255, 255]], dtype=np.uint8))
-            bbox = bboxes[i]
-            cv2.rectangle(cv2_image, (int(bbox[0]), int(bbox[1])), (int(bbox[2]), int(bbox[3])), (0, 255, 0), 3, cv2.LINE_AA)
-            alpha = 0.3
-        color_image = cv2.addWeighted(cv2_image, alpha, color, 1-alpha, 0)
-        cv2_mask = segms[i].astype(np.uint8) * 255
-        #cv2_mask_bool = np.array(segms[i], dtype=bool)
-        #centroid = np.mean(np.argwhere(cv2_mask_bool),axis=0)
-        centroid = np.mean(np.argwhere(segms[i]),axis=0)
-        centroid_x, centroid_y = int(centroid[1]), int(centroid[0])
-
-        cv2_mask_rgb = cv2.merge((cv2_mask, cv2_mask, cv2_mask))
-        cv2_image = np.where(cv2_mask_rgb == 255, color_image, cv2_image)
-        text_color = tuple([int(x) for x in ( color[0][0] - 100 )])
-        name = labels[i]
-        score = scores[i]
-
-        if score > 0.0:
-            score = str(score)[:4]
-            text = name + ' ' + score + f":{i+1}"
-        else:
-            text = name + f":{i+1}"
-        (w, h), _ = cv2.getTextSize(text, cv2.FONT_HERSHEY_DUPLEX, 0.4, 1)
-        cv2.putText(cv2_image, text, (centroid_x - int(w/2), centroid_y), cv2.FONT_HERSHEY_DUPLEX, 0.4, text_color, 1, cv2.LINE_AA)
 
-    if ( len(segms) > 0):
-        preview_image = Image.fromarray(cv2.cvtColor(cv2_image, cv2.COLOR_BGR2RGB))
-    else:
-        preview_image = image
-
-    return preview_image
-
-def is_allblack(mask):
-    cv2_mask = np.array(mask)
-    return cv2.countNonZero(cv2_mask) == 0
-
-def bitwise_and_masks(mask1, mask2):
-    cv2_mask1 = np.array(mask1)
-    cv2_mask2 = np.array(mask2)
-    cv2_mask = cv2.bitwise_and(cv2_mask1, cv2_mask2)
-    mask = Image.fromarray(cv2_mask)
-    return mask
-
-def subtract_masks(mask1, mask2):
-    cv2_mask1 = np.array(mask1)
-    cv2_mask2 = np.array(mask2)
-    cv2_mask = cv2.subtract(cv2_mask1, cv2_mask2)
-    mask = Image.fromarray(cv2_mask)
-    return mask
-
-def dilate_masks(masks, dilation_factor, iter=1):
-    if dilation_factor == 0:
-        return masks
-    dilated_masks = []
-    kernel = np.ones((dilation_factor,dilation_factor), np.uint8)
-    for i in range(len(masks)):
-        cv2_mask = np.array(masks[i])
-        dilated_mask = cv2.dilate(cv2_mask, kernel, iter)
-        dilated_masks.append(Image.fromarray(dilated_mask))
-    return dilated_masks
-
-def offset_masks(masks, offset_x, offset_y):
-    if (offset_x == 0 and offset_y == 0):
-        return masks
-    offset_masks = []
-    for i in range(len(masks)):
-        cv2_mask = np.array(masks[i])
-        offset_mask = cv2_mask.copy()
-        offset_mask = np.roll(offset_mask, -offset_y, axis=0)
-        offset_mask = np.roll(offset_mask, offset_x, axis=1)
+def create_detection_preview(results, image, detect_image, scale, selected=None):
+    """segmask preview drawn on the downscaled detection image and upscaled once.
+    drawn on the full size image only if previews are saved"""
+    if scale == 1.0 or shared.opts.data.get("mudd_save_previews", False):
+        return create_segmask_preview(results, image, selected)
+
+    preview = create_segmask_preview(downscale_results(results, scale, detect_image.size), detect_image, selected)
+    return preview.resize(image.size, Image.BILINEAR)
 
-        offset_masks.append(Image.fromarray(offset_mask))
-    return offset_masks
 
-def combine_masks(masks):
-    initial_cv2_mask = np.array(masks[0])
-    combined_cv2_mask = initial_cv2_mask
-    for i in range(1, len(masks)):
-        cv2_mask = np.array(masks[i])
-        combined_cv2_mask = cv2.bitwise_or(combined_cv2_mask, cv2_mask)
+def adaptive_inpaint_size(bbox, padding=0, scale=2.0, min_size=512, max_size=1024, multiple=64):
+    """
+    Get inpaint width, height for a given region
+
+    The inpaint canvas follows the area of the region (+padding) multiplied by the scale,
+    clamped to [min_size, max_size] and rounded to the multiple of 64. The aspect ratio of the region is preserved.
+    """
+    x1, y1, x2, y2 = bbox
+    w = max(x2 - x1, 1) + padding * 2
+    h = max(y2 - y1, 1) + padding * 2
+
+    # equivalent square side of the region
+    side = math.sqrt(w * h) * scale
+    side = min(max(side, min_size), max_size)
+
+    ratio = side / math.sqrt(w * h)
+    # the long side should not exceed max_size
+    ratio = min(ratio, max_size / max(w, h))
+    width = max(int(round(w * ratio / multiple)) * multiple, multiple)
+    height = max(int(round(h * ratio / multiple)) * multiple, multiple)
+    return width, height
+
+def reserve_region_progress(costs):
+    """add the total progress of the regions given by (steps, denoising strength)"""
+    costs = list(costs)
+    if len(costs) > 0 and getattr(shared.total_tqdm, "_tqdm", None) is not None:
+        shared.total_tqdm.updateTotal(shared.total_tqdm._tqdm.total + sum(img2img_sampler_steps(*cost) + 1 for cost in costs))
+
+def release_region_progress(cost):
+    """remove the total progress reserved for a skipped region"""
+    if getattr(shared.total_tqdm, "_tqdm", None) is not None:
+        shared.total_tqdm.updateTotal(max(shared.total_tqdm._tqdm.total - (img2img_sampler_steps(*cost) + 1), 0))
+
+def is_small_region(bbox, min_region_size):
+    if min_region_size <= 0:
+        return False
+    x1, y1, x2, y2 = bbox
+    return min(x2 - x1, y2 - y1) < min_region_size
+
+def img2img_sampler_steps(steps, denoising_strength):
+    """actual img2img sampler steps. see also sd_samplers_common.setup_img2img_steps()"""
+    if getattr(opts, "img2img_fix_steps", False):
+        return steps
+    return int(min(denoising_strength, 0.999) * steps)
+
+def parse_class_weights(text):
+    """
+    Parse class weights line
 
-    combined_mask = Image.fromarray(combined_cv2_mask)
-    return combined_mask
+    "hand=1.25;face=0.8" => {"hand": 1.25, "face": 0.8}
+    """
+    weights = {}
+    if not text:
+        return weights
+
+    for x in str(text).replace(",", ";").split(";"):
+        if "=" not in x:
+            continue
+        cls, w = x.split("=", 1)
+        try:
+            weights[cls.strip().lower()] = float(w)
+        except ValueError:
+            print(f"Error parsing class weight \"{x}\"")
+    return weights
+
+def get_cost_policy(params=None):
+    """get adaptive steps/denoise policy from the global settings and the overriding inpaint params"""
+    policy = {
+        "enabled": shared.opts.data.get("mudd_adaptive_steps", False),
+        "min_steps": shared.opts.data.get("mudd_adaptive_min_steps", 0),
+        "min_denoising": shared.opts.data.get("mudd_adaptive_min_denoising", 0.0),
+        "class_weights": parse_class_weights(shared.opts.data.get("mudd_adaptive_class_weights", "hand=1.25")),
+    }
+
+    if params:
+        if "Adaptive steps" in params:
+            v = params["Adaptive steps"]
+            policy["enabled"] = v if type(v) is bool else str(v) == "True"
+        if "Min steps" in params:
+            policy["min_steps"] = int(params["Min steps"])
+        if "Min denoising" in params:
+            policy["min_denoising"] = float(params["Min denoising"])
+        if "Class weights" in params:
+            policy["class_weights"] = parse_class_weights(params["Class weights"])
+
+    return policy if policy["enabled"] else None
+
+def region_cost(steps, denoising_strength, policy, score, area, image_area, label, ref_ratio=0.05):
+    """
+    Get steps and denoising strength of a region
+
+    The cost factor scales with the size of the region (saturated at ref_ratio of the image area),
+    the confidence score of the detection and the class weight.
+    """
+    size_factor = min(math.sqrt(area / max(image_area * ref_ratio, 1)), 1.0)
+    # mediapipe models have no score
+    conf_factor = 0.5 + 0.5 * float(score) if score > 0 else 1.0
+
+    weight = 1.0
+    for cls, w in policy["class_weights"].items():
+        if cls in label.lower():
+            weight = w
+            break
+
+    factor = size_factor * conf_factor * weight
+
+    min_steps = policy["min_steps"] if policy["min_steps"] > 0 else max(steps // 2, 1)
+    new_steps = max(int(round(steps * factor)), min(min_steps, steps))
+    if weight <= 1.0:
+        new_steps = min(new_steps, steps)
+
+    new_denoising = denoising_strength
+    if policy["min_denoising"] > 0:
+        new_denoising = min(max(denoising_strength * min(factor, 1.0), policy["min_denoising"]), denoising_strength)
+
+    return new_steps, round(new_denoising, 3)
 
 def on_ui_settings():
     section = ("muddetailer", "μ DDetailer")
@@ -3857,59 +3961,222 @@ def on_ui_settings():
     shared.opts.add_option("mudd_show_original", shared.OptionInfo(False, "Show original images in the gallery.", section=section))
     shared.opts.add_option("mudd_save_previews", shared.OptionInfo(False, "Save mask previews", section=section))
     shared.opts.add_option("mudd_save_masks", shared.OptionInfo(False, "Save masks", section=section))
+    shared.opts.add_option(
+        "mudd_mask_format",
+        shared.OptionInfo(
+            default="image",
+            label="Saved mask format (image: samples format with infotext, png1: 1-bit PNG, npz: compressed numpy, rle: run length JSON)",
+            component=gr.Radio,
+            component_args={"choices": ["image", "png1", "npz", "rle"]},
+            section=section,
+        ),
+    )
+    shared.opts.add_option("mudd_background_save", shared.OptionInfo(True, "Save masks, previews and originals in the background", section=section))
+    shared.opts.add_option(
+        "mudd_background_save_queue",
+        shared.OptionInfo(
+            default=16,
+            label="Maximum pending background saves (requires restart)",
+            component=gr.Slider,
+            component_args={"minimum": 1, "maximum": 64, "step": 1},
+            section=section,
+        ),
+    )
     shared.opts.add_option("mudd_import_adetailer", shared.OptionInfo(False, "Import ADetailer options", section=section))
     shared.opts.add_option("mudd_check_validity", shared.OptionInfo(True, "Check validity of model configs on startup", section=section))
     shared.opts.add_option("mudd_check_model_validity", shared.OptionInfo(False, "Check validity of models on startup", section=section))
+    shared.opts.add_option(
+        "mudd_presets_backend",
+        shared.OptionInfo(
+            default="tsv",
+            label="Presets storage (sqlite: shared by several webui processes, requires restart)",
+            component=gr.Radio,
+            component_args={"choices": ["tsv", "sqlite"]},
+            section=section,
+        ),
+    )
+    shared.opts.add_option("mudd_download_mirror", shared.OptionInfo("", "Model download mirror (local directory or URL prefix to replace the original host)", section=section))
+    shared.opts.add_option("mudd_download_manifest", shared.OptionInfo("", "SHA-256 manifest file of models (JSON or sha256sum format)", section=section))
+    shared.opts.add_option(
+        "mudd_download_workers",
+        shared.OptionInfo(
+            default=4,
+            label="Parallel model downloads",
+            component=gr.Slider,
+            component_args={"minimum": 1, "maximum": 8, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option("mudd_verify_model_hashes", shared.OptionInfo(False, "Re-verify cached model hashes in the background on startup", section=section))
     shared.opts.add_option("mudd_use_mediapipe_preview", shared.OptionInfo(False, "Use mediapipe preview if available", section=section))
     shared.opts.add_option("mudd_selected_scripts", shared.OptionInfo(default_scripts, "Selected scripts to apply (comma separated)", section=section))
     shared.opts.add_option("mudd_use_gender_fix", shared.OptionInfo(False, "Use gender fix", section=section))
     shared.opts.add_option("mudd_male_prompt", shared.OptionInfo("(1 boy:1.2)", "Male prompt", section=section))
     shared.opts.add_option("mudd_face_upside_down", shared.OptionInfo(False, "Detect upside-down face", section=section))
+    shared.opts.add_option("mudd_face_upside_down_landmarks", shared.OptionInfo(True, "Use facial landmarks to detect upside-down face if available (mediapipe_face_mesh)", section=section))
+    shared.opts.add_option("mudd_adaptive_inpaint", shared.OptionInfo(False, "Adaptive inpaint resolution per region (inpaint mask only)", section=section))
+    shared.opts.add_option("mudd_batch_schedule", shared.OptionInfo(False, "Detail the whole batch at once to minimize checkpoint/VAE switches (disabled with face restoration)", section=section))
+    shared.opts.add_option(
+        "mudd_adaptive_inpaint_min",
+        shared.OptionInfo(
+            default=512,
+            label="Adaptive inpaint minimum size",
+            component=gr.Slider,
+            component_args={"minimum": 64, "maximum": 2048, "step": 64},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "mudd_adaptive_inpaint_max",
+        shared.OptionInfo(
+            default=1024,
+            label="Adaptive inpaint maximum size",
+            component=gr.Slider,
+            component_args={"minimum": 64, "maximum": 2048, "step": 64},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "mudd_adaptive_inpaint_scale",
+        shared.OptionInfo(
+            default=2.0,
+            label="Adaptive inpaint upscale factor of the detected region",
+            component=gr.Slider,
+            component_args={"minimum": 1.0, "maximum": 8.0, "step": 0.1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "mudd_min_region_size",
+        shared.OptionInfo(
+            default=0,
+            label="Skip regions smaller than (pixels, 0: disabled)",
+            component=gr.Slider,
+            component_args={"minimum": 0, "maximum": 256, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option("mudd_adaptive_steps", shared.OptionInfo(False, "Adaptive steps and denoising strength per region (by size, confidence and class)", section=section))
+    shared.opts.add_option(
+        "mudd_adaptive_min_steps",
+        shared.OptionInfo(
+            default=0,
+            label="Adaptive minimum steps (0: half of the steps)",
+            component=gr.Slider,
+            component_args={"minimum": 0, "maximum": 120, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "mudd_adaptive_min_denoising",
+        shared.OptionInfo(
+            default=0.0,
+            label="Adaptive minimum denoising strength (0: do not change denoising strength)",
+            component=gr.Slider,
+            component_args={"minimum": 0.0, "maximum": 1.0, "step": 0.01},
+            section=section,
+        ),
+    )
+    shared.opts.add_option("mudd_adaptive_class_weights", shared.OptionInfo("hand=1.25", "Adaptive steps class weights (e.g. hand=1.25;face=1.0)", section=section))
+    shared.opts.add_option(
+        "mudd_detect_resolution",
+        shared.OptionInfo(
+            default=0,
+            label="Detection resolution (long side, 0: use the original size)",
+            component=gr.Slider,
+            component_args={"minimum": 0, "maximum": 4096, "step": 64},
+            section=section,
+        ),
+    )
+    shared.opts.add_option("mudd_tiled_models", shared.OptionInfo("", "Sliced inference models with tile size and overlap (comma separated, e.g. face_yolov8n:640:0.2,anime-face:512:0.25)", section=section))
+    shared.opts.add_option(
+        "mudd_tiled_min_size",
+        shared.OptionInfo(
+            default=1536,
+            label="Use sliced inference for images larger than (long side)",
+            component=gr.Slider,
+            component_args={"minimum": 512, "maximum": 8192, "step": 64},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "mudd_gate_model",
+        shared.OptionInfo(
+            default="None",
+            label="Detection gate model to pre-screen images before running detection models",
+            component=gr.Dropdown,
+            component_args=lambda: {"choices": ["None"] + list_models(False)},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "mudd_gate_conf",
+        shared.OptionInfo(
+            default=30,
+            label="Detection gate confidence %",
+            component=gr.Slider,
+            component_args={"minimum": 0, "maximum": 100, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "mudd_gate_size",
+        shared.OptionInfo(
+            default=512,
+            label="Detection gate image size (long side, 0: use the original size)",
+            component=gr.Slider,
+            component_args={"minimum": 0, "maximum": 2048, "step": 64},
+            section=section,
+        ),
+    )
+    shared.opts.add_option("mudd_timings", shared.OptionInfo(False, "Record per-stage timings", section=section))
+    shared.opts.add_option("mudd_timings_infotext", shared.OptionInfo(False, "Add \"MuDDetailer timings\" to the infotext", section=section))
+    shared.opts.add_option("mudd_timings_log", shared.OptionInfo("", "Timings log file (JSON lines, empty: print to console)", section=section))
+    shared.opts.add_option("mudd_onnx_runtime", shared.OptionInfo(True, "Use ONNX Runtime for .onnx detection models if available (CPU)", section=section))
+    shared.opts.add_option(
+        "mudd_onnx_intra_threads",
+        shared.OptionInfo(
+            default=0,
+            label="ONNX Runtime intra-op threads (0: auto)",
+            component=gr.Slider,
+            component_args={"minimum": 0, "maximum": 64, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "mudd_onnx_inter_threads",
+        shared.OptionInfo(
+            default=0,
+            label="ONNX Runtime inter-op threads (0: auto)",
+            component=gr.Slider,
+            component_args={"minimum": 0, "maximum": 16, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "mudd_api_cpu_workers",
+        shared.OptionInfo(
+            default=2,
+            label="Detection workers of the API job queue (requires restart)",
+            component=gr.Slider,
+            component_args={"minimum": 1, "maximum": 16, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "mudd_api_max_jobs",
+        shared.OptionInfo(
+            default=32,
+            label="Max queued API jobs (requires restart)",
+            component=gr.Slider,
+            component_args={"minimum": 1, "maximum": 256, "step": 1},
+            section=section,
+        ),
+    )
 
 
-def _create_segms(gray, bboxes):
-    segms = []
-    for x0, y0, x1, y1 in bboxes:
-        # make black (blank) image
-        mask = np.zeros((gray.shape), np.uint8)
-        # draw white rectangle
-        cv2.rectangle(mask, (int(x0), int(y0)), (int(x1), int(y1)), 255, -1)
-        mask_bool = mask.astype(bool)
-        segms.append(mask_bool)
-
-    return segms
-
-
-def create_segmasks(gray_image, results):
-    bboxes = results[1]
-    segms = results[2]
-
-    if len(segms) == 0:
-        segms = _create_segms(gray_image, bboxes)
-
-    segmasks = []
-    for i in range(len(bboxes)):
-        mask = segms[i].astype(np.uint8) * 255
-        mask = Image.fromarray(mask)
-        segmasks.append(mask)
-
-    return segmasks
-
-
-def create_polyline_from_segms(segms):
-    polys = []
-    for i in range(len(segms)):
-        mask = segms[i].astype(np.uint8) * 255
-        #contours, _ = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)
-        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        polygons = [np.array(polygon).squeeze().reshape(-1).tolist() for polygon in contours]
-        #polygons = [np.array(polygon).squeeze() for polygon in contours]
-        polys.append(polygons)
-    return polys
-
-
-def check_validity():
-    """check validity of model + config settings"""
+def check_validity(checks):
+    """check validity of model + config settings. results are cached by the model hash and the config mtime"""
     model_list = list_models()
     yolo_models = [model for model in model_list if model.startswith("yolo/")]
     print(f" Total \033[92m{len(model_list)-len(yolo_models)}\033[0m mmdet, \033[92m{len(yolo_models)}\033[0m yolo and \033[92m{3}\033[0m mediapipe models.")
@@ -3923,29 +4190,45 @@ def check_validity():
     model_device = get_device()
     valid = 0
     valid_config = 0
+    cached_count = 0
+    checks.step("validity", len(model_list))
     for j, title in enumerate(model_list):
+        checks.advance(title)
         checkpoint = models_alias[title]
         config = os.path.splitext(checkpoint)[0] + ".py"
-        if not os.path.exists(config):
+        if not os.path.exists(config) or checkpoint.endswith(".onnx"):
+            continue
+
+        entry = model_index.lookup(checkpoint)
+        signature = (entry.hash if entry is not None else None, os.path.getmtime(config))
+        cached = checks.cached(checkpoint, signature)
+        if cached is not None and (not modelcheck or cached.get("model", None) is not None):
+            checks.record(checkpoint, signature, config=cached["config"], model=cached.get("model", None))
+            valid_config += 1 if cached["config"] else 0
+            valid += 1 if cached.get("model", None) else 0
+            cached_count += 1
             continue
 
         try:
             conf = Config.fromfile(config)
             print(f"\033[92mSUCCESS\033[0m - success to load config for {checkpoint}!")
         except Exception as e:
-            continue
             print(f"\033[91mFAIL\033[0m - failed to load config for {checkpoint}, please check validity of the config - {e}")
+            checks.record(checkpoint, signature, config=False, model=False)
+            continue
         valid_config += 1
 
         if not modelcheck:
             if j == 0:
                 print(" You can enable model validity tester in the Settings-> μ DDetailer.")
+            checks.record(checkpoint, signature, config=True, model=None)
             continue
         # check default scope
         if "yolov8" in config:
             conf["default_scope"] = "mmyolo"
 
         if init_detector is None:
+            checks.record(checkpoint, signature, config=True, model=None)
             continue
 
         try:
@@ -3957,11 +4240,15 @@ def check_validity():
             print(f"\033[92mSUCCESS\033[0m - success to load {checkpoint}!")
             del model
             valid += 1
+            checks.record(checkpoint, signature, config=True, model=True)
         except Exception as e:
             print(f"\033[91mFAIL\033[0m - failed to load {checkpoint}, please check validity of the model - {e}")
+            checks.record(checkpoint, signature, config=True, model=False)
 
         devices.torch_gc()
 
+    if cached_count > 0:
+        print(f" {cached_count} unchanged models are skipped.")
     if modelcheck:
         print(f" Total \033[92m{valid_config}\033[0m valid mmdet configs, \033[92m{valid}\033[0m models are found.")
     else:
@@ -3987,8 +4274,10 @@ def prepare_classes(classes):
             classes = [c.strip() for c in classes.strip().split(",") if len(c) > 0]
         else:
             classes = [classes.strip()]
+    elif classes is not None:
+        classes = list(classes)
 
-    if len(classes) == 0:
+    if classes is None or len(classes) == 0:
         classes = None
 
     exclude_classes = None
@@ -4015,47 +4304,192 @@ def prepare_classes(classes):
     return classes, exclude_classes
 
 
+gate_stats = {"hit": 0, "miss": 0}
+gate_stats_lock = threading.Lock()
+def get_gate_settings(inpaint_override=None):
+    """get detection gate model settings from the global settings and the compiled overriding inpaint options"""
+    gate_model = shared.opts.data.get("mudd_gate_model", "None")
+    gate_conf = shared.opts.data.get("mudd_gate_conf", 30)
+    gate_size = shared.opts.data.get("mudd_gate_size", 512)
+
+    if inpaint_override is not None:
+        model, conf, size = inpaint_override.gate
+        gate_model = model if model is not None else gate_model
+        gate_conf = conf if conf is not None else gate_conf
+        gate_size = size if size is not None else gate_size
+
+    if gate_model in ["", "Default"]:
+        gate_model = "None"
+
+    return gate_model, gate_conf, gate_size
+
+
+def detection_gate(image, modelname, conf_thres, size=512):
+    """run a cheap detection model on the downscaled image. return False if nothing is detected"""
+    small = image
+    if size > 0 and max(image.size) > size:
+        small = image.copy()
+        small.thumbnail((size, size), Image.BILINEAR)
+
+    results = inference(small, modelname, conf_thres, "G", [], 1)
+    detected = len(results[1]) > 0
+
+    with gate_stats_lock:
+        gate_stats["hit" if detected else "miss"] += 1
+        hit, miss = gate_stats["hit"], gate_stats["miss"]
+    total = hit + miss
+    print(f" - detection gate {modelname}: {'hit' if detected else 'miss'} (hit {hit}/{total}, miss rate {miss * 100 / total:.1f}%)")
+    return detected
+
+
 def gc_model_cache():
-    while len(model_loaded) > 2:
-        model = model_loaded.popitem(last=False)
-        print(" - remove loaded model...")
-        del model
+    with model_cache_lock:
+        while len(model_loaded) > 2:
+            model = model_loaded.popitem(last=False)
+            print(" - remove loaded model...")
+            metrics.inc("mudd_model_cache_evictions_total", cache="mmdet")
+            del model
+
+
+def cached_mmdet_model(modelkey, conf, model_checkpoint, model_device, **kwargs):
+    """get the cached mmdet model or init a new one"""
+    with model_cache_lock:
+        model = model_loaded.get(modelkey, None)
+        if model is None:
+            model = init_detector(conf, model_checkpoint, device=model_device, **kwargs)
+            model_loaded[modelkey] = model
+            metrics.inc("mudd_model_cache_misses_total", cache="mmdet")
+            return model
+
+        print(" - load cached model...")
+        metrics.inc("mudd_model_cache_hits_total", cache="mmdet")
+    model.to(model_device)
+    return model
+
+
+def loaded_models_count():
+    loaded = {(("cache", "mmdet"),): len(model_loaded)}
+    if "scripts.detectors.onnx_runtime" in sys.modules:
+        loaded[(("cache", "onnx"),)] = len(sys.modules["scripts.detectors.onnx_runtime"]._sessions)
+    return loaded
+
+
+def detector_vram_bytes():
+    """parameter bytes of the cached detector models on the GPU"""
+    total = 0
+    with model_cache_lock:
+        models = list(model_loaded.values())
+    for model in models:
+        for param in model.parameters():
+            if param.device.type != "cpu":
+                total += param.numel() * param.element_size()
+    return total
+
+
+metrics.gauge_callback("mudd_detector_models_loaded", loaded_models_count)
+metrics.gauge_callback("mudd_detector_vram_bytes", detector_vram_bytes)
 
 
 def clear_model_cache():
-    model_loaded.clear()
+    with model_cache_lock:
+        model_loaded.clear()
+    if "scripts.detectors.onnx_runtime" in sys.modules:
+        sys.modules["scripts.detectors.onnx_runtime"].clear_sessions()
+    if "scripts.detectors.gender" in sys.modules:
+        sys.modules["scripts.detectors.gender"].unload()
     gc.collect()
     devices.torch_gc()
 
 
+def get_tile_settings(modelname):
+    """get tile size and overlap of the model for sliced inference"""
+    tiled_models = shared.opts.data.get("mudd_tiled_models", "")
+    for setting in tiled_models.split(","):
+        tmp = [x.strip() for x in setting.split(":")]
+        if len(tmp) == 0 or tmp[0] == "" or tmp[0] not in modelname:
+            continue
+        tile_size = int(tmp[1]) if len(tmp) > 1 and tmp[1] else 640
+        overlap = float(tmp[2]) if len(tmp) > 2 and tmp[2] else 0.2
+        return tile_size, overlap
+
+    return None
+
+
 def inference(image, modelname, conf_thres, label, classes=None, max_per_img=100):
-    from scripts.detectors.mediapipe import mediapipe_detector_face as mp_detector_face
-    from scripts.detectors.mediapipe import mediapipe_detector_facemesh as mp_detector_facemesh
-    from scripts.detectors.ultralytics import ultralytics_inference as ultra_inference
+    with timing.span("detect", label=label, model=modelname, size=image.size) as span:
+        tile = get_tile_settings(modelname)
+        tiled_min_size = shared.opts.data.get("mudd_tiled_min_size", 1536)
+        if tile is not None and max(image.size) > max(tiled_min_size, tile[0]):
+            from scripts.detectors.tiling import sliced_inference
+
+            tile_size, overlap = tile
+            print(f" - sliced inference with tile size {tile_size}, overlap {overlap}")
+            detect_batch = lambda images: inference_batch(images, modelname, conf_thres, label, classes, max_per_img)
+            results = Detections.from_list(sliced_inference(image, detect_batch, tile_size, overlap, max_per_img=max_per_img))
+        else:
+            results = inference_batch([image], modelname, conf_thres, label, classes, max_per_img)[0]
+        span.tag(detections=len(results[1]))
 
-    classes, exclude_classes = prepare_classes(classes)
+    return results
 
-    if modelname in ["mediapipe_face_short", "mediapipe_face_full"]:
-        results = mp_detector_face(image, modelname, conf_thres, label, classes, exclude_classes, max_per_img)
-        return results
-    elif modelname in ["mediapipe_face_mesh"]:
-        results = mp_detector_facemesh(image, modelname, conf_thres, label, classes, exclude_classes, max_per_img)
-        return results
 
-    path = modelpath(modelname)
-    if ( "mmdet" in path and "bbox" in path ):
-        results = inference_mmdet_bbox(image, modelname, conf_thres, label, classes, exclude_classes, max_per_img)
-        gc_model_cache()
-    elif ( "mmdet" in path and "segm" in path):
-        results = inference_mmdet_segm(image, modelname, conf_thres, label, classes, exclude_classes, max_per_img)
-        gc_model_cache()
-    elif "yolo/" in path or "yolo\\" in path:
-        results = ultra_inference(image, path, conf_thres, label, classes, exclude_classes, max_per_img, device=get_device())
-    else:
-        return [[], [], [], []]
+def setup_backends():
+    """configure detector backends from the settings"""
+    onnx_backend = get_backend("onnxruntime")
+    if onnx_backend is not None:
+        onnx_backend.configure(
+            enabled=shared.opts.data.get("mudd_onnx_runtime", True),
+            intra_threads=int(shared.opts.data.get("mudd_onnx_intra_threads", 0)),
+            inter_threads=int(shared.opts.data.get("mudd_onnx_inter_threads", 0)),
+        )
+
+
+def inference_batch(images, modelname, conf_thres, label, classes=None, max_per_img=100):
+    setup_backends()
+
+    path = None
+    if modelname not in builtin_models():
+        path = modelpath(modelname)
+
+    backend = find_backend(modelname, path)
+    if backend is None:
+        print(f" - no detector backend found for {modelname}")
+        return [Detections() for _ in images]
+
+    classes, exclude_classes = prepare_classes(deepcopy(classes))
+    device = get_device()
+    start = time.perf_counter()
+    with detector_lock if device != "cpu" else nullcontext():
+        if backend.batch or len(images) == 1:
+            results = backend.detect(images, modelname, path, conf_thres, label, classes, exclude_classes, max_per_img, device=device)
+        else:
+            results = [backend.detect([image], modelname, path, conf_thres, label, classes, exclude_classes, max_per_img, device=device)[0] for image in images]
+    metrics.observe("mudd_detection_seconds", time.perf_counter() - start, backend=backend.name)
+    metrics.inc("mudd_detections_total", sum(len(result[1]) for result in results), backend=backend.name)
     devices.torch_gc()
     return results
 
+
+class MMDetBackend(DetectorBackend):
+    name = "mmdet"
+    masks = True
+    devices = ("cpu", "cuda", "mps")
+
+    def match(self, modelname, path=None):
+        return path is not None and "mmdet" in path and ("bbox" in path or "segm" in path) and not path.endswith(".onnx")
+
+    def detect(self, images, modelname, path, conf_thres, label, classes=None, exclude_classes=None, max_per_img=100, device="cpu"):
+        inference_mmdet = inference_mmdet_bbox if "bbox" in path else inference_mmdet_segm
+        results = []
+        for image in images:
+            results.append(Detections.from_list(inference_mmdet(image, modelname, conf_thres, label, classes, exclude_classes, max_per_img)))
+            gc_model_cache()
+        return results
+
+
+register_backend(MMDetBackend())
+
+
 def inference_mmdet_segm(image, modelname, conf_thres, label, sel_classes, exclude_classes=None, max_per_img=100):
     model_checkpoint = modelpath(modelname)
     model_config = os.path.splitext(model_checkpoint)[0] + ".py"
@@ -4073,13 +4507,7 @@ def inference_mmdet_segm(image, modelname, conf_thres, label, sel_classes, exclu
     bboxes = []
     modelkey = hash(f"{dict(conf) | dict(modelname=modelname, classes=sel_classes)}")
     if mmcv_legacy:
-        if model_loaded.get(modelkey, None) is None:
-            model = init_detector(conf, model_checkpoint, device=model_device)
-            model_loaded[modelkey] = model
-        else:
-            print(" - load cached model...")
-            model = model_loaded[modelkey]
-            model.to(model_device)
+        model = cached_mmdet_model(modelkey, conf, model_checkpoint, model_device)
 
         results = inference_detector(model, np.array(image))
 
@@ -4103,13 +4531,7 @@ def inference_mmdet_segm(image, modelname, conf_thres, label, sel_classes, exclu
         scores = bboxes[:, 4]
         bboxes = bboxes[:, :4]
     else:
-        if model_loaded.get(modelkey, None) is None:
-            model = init_detector(conf, model_checkpoint, palette="random", device=model_device)
-            model_loaded[modelkey] = model
-        else:
-            print(" - load cached model...")
-            model = model_loaded[modelkey]
-            model.to(model_device)
+        model = cached_mmdet_model(modelkey, conf, model_checkpoint, model_device, palette="random")
 
         results = inference_detector(model, np.array(image)).pred_instances
         bboxes = results.bboxes.cpu().numpy()
@@ -4187,23 +4609,11 @@ def inference_mmdet_bbox(image, modelname, conf_thres, label, sel_classes, exclu
 
     modelkey = hash(f"{dict(conf) | dict(modelname=modelname, classes=sel_classes)}")
     if mmcv_legacy:
-        if model_loaded.get(modelkey, None) is None:
-            model = init_detector(conf, model_checkpoint, device=model_device)
-            model_loaded[modelkey] = model
-        else:
-            print(" - load cached model...")
-            model = model_loaded[modelkey]
-            model.to(model_device)
+        model = cached_mmdet_model(modelkey, conf, model_checkpoint, model_device)
 
         results = inference_detector(model, np.array(image))
     else:
-        if model_loaded.get(modelkey, None) is None:
-            model = init_detector(conf, model_checkpoint, device=model_device, palette="random")
-            model_loaded[modelkey] = model
-        else:
-            print(" - load cached model...")
-            model = model_loaded[modelkey]
-            model.to(model_device)
+        model = cached_mmdet_model(modelkey, conf, model_checkpoint, model_device, palette="random")
 
         results = inference_detector(model, np.array(image)).pred_instances
 
@@ -4411,8 +4821,246 @@ def on_infotext_pasted(infotext, results):
 
     results.update(updates)
 
+def inference_images(images, modelname, conf_thres, label, classes=None, max_per_img=100):
+    """detect a list of images. use batched inference if sliced inference is not needed"""
+    if get_tile_settings(modelname) is not None:
+        return [inference(image, modelname, conf_thres, label, classes, max_per_img) for image in images]
+
+    with timing.span("detect", label=label, model=modelname, images=len(images)):
+        return inference_batch(images, modelname, conf_thres, label, deepcopy(classes), max_per_img)
+
+
+def encode_detections(results, masks, mask_format="rle", index=None):
+    """detection results as a JSON serializable dict with compact masks"""
+    index = index if index is not None else range(len(masks))
+    detected = {
+        "index": [i + 1 for i in index],
+        "labels": [results[0][i] for i in index],
+        "bboxes": [[round(float(x), 1) for x in results[1][i][:4]] for i in index],
+        "scores": [round(float(results[3][i]), 4) for i in index],
+    }
+    segms = [np.array(masks[i]) > 0 for i in index]
+    if mask_format == "rle":
+        detected["masks"] = [mask_to_rle(segm) for segm in segms]
+    elif mask_format == "polygon":
+        detected["masks"] = create_polyline_from_segms(segms)
+    return detected
+
+
+DETECT_MASK_FORMATS = ("rle", "polygon", "none")
+
+
+def detect_args(args):
+    """validated (DetailerArgs, mask format) of the detect request. raise ValueError"""
+    if not isinstance(args, dict):
+        raise ValueError("args: dict expected")
+    mask_format = args.get("masks", "rle")
+    if mask_format not in DETECT_MASK_FORMATS:
+        raise ValueError(f"masks: {mask_format!r} is not one of {DETECT_MASK_FORMATS}")
+    return DetailerArgs.from_dict(args), mask_format
+
+
+def detect_images(images, args):
+    """detection only. run model A and B concurrently and apply the bitwise operation of masks"""
+    use_max_per_img = shared.opts.data.get("mudd_max_per_img", 20)
+    args, mask_format = detect_args(args)
+    bitwise = args.dd_bitwise_op
+
+    models = {}
+    for label in ["a", "b"]:
+        model = getattr(args, f"dd_model_{label}")
+        if model in ["None", ""]:
+            continue
+        max_per_img = getattr(args, f"dd_max_per_img_{label}")
+        models[label] = dict(
+            modelname=model,
+            conf_thres=getattr(args, f"dd_conf_{label}") / 100.0,
+            label=label.upper(),
+            classes=list(getattr(args, f"dd_classes_{label}") or []),
+            max_per_img=max_per_img if max_per_img > 0 else use_max_per_img,
+            orders=list(getattr(args, f"dd_detect_order_{label}")),
+            dilation=getattr(args, f"dd_dilation_factor_{label}"),
+            offset=(getattr(args, f"dd_offset_x_{label}"), getattr(args, f"dd_offset_y_{label}")),
+        )
+
+    with ThreadPoolExecutor(max_workers=max(len(models), 1)) as pool:
+        futures = {label: pool.submit(inference_images, images, m["modelname"], m["conf_thres"], m["label"], m["classes"], m["max_per_img"])
+                   for label, m in models.items()}
+        detections = {label: future.result() for label, future in futures.items()}
+
+    outputs = []
+    for n, image in enumerate(images):
+        gray = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2GRAY)
+        output = {}
+        masks = {}
+        for label, m in models.items():
+            results = sort_results(detections[label][n], m["orders"])
+            masks[label] = create_segmasks(gray, results)
+            masks[label] = dilate_masks(masks[label], m["dilation"], 1)
+            masks[label] = offset_masks(masks[label], *m["offset"])
+            output[label] = encode_detections(results, masks[label], mask_format)
+            detections[label][n] = results
+
+        if bitwise in ["A&B", "A-B"] and len(masks.get("a", [])) > 0 and len(masks.get("b", [])) > 0:
+            combined_mask_b = combine_masks(masks["b"])
+            masks_ab = []
+            for mask in masks["a"]:
+                mask = bitwise_and_masks(mask, combined_mask_b) if bitwise == "A&B" else subtract_masks(mask, combined_mask_b)
+                masks_ab.append(None if is_allblack(mask) else mask)
+            index = [i for i, mask in enumerate(masks_ab) if mask is not None]
+            output["ab"] = encode_detections(detections["a"][n], masks_ab, mask_format, index)
+
+        outputs.append(output)
+
+    return outputs
+
+
+def detail_args(body):
+    """validated DetailerArgs of the detail request. raise ValueError"""
+    args = body.get("args", {})
+    if not isinstance(args, dict):
+        raise ValueError("args: dict expected")
+    return DetailerArgs.from_dict({"enabled": True, **args})
+
+
+def detail_images(input_images, body):
+    """detail given images without the base generation. yield results one by one"""
+    from modules.api.api import encode_pil_to_base64
+    from modules.call_queue import queue_lock
+
+    args = detail_args(body)
+    outpath = opts.outdir_samples or opts.outdir_img2img_samples
+
+    for n, image in enumerate(input_images):
+        try:
+            # prompts and seed are taken from the request or the infotext of the image
+            info, _ = images.read_info_from_image(image)
+            params = parse_prompt(info) if info is not None else {}
+
+            seed = int(body.get("seed", params.get("Seed", -1)))
+            p = processing.StableDiffusionProcessingTxt2Img(
+                sd_model=shared.sd_model,
+                outpath_samples=outpath,
+                prompt=body.get("prompt", params.get("Prompt", "")),
+                negative_prompt=body.get("negative_prompt", params.get("Negative prompt", "")),
+                seed=seed,
+                sampler_name=body.get("sampler_name", params.get("Sampler", "Euler a")),
+                batch_size=1,
+                n_iter=1,
+                steps=int(body.get("steps", params.get("Steps", 20))),
+                cfg_scale=float(body.get("cfg_scale", params.get("CFG scale", 7))),
+                width=image.width,
+                height=image.height,
+            )
+            # no other scripts
+            p.scripts = None
+            p.script_args = None
+
+            p.all_seeds = [ processing.get_fixed_seed(seed) ]
+            p.all_prompts = [p.prompt]
+            p.all_negative_prompts = [p.negative_prompt]
+            p.all_subseeds = [processing.get_fixed_seed(p.subseed)]
+
+            p._inpainting = True
+
+            pp = scripts.PostprocessImageArgs(image)
+            script = MuDetectionDetailerScript()
+            with queue_lock:
+                shared.state.begin(job="uddetailer_detail")
+                try:
+                    script.process(p)
+                    script.postprocess_image(p, pp, args)
+                finally:
+                    shared.state.end()
+
+            output = {"index": n, "image": encode_pil_to_base64(pp.image).decode("ascii"), "info": pp.image.info.get("parameters", "")}
+            if body.get("save_images", False) in [True, "true", "True", "1"]:
+                images.save_image(pp.image, outpath, "", p.all_seeds[0], p.prompt, opts.samples_format, info=output["info"], p=p)
+        except Exception as e:
+            print(f" - MuDDetailer failed to detail image {n} - {e}")
+            output = {"index": n, "error": str(e)}
+
+        yield output
+
+
+def interrupt_detail():
+    # do not interrupt other generations
+    if shared.state.job == "uddetailer_detail":
+        shared.state.interrupt()
+
+
+# images detected at once by a detect job. cancel is checked between the chunks
+DETECT_JOB_CHUNK = 8
+
+
+def detect_job(job):
+    images, body = job.payload
+    for i in range(0, len(images), DETECT_JOB_CHUNK):
+        job.check_cancelled()
+        job.results.extend(detect_images(images[i:i + DETECT_JOB_CHUNK], body.get("args", {})))
+
+
+def detail_job(job):
+    images, body = job.payload
+    job.on_cancel = interrupt_detail
+    for output in detail_images(images, body):
+        job.check_cancelled()
+        job.results.append(output)
+
+
+job_queue = None
+
+def get_job_queue():
+    global job_queue
+
+    if job_queue is None:
+        job_queue = JobQueue(
+            {"detect": (detect_job, "cpu"), "detail": (detail_job, "gpu")},
+            cpu_workers=shared.opts.data.get("mudd_api_cpu_workers", 2),
+            max_jobs=shared.opts.data.get("mudd_api_max_jobs", 32),
+        )
+    return job_queue
+
+
+def pending_jobs_count():
+    counts = {}
+    if job_queue is not None:
+        for job in list(job_queue.jobs.values()):
+            if not job.done:
+                key = (("status", job.status), ("type", job.kind))
+                counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+metrics.gauge_callback("mudd_jobs_pending", pending_jobs_count)
+
+
+async def read_api_images(request):
+    """read images and the request body from the JSON body (base64 images) or multipart form (image files)"""
+    from modules.api.api import decode_base64_to_image
+    import io
+
+    try:
+        if request.headers.get("content-type", "").startswith("multipart/form-data"):
+            form = await request.form()
+            images = [Image.open(io.BytesIO(await file.read())) for file in form.getlist("images")]
+            body = {k: v for k, v in form.items() if k != "images"}
+            body["args"] = json.loads(body.get("args", "{}"))
+        else:
+            body = await request.json()
+            if not isinstance(body, dict):
+                raise ValueError("JSON object expected")
+            images = [decode_base64_to_image(image) for image in body.pop("images", [])]
+
+        return [image.convert("RGB") for image in images], body
+    except (ValueError, OSError, HTTPException) as e:
+        # invalid JSON, corrupted or unknown images (UnidentifiedImageError is an OSError)
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        raise HTTPException(status_code=422, detail=f"invalid request: {detail}")
+
+
 def api_version():
-    return "1.0.1"
+    return "1.5.0"
 
 def muddetailer_api(_: gr.Blocks, app: FastAPI):
     @app.get("/uddetailer/version")
@@ -4424,6 +5072,99 @@ def muddetailer_api(_: gr.Blocks, app: FastAPI):
         list_model = list_models()
         return {"model_list": list_model}
 
+    @app.get("/uddetailer/startup")
+    async def startup_status():
+        return startup_checks.to_dict()
+
+    @app.get("/uddetailer/metrics")
+    async def get_metrics(format: str = "json"):
+        if format == "prometheus":
+            return PlainTextResponse(metrics.prometheus(), media_type="text/plain; version=0.0.4")
+        return metrics.snapshot()
+
+    @app.post("/uddetailer/detect")
+    async def detect(request: Request):
+        from starlette.concurrency import run_in_threadpool
+
+        images, body = await read_api_images(request)
+        if len(images) == 0:
+            raise HTTPException(status_code=422, detail="no images given")
+
+        try:
+            detect_args(body.get("args", {}))
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+
+        start = time.perf_counter()
+        outputs = await run_in_threadpool(detect_images, images, body.get("args", {}))
+        return {"images": outputs, "time": round(time.perf_counter() - start, 3)}
+
+    @app.post("/uddetailer/detail")
+    async def detail(request: Request):
+        images, body = await read_api_images(request)
+        if len(images) == 0:
+            raise HTTPException(status_code=422, detail="no images given")
+        try:
+            detail_args(body)
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+
+        # stream results as newline delimited JSON, one line per image
+        def stream():
+            for output in detail_images(images, body):
+                yield json.dumps(output) + "\n"
+
+        return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+    @app.post("/uddetailer/jobs")
+    async def submit_job(request: Request):
+        images, body = await read_api_images(request)
+        if len(images) == 0:
+            raise HTTPException(status_code=422, detail="no images given")
+
+        kind = body.pop("type", "detail")
+        try:
+            priority = int(body.pop("priority", 0))
+        except ValueError:
+            raise HTTPException(status_code=422, detail="invalid priority")
+
+        queue = get_job_queue()
+        if kind not in queue.handlers:
+            raise HTTPException(status_code=422, detail=f"unknown job type {kind}")
+        try:
+            if kind == "detail":
+                detail_args(body)
+            else:
+                detect_args(body.get("args", {}))
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        try:
+            job = await queue.submit(kind, (images, body), priority)
+        except QueueFull:
+            raise HTTPException(status_code=429, detail="job queue is full", headers={"Retry-After": "10"})
+
+        return {"id": job.id, "status": job.status, "position": queue.position(job)}
+
+    @app.get("/uddetailer/jobs")
+    async def list_jobs():
+        queue = get_job_queue()
+        return {"jobs": [job.to_dict(results=False) for job in list(queue.jobs.values())], "pending": queue.pending()}
+
+    @app.get("/uddetailer/jobs/{job_id}")
+    async def get_job(job_id: str):
+        queue = get_job_queue()
+        job = queue.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="job not found")
+        return {**job.to_dict(), "position": queue.position(job)}
+
+    @app.delete("/uddetailer/jobs/{job_id}")
+    async def cancel_job(job_id: str):
+        job = get_job_queue().cancel(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="job not found")
+        return job.to_dict(results=False)
+
 script_callbacks.on_ui_settings(on_ui_settings)
 script_callbacks.on_infotext_pasted(on_infotext_pasted)
 script_callbacks.on_app_started(muddetailer_api)
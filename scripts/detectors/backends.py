@@ -0,0 +1,195 @@
+"""
+Detector backend registry
+
+All detectors are wrapped by a DetectorBackend and return Detections for each image.
+"""
+
+
+class Detections:
+    """
+    Detection results of an image
+
+    Detections is also compatible with the legacy [labels, bboxes, segms, scores, (preview), (landmarks)] list.
+    """
+    __slots__ = ("labels", "bboxes", "segms", "scores", "preview", "landmarks")
+    _fields = ("labels", "bboxes", "segms", "scores", "preview", "landmarks")
+
+    def __init__(self, labels=None, bboxes=None, segms=None, scores=None, preview=None, landmarks=None):
+        self.labels = list(labels) if labels is not None else []
+        self.bboxes = list(bboxes) if bboxes is not None else []
+        self.segms = list(segms) if segms is not None else []
+        self.scores = list(scores) if scores is not None else []
+        self.preview = preview
+        self.landmarks = landmarks
+
+    @classmethod
+    def from_list(cls, results):
+        if isinstance(results, Detections):
+            return results
+        results = list(results)
+        return cls(*[results[i] if i < len(results) else None for i in range(len(cls._fields))])
+
+    def to_list(self):
+        return [self[i] for i in range(len(self))]
+
+    def __len__(self):
+        if self.landmarks is not None:
+            return 6
+        if self.preview is not None:
+            return 5
+        return 4
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.to_list()[i]
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("Detections index out of range")
+        return getattr(self, self._fields[i])
+
+    def __setitem__(self, i, value):
+        if i < 0:
+            i += len(self)
+        setattr(self, self._fields[i], value)
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def __repr__(self):
+        return f"Detections(labels={self.labels}, bboxes={len(self.bboxes)}, segms={len(self.segms)})"
+
+
+class DetectorBackend:
+    """base detector backend"""
+
+    name = None
+    # capabilities
+    masks = False
+    batch = False
+    devices = ("cpu",)
+    # builtin model names without model files
+    models = ()
+
+    def match(self, modelname, path=None):
+        return False
+
+    def classes(self, modelname, path=None):
+        return None
+
+    def capabilities(self):
+        return {"masks": self.masks, "batch": self.batch, "devices": list(self.devices)}
+
+    def detect(self, images, modelname, path, conf_thres, label, classes=None, exclude_classes=None, max_per_img=100, device="cpu"):
+        """detect a list of images. return a list of Detections"""
+        raise NotImplementedError
+
+
+_backends = []
+
+
+def register_backend(backend, priority=0):
+    """register a backend. backends with higher priority are matched first"""
+    unregister_backend(backend.name)
+    _backends.append((priority, backend))
+    _backends.sort(key=lambda x: -x[0])
+
+
+def unregister_backend(name):
+    _backends[:] = [(priority, backend) for priority, backend in _backends if backend.name != name]
+
+
+def list_backends():
+    return [backend for _, backend in _backends]
+
+
+def get_backend(name):
+    for backend in list_backends():
+        if backend.name == name:
+            return backend
+    return None
+
+
+def find_backend(modelname, path=None):
+    for backend in list_backends():
+        if backend.match(modelname, path):
+            return backend
+    return None
+
+
+def builtin_models():
+    return [model for backend in list_backends() for model in backend.models]
+
+
+class MediapipeBackend(DetectorBackend):
+    name = "mediapipe"
+    masks = True
+    models = ("mediapipe_face_short", "mediapipe_face_full", "mediapipe_face_mesh")
+
+    def match(self, modelname, path=None):
+        return modelname in self.models
+
+    def detect(self, images, modelname, path, conf_thres, label, classes=None, exclude_classes=None, max_per_img=100, device="cpu"):
+        from scripts.detectors.mediapipe import mediapipe_detector_face, mediapipe_detector_facemesh
+
+        detector = mediapipe_detector_facemesh if modelname == "mediapipe_face_mesh" else mediapipe_detector_face
+        return [Detections.from_list(detector(image, modelname, conf_thres, label, classes, exclude_classes, max_per_img)) for image in images]
+
+
+class UltralyticsBackend(DetectorBackend):
+    name = "ultralytics"
+    masks = True
+    batch = True
+    devices = ("cpu", "cuda", "mps")
+
+    def match(self, modelname, path=None):
+        return path is not None and ("yolo/" in path or "yolo\\" in path)
+
+    def detect(self, images, modelname, path, conf_thres, label, classes=None, exclude_classes=None, max_per_img=100, device="cpu"):
+        from scripts.detectors.ultralytics import ultralytics_inference_batch
+
+        results = ultralytics_inference_batch(images, path, conf_thres, label, classes, exclude_classes, max_per_img, device=device)
+        return [Detections.from_list(result) for result in results]
+
+
+class OnnxBackend(DetectorBackend):
+    """ONNX Runtime CPU backend for yolo .onnx models"""
+    name = "onnxruntime"
+    masks = True
+    batch = True
+    devices = ("cpu",)
+
+    def __init__(self):
+        self.enabled = True
+        self.intra_threads = 0
+        self.inter_threads = 0
+        self.iou_thres = 0.7
+        self._available = None
+
+    def configure(self, enabled=True, intra_threads=0, inter_threads=0, iou_thres=0.7):
+        self.enabled = enabled
+        self.intra_threads = intra_threads
+        self.inter_threads = inter_threads
+        self.iou_thres = iou_thres
+
+    def available(self):
+        if self._available is None:
+            import importlib.util
+            self._available = importlib.util.find_spec("onnxruntime") is not None
+        return self._available
+
+    def match(self, modelname, path=None):
+        return self.enabled and path is not None and path.endswith(".onnx") and self.available()
+
+    def detect(self, images, modelname, path, conf_thres, label, classes=None, exclude_classes=None, max_per_img=100, device="cpu"):
+        from scripts.detectors.onnx_runtime import onnx_inference_batch
+
+        results = onnx_inference_batch(images, path, conf_thres, label, classes, exclude_classes, max_per_img,
+                    iou_thres=self.iou_thres, intra_threads=self.intra_threads, inter_threads=self.inter_threads)
+        return [Detections.from_list(result) for result in results]
+
+
+register_backend(MediapipeBackend())
+register_backend(UltralyticsBackend())
+# match .onnx models before the ultralytics backend
+register_backend(OnnxBackend(), priority=10)
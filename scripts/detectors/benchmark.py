@@ -0,0 +1,267 @@
+"""
+Detection and mask pipeline benchmark (CPU only, without the webui)
+
+usage: python -m scripts.detectors.benchmark [--sizes 512x512,1024x1536] [--detections 1,8,32]
+                                             [--models ../../models/yolo/face_yolov8n.pt ...]
+                                             [--webui-dir ../..]
+                                             [--output bench.json] [--compare old_bench.json]
+
+Synthetic images with random ellipses are used as inputs. Latency percentiles, the RSS growth
+of each case, the peak RSS of the process and peak traced allocations are reported and written
+as JSON to compare across commits.
+
+Detection runs through inference() of the extension when the webui is given by --webui-dir,
+so mmdet models are available too. Otherwise the same backend registry dispatch is used
+without the webui.
+"""
+import os
+
+# CPU only
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from scripts.detectors.backends import Detections, find_backend, builtin_models
+from scripts.detectors.masks import sort_results, create_segmasks, dilate_masks, offset_masks, combine_masks
+from scripts.detectors.masks import create_segmask_preview, create_polyline_from_segms
+
+
+def synthetic_sample(width, height, detections, seed=0):
+    """generate an image with random ellipses and matching detection results"""
+    rng = np.random.default_rng(seed)
+    image = rng.integers(0, 64, (height, width, 3), dtype=np.uint8)
+
+    labels, bboxes, segms, scores = [], [], [], []
+    for i in range(detections):
+        rw = int(rng.integers(max(width // 20, 4), max(width // 5, 8)))
+        rh = int(rng.integers(max(height // 20, 4), max(height // 5, 8)))
+        cx = int(rng.integers(rw, max(width - rw, rw + 1)))
+        cy = int(rng.integers(rh, max(height - rh, rh + 1)))
+        color = tuple(int(c) for c in rng.integers(128, 256, 3))
+        cv2.ellipse(image, (cx, cy), (rw, rh), 0, 0, 360, color, -1)
+
+        mask = np.zeros((height, width), dtype=np.uint8)
+        cv2.ellipse(mask, (cx, cy), (rw, rh), 0, 0, 360, 255, -1)
+        labels.append(f"A-object{i % 3}")
+        bboxes.append(np.array([max(cx - rw, 0), max(cy - rh, 0), min(cx + rw, width), min(cy + rh, height)], dtype=np.float32))
+        segms.append(mask.astype(bool))
+        scores.append(float(rng.uniform(0.3, 1.0)))
+
+    return Image.fromarray(image), Detections(labels, bboxes, segms, scores)
+
+
+def rss_kb():
+    """current resident set size of the process in KB"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+
+        return psutil.Process().memory_info().rss // 1024
+    except ImportError:
+        return None
+
+
+def peak_rss_kb():
+    """peak resident set size of the process in KB"""
+    try:
+        import resource
+
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # bytes on macOS
+        return rss // 1024 if sys.platform == "darwin" else rss
+    except ImportError:
+        pass
+    try:
+        import psutil
+
+        info = psutil.Process().memory_info()
+        return getattr(info, "peak_wset", info.rss) // 1024
+    except ImportError:
+        return None
+
+
+def measure(func, iterations=20, warmup=2):
+    """return latency statistics, peak traced allocations and RSS of func()"""
+    rss_before = rss_kb()
+    for _ in range(warmup):
+        func()
+
+    times = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000.0)
+
+    # allocations are traced in a separate run to keep the timings clean
+    tracemalloc.start()
+    func()
+    _, alloc_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss_after = rss_kb()
+
+    times = np.array(times)
+    return {
+        "iterations": iterations,
+        "mean_ms": round(float(times.mean()), 3),
+        "p50_ms": round(float(np.percentile(times, 50)), 3),
+        "p95_ms": round(float(np.percentile(times, 95)), 3),
+        "alloc_peak_kb": round(alloc_peak / 1024, 1),
+        # RSS growth of this case. the peak RSS is of the whole process so far
+        "rss_delta_kb": rss_after - rss_before if rss_before is not None and rss_after is not None else None,
+        "process_rss_peak_kb": peak_rss_kb(),
+    }
+
+
+def mask_benchmarks(image, results):
+    """mask pipeline benchmark cases"""
+    gray = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2GRAY)
+    masks = create_segmasks(gray, results)
+    bbox_results = Detections(results.labels, results.bboxes, [], results.scores)
+
+    return {
+        "sort_results": lambda: sort_results(Detections(results.labels, results.bboxes, results.segms, results.scores), ["area", "position"]),
+        "create_segmasks": lambda: create_segmasks(gray, results),
+        "create_segmasks (bbox)": lambda: create_segmasks(gray, bbox_results),
+        "dilate_masks": lambda: dilate_masks(masks, 4),
+        "offset_masks": lambda: offset_masks(masks, 8, -8),
+        "combine_masks": lambda: combine_masks(masks),
+        "create_segmask_preview": lambda: create_segmask_preview(results, image, [0]),
+        "create_polyline_from_segms": lambda: create_polyline_from_segms(results.segms),
+    }
+
+
+def _inference(image, modelname, conf_thres, label, classes=None, max_per_img=100):
+    """inference() without the webui. dispatch through the backend registry"""
+    path = None if modelname in builtin_models() else modelname
+    backend = find_backend(modelname, path)
+    return backend.detect([image], modelname, path, conf_thres, label, classes, None, max_per_img, device="cpu")[0]
+
+
+def load_inference(webui_dir=None):
+    """inference() of the extension if the webui is available, otherwise _inference()"""
+    if webui_dir is None:
+        return _inference
+
+    sys.path.insert(0, os.path.abspath(webui_dir))
+    # ignore the benchmark arguments
+    os.environ.setdefault("IGNORE_CMD_ARGS_ERRORS", "1")
+    try:
+        try:
+            from modules import shared_init
+
+            shared_init.initialize()
+        except ImportError:
+            pass
+        from scripts.ddetailer import inference
+
+        return inference
+    except Exception as e:
+        print(f" - failed to load the extension with the webui {webui_dir}, use the backend registry - {e}")
+        return _inference
+
+
+def inference_benchmarks(image, models, inference, conf_thres=0.3):
+    """detection benchmark cases for each available backend"""
+    cases = {}
+    for model in models:
+        path = None if model in builtin_models() else model
+        backend = find_backend(model, path)
+        name = f"inference {backend.name}:{os.path.basename(model)}" if backend is not None else f"inference {os.path.basename(model)}"
+        if backend is None and inference is _inference:
+            print(f" - no available backend for {model}, skipped")
+            continue
+
+        cases[name] = lambda model=model: inference(image, model, conf_thres, "A")
+    return cases
+
+
+def git_commit():
+    try:
+        cwd = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=cwd, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    old = {(r["name"], r["size"], r["detections"]): r for r in baseline["results"]}
+
+    print(f"\ncompared with {baseline_path} ({baseline['meta'].get('commit')})")
+    for r in results:
+        prev = old.get((r["name"], r["size"], r["detections"]))
+        if prev is None or prev["p50_ms"] == 0:
+            continue
+        ratio = r["p50_ms"] / prev["p50_ms"]
+        mark = "\033[92m" if ratio < 0.95 else "\033[91m" if ratio > 1.05 else ""
+        print(f" {r['name']:<40} {r['size']:>10} {r['detections']:>4}  {prev['p50_ms']:>9.3f} -> {r['p50_ms']:>9.3f} ms {mark}x{ratio:.2f}\033[0m")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="detection and mask pipeline benchmark")
+    parser.add_argument("--sizes", default="512x512,1024x1024,2048x2048", help="comma separated image sizes")
+    parser.add_argument("--detections", default="1,8,32", help="comma separated detection counts")
+    parser.add_argument("--models", nargs="*", default=[], help="model paths or builtin model names (e.g. mediapipe_face_short)")
+    parser.add_argument("--webui-dir", default=None, help="webui folder. run detection through inference() of the extension")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench.json", help="output JSON file")
+    parser.add_argument("--compare", default=None, help="baseline JSON file to compare with")
+    args = parser.parse_args(argv)
+
+    sizes = [tuple(int(x) for x in size.lower().split("x")) for size in args.sizes.split(",") if size]
+    counts = [int(n) for n in args.detections.split(",") if n]
+    inference = load_inference(args.webui_dir) if len(args.models) > 0 else None
+
+    results = []
+    for width, height in sizes:
+        for count in counts:
+            image, detections = synthetic_sample(width, height, count, args.seed)
+            cases = mask_benchmarks(image, detections)
+            if count == counts[0]:
+                # detection does not depend on the synthetic detection count
+                cases.update(inference_benchmarks(image, args.models, inference))
+
+            for name, func in cases.items():
+                stats = measure(func, args.iterations, args.warmup)
+                result = {"name": name, "size": f"{width}x{height}", "detections": count, **stats}
+                results.append(result)
+                print(f" {name:<40} {width:>5}x{height:<5} {count:>4}  p50 {stats['p50_ms']:>9.3f} ms  p95 {stats['p95_ms']:>9.3f} ms  alloc {stats['alloc_peak_kb']:>10.1f} KB")
+
+    meta = {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": np.__version__,
+        "cv2": cv2.__version__,
+        "seed": args.seed,
+        "inference": None if inference is None else "registry" if inference is _inference else "webui",
+    }
+    with open(args.output, "w") as f:
+        json.dump({"meta": meta, "results": results}, f, indent=2)
+    print(f" - results saved to {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,337 @@
+"""
+Export detection models to ONNX with a parity check
+
+usage: python -m scripts.detectors.export MODEL --images IMAGE [IMAGE ...]
+       python -m scripts.detectors.export MODEL --skip-parity
+
+MODEL is an ultralytics .pt model or a mmdet/mmyolo .pth checkpoint with its .py config.
+The path or the title in the model list ("yolo/face_yolov8n.pt [hash]", "face_yolov8n.pt") is accepted.
+The exported .onnx model and the class names .json are saved next to the original model
+and used by the onnxruntime detector backend.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+import numpy as np
+from PIL import Image
+
+
+def _model_title(path, models_dir):
+    """the same name as modeltitle() of the extension. e.g. "bbox/mmdet_anime-face_yolov3.pth", "yolo/face_yolov8n.pt" """
+    abspath = os.path.abspath(path)
+    mmdet_dir = os.path.join(models_dir, "mmdet")
+    if abspath.startswith(mmdet_dir):
+        name = os.path.relpath(abspath, mmdet_dir)
+    elif abspath.startswith(os.path.join(models_dir, "yolo")):
+        name = os.path.relpath(abspath, models_dir)
+    else:
+        name = os.path.basename(path)
+    return name.replace("\\", "/")
+
+
+def _short_hash(path):
+    """the same short sha256 as model_hash() of the extension"""
+    hash_sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            hash_sha256.update(chunk)
+    return hash_sha256.hexdigest()[0:8]
+
+
+def resolve_model(model, models_dir):
+    """path of the model given by a path or a title of the model list. None if not found"""
+    if os.path.exists(model):
+        return model
+
+    from scripts.mudd.model_index import ModelIndex
+
+    models_dir = os.path.abspath(models_dir)
+    index = ModelIndex(lambda path: _model_title(path, models_dir), _short_hash)
+    cache_path = os.path.join(models_dir, os.pardir, "cache", "uddetailer-hashes.json")
+    if os.path.exists(cache_path):
+        # reuse hashes of the webui. read only, old style hashes are not available here
+        index.cache_path = cache_path
+        index.load_cache()
+        index.cache_path = None
+
+    paths = []
+    for subdir, exts in (("mmdet", (".pth",)), ("yolo", (".pt",))):
+        for root, _, files in os.walk(os.path.join(models_dir, subdir)):
+            paths += [os.path.join(root, name) for name in sorted(files) if name.endswith(exts)]
+    index.refresh(paths)
+
+    entry = index.resolve(model)
+    return entry.path if entry is not None else None
+
+
+def _write_classes(model_path, classes):
+    """write class names .json used by the ultralytics/onnxruntime detectors"""
+    classes_path = model_path.rsplit(".", 1)[0] + ".json"
+    if classes is None or os.path.exists(classes_path):
+        return
+    with open(classes_path, "w") as f:
+        json.dump(list(classes), f)
+    print(f" - class names saved to {classes_path}")
+
+
+def _add_metadata(onnx_path, meta):
+    import onnx
+
+    model = onnx.load(onnx_path)
+    for key, value in meta.items():
+        prop = model.metadata_props.add()
+        prop.key = key
+        prop.value = value
+    onnx.save(model, onnx_path)
+
+
+def export_ultralytics(model_path, imgsz=640, opset=12, device="cpu"):
+    """export ultralytics model. return .onnx path"""
+    from ultralytics import YOLO
+
+    model = YOLO(model_path)
+    onnx_path = model.export(format="onnx", imgsz=imgsz, opset=opset, device=device, simplify=True)
+    if model.names is not None:
+        _write_classes(model_path, model.names.values())
+    return onnx_path
+
+
+def _mmdet_classes(model):
+    meta = getattr(model, "dataset_meta", None)
+    if meta is not None and "classes" in meta:
+        return meta["classes"]
+    return getattr(model, "CLASSES", None)
+
+
+def _mmdet_normalize(conf):
+    """get mean, std and to_rgb from mmdet 3.x data_preprocessor or mmdet 2.x img_norm_cfg"""
+    norm = conf.get("model", {}).get("data_preprocessor", None) or conf.get("img_norm_cfg", None) or {}
+    mean = norm.get("mean", [0, 0, 0])
+    std = norm.get("std", [1, 1, 1])
+    to_rgb = norm.get("bgr_to_rgb", norm.get("to_rgb", False))
+    return list(mean), list(std), to_rgb
+
+
+def export_mmdet(model_path, imgsz=640, opset=11, device="cpu"):
+    """export mmdet/mmyolo model using mmdeploy. return .onnx path"""
+    try:
+        from mmdeploy.apis import torch2onnx
+    except ImportError:
+        raise RuntimeError("mmdeploy is required to export mmdet models. try `pip install mmdeploy`")
+    from mmengine.config import Config
+
+    config_path = os.path.splitext(model_path)[0] + ".py"
+    if not os.path.exists(config_path):
+        raise RuntimeError(f"config {config_path} not found")
+
+    conf = Config.fromfile(config_path)
+    codebase = "mmyolo" if "yolov8" in config_path or conf.get("default_scope", "") == "mmyolo" else "mmdet"
+    if codebase == "mmyolo":
+        conf["default_scope"] = "mmyolo"
+    segm = "segm" in model_path
+
+    output_names = ["dets", "labels"] + (["masks"] if segm else [])
+    deploy_cfg = Config(dict(
+        onnx_config=dict(
+            type="onnx",
+            export_params=True,
+            keep_initializers_as_inputs=False,
+            opset_version=opset,
+            save_file=os.path.basename(model_path).rsplit(".", 1)[0] + ".onnx",
+            input_names=["input"],
+            output_names=output_names,
+            input_shape=[imgsz, imgsz],
+            optimize=True,
+        ),
+        codebase_config=dict(
+            type=codebase,
+            task="InstanceSegmentation" if segm else "ObjectDetection",
+            model_type="end2end",
+            post_processing=dict(
+                score_threshold=0.05,
+                confidence_threshold=0.005,
+                iou_threshold=0.5,
+                max_output_boxes_per_class=200,
+                pre_top_k=5000,
+                keep_top_k=100,
+                background_label_id=-1,
+                export_postprocess_mask=True,
+            ),
+        ),
+        backend_config=dict(type="onnxruntime"),
+    ))
+
+    sample = np.zeros((imgsz, imgsz, 3), dtype=np.uint8)
+    work_dir = os.path.dirname(os.path.abspath(model_path))
+    onnx_path = os.path.join(work_dir, deploy_cfg.onnx_config.save_file)
+    torch2onnx(sample, work_dir, deploy_cfg.onnx_config.save_file, deploy_cfg, conf, model_path, device)
+
+    mean, std, to_rgb = _mmdet_normalize(conf)
+    _add_metadata(onnx_path, {
+        "mudd_format": "mmdeploy",
+        "mudd_mean": json.dumps(mean),
+        "mudd_std": json.dumps(std),
+        "mudd_to_rgb": "1" if to_rgb else "0",
+    })
+
+    # class names
+    import torch
+
+    checkpoint = torch.load(model_path, map_location="cpu")
+    meta = checkpoint.get("meta", {})
+    classes = meta.get("dataset_meta", {}).get("classes", None) or meta.get("CLASSES", None)
+    _write_classes(model_path, classes)
+    return onnx_path
+
+
+def _reference_ultralytics(model_path, images, conf_thres, device="cpu"):
+    from scripts.detectors.ultralytics import ultralytics_inference_batch
+
+    return ultralytics_inference_batch(images, model_path, conf_thres, "A", device=device)
+
+
+def _reference_mmdet(model_path, images, conf_thres, device="cpu"):
+    from mmdet.apis import init_detector, inference_detector
+    from mmengine.config import Config
+
+    config_path = os.path.splitext(model_path)[0] + ".py"
+    conf = Config.fromfile(config_path)
+    if "yolov8" in config_path:
+        conf["default_scope"] = "mmyolo"
+    model = init_detector(conf, model_path, device=device)
+    # class names as the onnxruntime backend reads them from the .json
+    names = _mmdet_classes(model) or []
+
+    results = []
+    for image in images:
+        result = inference_detector(model, np.array(image)[:, :, ::-1])
+        pred = result.pred_instances
+        keep = pred.scores.cpu().numpy() >= conf_thres
+        bboxes = pred.bboxes.cpu().numpy()[keep]
+        labels = [f"A-{names[c] if c < len(names) else c}" for c in pred.labels.cpu().numpy()[keep]]
+        segms = list(pred.masks.cpu().numpy()[keep]) if "masks" in pred else []
+        results.append([labels, list(bboxes), segms, list(pred.scores.cpu().numpy()[keep])])
+    return results
+
+
+def _bbox_iou(a, b):
+    x1, y1 = max(a[0], b[0]), max(a[1], b[1])
+    x2, y2 = min(a[2], b[2]), min(a[3], b[3])
+    inter = max(x2 - x1, 0) * max(y2 - y1, 0)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+def _mask_iou(a, b):
+    union = np.logical_or(a, b).sum()
+    return np.logical_and(a, b).sum() / union if union > 0 else 1.0
+
+
+def parity_check(reference, exported, bbox_iou_thres=0.9, mask_iou_thres=0.8, score_delta=0.05):
+    """compare detection results. return True if all reference detections are matched
+    and at least one detection is compared"""
+    passed = True
+    bbox_ious = []
+    mask_ious = []
+    score_deltas = []
+    for n, (ref, out) in enumerate(zip(reference, exported)):
+        if len(ref[1]) != len(out[1]):
+            print(f" - image {n}: detection count mismatch {len(ref[1])} != {len(out[1])}")
+            passed = False
+
+        used = set()
+        for i, bbox in enumerate(ref[1]):
+            ious = [(_bbox_iou(bbox, other), j) for j, other in enumerate(out[1]) if j not in used]
+            if len(ious) == 0:
+                passed = False
+                break
+            iou, j = max(ious)
+            used.add(j)
+            bbox_ious.append(iou)
+            if iou < bbox_iou_thres:
+                print(f" - image {n}: bbox #{i} IoU {iou:.3f} < {bbox_iou_thres}")
+                passed = False
+
+            if ref[0][i] != out[0][j]:
+                print(f" - image {n}: label #{i} mismatch {ref[0][i]} != {out[0][j]}")
+                passed = False
+
+            delta = abs(float(ref[3][i]) - float(out[3][j]))
+            score_deltas.append(delta)
+            if delta > score_delta:
+                print(f" - image {n}: score #{i} delta {delta:.3f} > {score_delta}")
+                passed = False
+
+            if len(ref[2]) > i and len(out[2]) > j:
+                miou = _mask_iou(ref[2][i], out[2][j])
+                mask_ious.append(miou)
+                if miou < mask_iou_thres:
+                    print(f" - image {n}: mask #{i} IoU {miou:.3f} < {mask_iou_thres}")
+                    passed = False
+
+    if len(bbox_ious) == 0:
+        print(" - no detections to compare. use --images with sample images containing the target objects")
+        return False
+
+    print(f" - bbox IoU mean {np.mean(bbox_ious):.4f}, min {np.min(bbox_ious):.4f}")
+    print(f" - score delta mean {np.mean(score_deltas):.4f}, max {np.max(score_deltas):.4f}")
+    if len(mask_ious) > 0:
+        print(f" - mask IoU mean {np.mean(mask_ious):.4f}, min {np.min(mask_ious):.4f}")
+    return passed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="export detection models to ONNX")
+    parser.add_argument("model", help="ultralytics .pt or mmdet/mmyolo .pth model path or title in the model list")
+    parser.add_argument("--models-dir", default=os.path.join("..", "..", "models"), help="webui models folder used to find the model by title")
+    parser.add_argument("--imgsz", type=int, default=640, help="input image size")
+    parser.add_argument("--opset", type=int, default=12, help="ONNX opset version")
+    parser.add_argument("--device", default="cpu", help="device used for export and reference inference")
+    parser.add_argument("--images", nargs="*", default=[], help="sample images for the parity check")
+    parser.add_argument("--conf", type=float, default=0.3, help="confidence threshold for the parity check")
+    parser.add_argument("--bbox-iou", type=float, default=0.9, help="minimum bbox IoU")
+    parser.add_argument("--mask-iou", type=float, default=0.8, help="minimum mask IoU")
+    parser.add_argument("--score-delta", type=float, default=0.05, help="maximum score difference")
+    parser.add_argument("--skip-parity", action="store_true", help="skip the parity check")
+    args = parser.parse_args(argv)
+    if not args.skip_parity and len(args.images) == 0:
+        parser.error("--images is required for the parity check. use --skip-parity to export only")
+
+    model_path = resolve_model(args.model, args.models_dir)
+    if model_path is None:
+        print(f"{args.model} not found")
+        return 1
+
+    ultralytics = model_path.endswith(".pt")
+    if ultralytics:
+        onnx_path = export_ultralytics(model_path, args.imgsz, args.opset, args.device)
+    else:
+        onnx_path = export_mmdet(model_path, args.imgsz, args.opset, args.device)
+    print(f" - exported to {onnx_path}")
+
+    if args.skip_parity:
+        return 0
+
+    from scripts.detectors.onnx_runtime import onnx_inference_batch
+
+    images = [Image.open(path).convert("RGB") for path in args.images]
+
+    if ultralytics:
+        reference = _reference_ultralytics(model_path, images, args.conf, args.device)
+    else:
+        reference = _reference_mmdet(model_path, images, args.conf, args.device)
+    exported = onnx_inference_batch(images, onnx_path, args.conf, "A")
+
+    if parity_check(reference, exported, args.bbox_iou, args.mask_iou, args.score_delta):
+        print("\033[92mSUCCESS\033[0m - parity check passed")
+        return 0
+
+    print("\033[91mFAIL\033[0m - parity check failed")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,31 +3,37 @@ Simple upside down detection
 """
 import cv2
 import numpy as np
-import torch
+import threading
 
-#model = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_eye.xml')
-model = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_eye_tree_eyeglasses.xml')
+#_cascade_file = cv2.data.haarcascades + 'haarcascade_eye.xml'
+_cascade_file = cv2.data.haarcascades + 'haarcascade_eye_tree_eyeglasses.xml'
 
-def is_face_upside_down(image, bbox, use_cuda=True, verbose=False):
-    debug = True
-    verbose = True
+# cv2.CascadeClassifier is not thread-safe. use per-thread cascade
+_local = threading.local()
 
-    image = np.array(image)
-    x1, x2, y1, y2 = int(bbox[0]), int(bbox[2]), int(bbox[1]), int(bbox[3])
+# mediapipe facemesh landmark indices
+_LEFT_EYE = 33
+_RIGHT_EYE = 263
+_UPPER_LIP = 13
+_LOWER_LIP = 14
 
-    face = image[y1:y2, x1:x2].copy()
-    if debug:
-        from PIL import Image
-        im = Image.fromarray(face)
-        im.save("face.png")
 
-    # gray scale face
-    face = cv2.cvtColor(face, cv2.COLOR_BGR2GRAY)
+def get_cascade():
+    model = getattr(_local, "model", None)
+    if model is None:
+        model = cv2.CascadeClassifier(_cascade_file)
+        _local.model = model
+    return model
+
+
+def _is_upside_down(face, verbose=False):
+    model = get_cascade()
 
     # Detect eyes within the face region
     eyes = model.detectMultiScale(face)
     if len(eyes) < 1:
-        print("eyes = ", len(eyes))
+        if verbose:
+            print("eyes = ", len(eyes))
         # not detected eyes. in this case, the image is suspected to be upside down.
         return True
 
@@ -44,7 +50,8 @@ def is_face_upside_down(image, bbox, use_cuda=True, verbose=False):
 
     if len(flipped_eyes) < 1:
         # not detected eyes. in this case, the flipped image suspected to be upside down.
-        print("flipped eyes = ", len(flipped_eyes))
+        if verbose:
+            print("flipped eyes = ", len(flipped_eyes))
         return False
 
     flipped_eyes_ypos = [eye[1] for eye in flipped_eyes]
@@ -56,3 +63,62 @@ def is_face_upside_down(image, bbox, use_cuda=True, verbose=False):
     if sum(flipped_eyes_ypos) * 0.5 > sum(eyes_ypos) * 0.5:
         return False
     return True
+
+
+def _crop_gray(gray, bbox, size=128):
+    x1, x2, y1, y2 = int(bbox[0]), int(bbox[2]), int(bbox[1]), int(bbox[3])
+    x1, y1 = max(x1, 0), max(y1, 0)
+
+    face = gray[y1:y2, x1:x2]
+    if face.size == 0:
+        return None
+
+    # downscale face
+    h, w = face.shape[:2]
+    if size > 0 and max(w, h) > size:
+        scale = size / max(w, h)
+        face = cv2.resize(face, (max(int(w * scale), 1), max(int(h * scale), 1)), interpolation=cv2.INTER_AREA)
+    return face
+
+
+def is_upside_down_by_landmarks(points):
+    """check upside down face by facial landmarks. eyes should be above the mouth"""
+    if points is None or len(points) <= max(_LEFT_EYE, _RIGHT_EYE, _UPPER_LIP, _LOWER_LIP):
+        return None
+
+    eyes_y = (points[_LEFT_EYE][1] + points[_RIGHT_EYE][1]) * 0.5
+    mouth_y = (points[_UPPER_LIP][1] + points[_LOWER_LIP][1]) * 0.5
+    return bool(eyes_y > mouth_y)
+
+
+def faces_upside_down(image, bboxes, landmarks=None, size=128, verbose=False):
+    """check upside down faces of all bboxes at once"""
+    if len(bboxes) == 0:
+        return []
+
+    flipped = [None] * len(bboxes)
+    if landmarks is not None:
+        for j, points in enumerate(landmarks[:len(bboxes)]):
+            flipped[j] = is_upside_down_by_landmarks(points)
+        if all(x is not None for x in flipped):
+            return flipped
+
+    # gray scale image
+    gray = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2GRAY)
+    for j, bbox in enumerate(bboxes):
+        if flipped[j] is not None:
+            continue
+        face = _crop_gray(gray, bbox, size)
+        flipped[j] = _is_upside_down(face, verbose) if face is not None else False
+
+    return flipped
+
+
+def is_face_upside_down(image, bbox, use_cuda=True, verbose=False, debug=False):
+    image = np.array(image)
+    if debug:
+        from PIL import Image
+        x1, x2, y1, y2 = int(bbox[0]), int(bbox[2]), int(bbox[1]), int(bbox[3])
+        Image.fromarray(image[y1:y2, x1:x2]).save("face.png")
+
+    return faces_upside_down(image, [bbox], size=0, verbose=verbose)[0]
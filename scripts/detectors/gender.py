@@ -4,9 +4,11 @@ gender detection based on https://github.com/Sklyvan/Age-Gender-Prediction
 resnet-18-age-0.60-gender-93-f16.safetensors is a converted float16 model
 from https://github.com/Sklyvan/Age-Gender-Prediction/blob/main/Models/ResNet-18/ResNet-18%20Age%200.60%20%2B%20Gender%2093.pt
 """
+import copy
 import cv2
 import numpy as np
 import os
+import threading
 import torch
 import torch.nn as nn
 import torchvision.models as models
@@ -77,14 +79,33 @@ model.load_state_dict(state_dict)
 model.eval()
 model.to("cpu")
 
+# float16 copy on the GPU. kept resident while the gender fix is used, released by unload()
+_cuda_model = None
+_cuda_lock = threading.Lock()
 
-transform = transforms.Compose([transforms.ToTensor()])
 
+def get_cuda_model():
+    global _cuda_model
 
-def gender_info(image, bbox, use_cuda=True, verbose=False):
-    debug_gender = False
+    with _cuda_lock:
+        if _cuda_model is None:
+            # the shared fp32 model stays on CPU
+            _cuda_model = copy.deepcopy(model).half().to("cuda")
+        return _cuda_model
 
-    image = np.array(image)
+
+def unload():
+    """release the GPU copy of the model"""
+    global _cuda_model
+
+    with _cuda_lock:
+        _cuda_model = None
+
+
+transform = transforms.Compose([transforms.ToTensor()])
+
+
+def _crop_face(image, bbox):
     dw = bbox[2] - bbox[0]
     dh = bbox[3] - bbox[1]
     x1, x2, y1, y2 = int(bbox[0]), int(bbox[2]), int(bbox[1]), int(bbox[3])
@@ -107,37 +128,55 @@ def gender_info(image, bbox, use_cuda=True, verbose=False):
                 y1 = 0
 
     cropped = image[y1:y2, x1:x2]
-    cropped = cv2.resize(cropped, (200, 200))
+    return cv2.resize(cropped, (200, 200))
+
+
+def gender_info(image, bbox, use_cuda=None, verbose=False):
+    return gender_info_batch(image, [bbox], use_cuda, verbose)[0]
+
+
+def gender_info_batch(image, bboxes, use_cuda=None, verbose=False):
+    """get gender, age info of all faces at once"""
+    debug_gender = False
+
+    if len(bboxes) == 0:
+        return []
+
+    if use_cuda is None:
+        use_cuda = torch.cuda.is_available()
+
+    image = np.array(image)
+    cropped = [_crop_face(image, bbox) for bbox in bboxes]
     if debug_gender:
         from PIL import Image
-        im = Image.fromarray(cropped)
-        im.save("gender.png")
+        for j, face in enumerate(cropped):
+            Image.fromarray(face).save(f"gender-{j}.png")
 
     # extract gender info
-    image = transform(cropped).unsqueeze(0)
+    batch = torch.stack([transform(face) for face in cropped])
     if use_cuda:
-        image = image.to("cuda")
-        image = image.half()
-        model.half()
-        model.to("cuda")
+        net = get_cuda_model()
+        batch = batch.to("cuda").half()
     else:
-        image = image.float()
-        model.float()
+        net = model
+        batch = batch.float()
 
-    labels = model(image)[0]
+    with torch.no_grad():
+        outputs = net(batch).float().cpu()
 
-    age = torch.argmax(labels[:_classes])
-    gender = int(torch.argmax(labels[_classes:]))
-    gender = 'male' if gender == 0 else 'female'
+    infos = []
+    for labels in outputs:
+        age = int(torch.argmax(labels[:_classes]))
+        gender = int(torch.argmax(labels[_classes:]))
+        gender = 'male' if gender == 0 else 'female'
 
-    c1 = float(torch.max(labels[:_classes]))
-    c2 = float(torch.max(labels[_classes:]))
+        c1 = float(torch.max(labels[:_classes]))
+        c2 = float(torch.max(labels[_classes:]))
 
-    if verbose:
-        output = [round(float(x), 3) for x in labels]
-        print(gender, output)
+        if verbose:
+            output = [round(float(x), 3) for x in labels]
+            print(gender, output)
 
-    if use_cuda:
-        model.to("cpu")
+        infos.append((gender, _groups[age], [round(c1, 3), round(c2, 3)]))
 
-    return gender, _groups[age], [round(c1, 3), round(c2, 3)]
+    return infos
@@ -0,0 +1,247 @@
+"""
+Mask and detection result helpers
+
+These helpers do not depend on the webui.
+"""
+import cv2
+import json
+import math
+import os
+import numpy as np
+
+from PIL import Image
+
+
+def sort_results(results, orders):
+    if len(results[1]) <= 1 or orders is None or len(orders) == 0:
+        return results
+
+    bboxes = results[1]
+    items = len(bboxes)
+    order = range(items)
+
+    # get max size bbox
+    sortkey = lambda bbox: -(bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
+    tmpord = sorted(order, key=lambda i: sortkey(bboxes[i]))
+    # setup marginal variables ~0.2
+    bbox = bboxes[tmpord[0]]
+    area = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
+    marginarea = int(area * 0.2)
+    marginwidth = int(math.sqrt(area) * 0.2)
+
+    # sort by position (left to light)
+    if "position" in orders:
+        sortkey = lambda bbox: int(int((bbox[0] + (bbox[2] - bbox[0]) * 0.5)/marginwidth)*marginwidth)
+        order = sorted(order, key=lambda i: sortkey(bboxes[i]))
+
+    # sort by area
+    if "area" in orders:
+        sortkey = lambda bbox: -int(int((bbox[2] - bbox[0]) * (bbox[3] - bbox[1])/marginarea)*marginarea)
+        order = sorted(order, key=lambda i: sortkey(bboxes[i]))
+
+    # sort all results
+    results[1] = [bboxes[i] for i in order]
+    results[0] = [results[0][i] for i in order]
+    if len(results[2]) > 0:
+        results[2] = [results[2][i] for i in order]
+    results[3] = [results[3][i] for i in order]
+    if len(results) > 5:
+        # facial landmarks
+        results[5] = [results[5][i] for i in order]
+    return results
+
+
+def create_segmask_preview(results, image, selected=None, use_preview=False):
+    if use_preview and len(results) > 4 and results[4] is not None:
+        image = results[4]
+
+    labels = results[0]
+    bboxes = results[1]
+    segms = results[2]
+    scores = results[3]
+
+    cv2_image = np.array(image)
+    cv2_image = cv2_image[:, :, ::-1].copy()
+    gray = cv2.cvtColor(cv2_image, cv2.COLOR_BGR2GRAY)
+
+    # no segms? simply generate from bboxes
+    if len(segms) == 0:
+        segms = _create_segms(gray, bboxes)
+
+    if selected is None:
+        selected = []
+
+    for i in range(len(bboxes)):
+        color = np.full_like(cv2_image, np.random.randint(100, 256, (1, 3), dtype=np.uint8))
+        alpha = 0.2
+        if i in selected:
+            # selected masks change color to white and draw bbox rectangle on it
+            #color = np.full_like(cv2_image, np.array([[255, 255, 255]], dtype=np.uint8))
+            bbox = bboxes[i]
+            cv2.rectangle(cv2_image, (int(bbox[0]), int(bbox[1])), (int(bbox[2]), int(bbox[3])), (0, 255, 0), 3, cv2.LINE_AA)
+            alpha = 0.3
+        color_image = cv2.addWeighted(cv2_image, alpha, color, 1-alpha, 0)
+        cv2_mask = segms[i].astype(np.uint8) * 255
+        #cv2_mask_bool = np.array(segms[i], dtype=bool)
+        #centroid = np.mean(np.argwhere(cv2_mask_bool),axis=0)
+        centroid = np.mean(np.argwhere(segms[i]),axis=0)
+        centroid_x, centroid_y = int(centroid[1]), int(centroid[0])
+
+        cv2_mask_rgb = cv2.merge((cv2_mask, cv2_mask, cv2_mask))
+        cv2_image = np.where(cv2_mask_rgb == 255, color_image, cv2_image)
+        text_color = tuple([int(x) for x in ( color[0][0] - 100 )])
+        name = labels[i]
+        score = scores[i]
+
+        if score > 0.0:
+            score = str(score)[:4]
+            text = name + ' ' + score + f":{i+1}"
+        else:
+            text = name + f":{i+1}"
+        (w, h), _ = cv2.getTextSize(text, cv2.FONT_HERSHEY_DUPLEX, 0.4, 1)
+        cv2.putText(cv2_image, text, (centroid_x - int(w/2), centroid_y), cv2.FONT_HERSHEY_DUPLEX, 0.4, text_color, 1, cv2.LINE_AA)
+
+    if ( len(segms) > 0):
+        preview_image = Image.fromarray(cv2.cvtColor(cv2_image, cv2.COLOR_BGR2RGB))
+    else:
+        preview_image = image
+
+    return preview_image
+
+def is_allblack(mask):
+    cv2_mask = np.array(mask)
+    return cv2.countNonZero(cv2_mask) == 0
+
+def bitwise_and_masks(mask1, mask2):
+    cv2_mask1 = np.array(mask1)
+    cv2_mask2 = np.array(mask2)
+    cv2_mask = cv2.bitwise_and(cv2_mask1, cv2_mask2)
+    mask = Image.fromarray(cv2_mask)
+    return mask
+
+def subtract_masks(mask1, mask2):
+    cv2_mask1 = np.array(mask1)
+    cv2_mask2 = np.array(mask2)
+    cv2_mask = cv2.subtract(cv2_mask1, cv2_mask2)
+    mask = Image.fromarray(cv2_mask)
+    return mask
+
+def dilate_masks(masks, dilation_factor, iter=1):
+    if dilation_factor == 0:
+        return masks
+    dilated_masks = []
+    kernel = np.ones((dilation_factor,dilation_factor), np.uint8)
+    for i in range(len(masks)):
+        cv2_mask = np.array(masks[i])
+        dilated_mask = cv2.dilate(cv2_mask, kernel, iter)
+        dilated_masks.append(Image.fromarray(dilated_mask))
+    return dilated_masks
+
+def offset_masks(masks, offset_x, offset_y):
+    if (offset_x == 0 and offset_y == 0):
+        return masks
+    offset_masks = []
+    for i in range(len(masks)):
+        cv2_mask = np.array(masks[i])
+        offset_mask = cv2_mask.copy()
+        offset_mask = np.roll(offset_mask, -offset_y, axis=0)
+        offset_mask = np.roll(offset_mask, offset_x, axis=1)
+
+        offset_masks.append(Image.fromarray(offset_mask))
+    return offset_masks
+
+def combine_masks(masks):
+    initial_cv2_mask = np.array(masks[0])
+    combined_cv2_mask = initial_cv2_mask
+    for i in range(1, len(masks)):
+        cv2_mask = np.array(masks[i])
+        combined_cv2_mask = cv2.bitwise_or(combined_cv2_mask, cv2_mask)
+
+    combined_mask = Image.fromarray(combined_cv2_mask)
+    return combined_mask
+
+
+def _create_segms(gray, bboxes):
+    segms = []
+    for x0, y0, x1, y1 in bboxes:
+        # make black (blank) image
+        mask = np.zeros((gray.shape), np.uint8)
+        # draw white rectangle
+        cv2.rectangle(mask, (int(x0), int(y0)), (int(x1), int(y1)), 255, -1)
+        mask_bool = mask.astype(bool)
+        segms.append(mask_bool)
+
+    return segms
+
+
+def create_segmasks(gray_image, results):
+    bboxes = results[1]
+    segms = results[2]
+
+    if len(segms) == 0:
+        segms = _create_segms(gray_image, bboxes)
+
+    segmasks = []
+    for i in range(len(bboxes)):
+        mask = segms[i].astype(np.uint8) * 255
+        mask = Image.fromarray(mask)
+        segmasks.append(mask)
+
+    return segmasks
+
+
+def create_polyline_from_segms(segms):
+    polys = []
+    for i in range(len(segms)):
+        mask = segms[i].astype(np.uint8) * 255
+        #contours, _ = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        polygons = [np.array(polygon).squeeze().reshape(-1).tolist() for polygon in contours]
+        #polygons = [np.array(polygon).squeeze() for polygon in contours]
+        polys.append(polygons)
+    return polys
+
+
+def mask_to_rle(mask):
+    """encode a mask to the (row-major) run length encoding. counts start with the zero run"""
+    flat = np.asarray(mask, dtype=bool).reshape(-1)
+    h, w = np.asarray(mask).shape[:2]
+    if flat.size == 0:
+        return {"size": [h, w], "counts": []}
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    bounds = np.concatenate(([0], changes, [flat.size]))
+    counts = np.diff(bounds).tolist()
+    if flat[0]:
+        counts = [0] + counts
+    return {"size": [h, w], "counts": counts}
+
+
+def rle_to_mask(rle):
+    """decode the run length encoding to a boolean mask"""
+    h, w = rle["size"]
+    values = np.zeros(len(rle["counts"]), dtype=bool)
+    values[1::2] = True
+    return np.repeat(values, rle["counts"]).reshape(h, w)
+
+
+MASK_FORMATS = ("png1", "npz", "rle")
+
+
+def save_mask(mask, path, format="png1"):
+    """save a mask in a cheap format. png1: 1-bit PNG, npz: compressed numpy, rle: run length JSON.
+    path is given without the extension. return the saved path"""
+    if format not in MASK_FORMATS:
+        raise ValueError(f"unknown mask format {format}")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    if format == "npz":
+        np.savez_compressed(f"{path}.npz", mask=np.asarray(mask, dtype=bool))
+        return f"{path}.npz"
+    if format == "rle":
+        with open(f"{path}.json", "w", encoding="utf8") as f:
+            json.dump(mask_to_rle(mask), f, separators=(",", ":"))
+        return f"{path}.json"
+
+    image = mask if isinstance(mask, Image.Image) else Image.fromarray(np.asarray(mask, dtype=np.uint8) * 255)
+    image.convert("1").save(f"{path}.png", compress_level=1)
+    return f"{path}.png"
@@ -82,6 +82,7 @@ def mediapipe_detector_facemesh(image,
     masks = []
     scores = []
     bboxes = []
+    landmarks_list = []
     with mp_facemesh.FaceMesh(static_image_mode=True,
                               min_detection_confidence=confidence,
                               max_num_faces=max_num_faces,
@@ -127,6 +128,7 @@ def mediapipe_detector_facemesh(image,
 
             # prepare bbox, masks
             points = np.intp([(m.x * w, m.y * h) for m in landmarks.landmark])
+            landmarks_list.append(points)
 
             # create convex hull from facial mesh points
             hull = cv2.convexHull(points)
@@ -169,4 +171,4 @@ def mediapipe_detector_facemesh(image,
         results[3].append(scores[i])
 
     preview_image = Image.fromarray(cv2.cvtColor(preview, cv2.COLOR_BGR2RGB))
-    return results + [preview_image]
+    return results + [preview_image, landmarks_list]
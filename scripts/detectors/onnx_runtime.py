@@ -0,0 +1,283 @@
+"""
+ONNX Runtime inference for YOLO and mmdeploy exported detection/segmentation models
+"""
+import ast
+import cv2
+import json
+import numpy as np
+import os
+import threading
+
+from collections import OrderedDict
+
+from scripts.detectors.tiling import nms
+from scripts.mudd import metrics
+
+
+_sessions = OrderedDict()
+_sessions_lock = threading.Lock()
+MAX_SESSIONS = 2
+
+
+class OnnxModel:
+    """ONNX Runtime session with pre-allocated input buffers per thread"""
+
+    def __init__(self, model_path, intra_threads=0, inter_threads=0):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_threads > 0:
+            options.intra_op_num_threads = intra_threads
+        if inter_threads > 0:
+            options.inter_op_num_threads = inter_threads
+            options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+
+        self.session = ort.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+
+        inp = self.session.get_inputs()[0]
+        self.input_name = inp.name
+        self.output_names = [out.name for out in self.session.get_outputs()]
+        shape = inp.shape
+        # dynamic axes are given as strings or None
+        self.fixed_batch = shape[0] if isinstance(shape[0], int) and shape[0] > 0 else None
+        self.height = shape[2] if isinstance(shape[2], int) and shape[2] > 0 else 640
+        self.width = shape[3] if isinstance(shape[3], int) and shape[3] > 0 else 640
+        self.meta = self.session.get_modelmeta().custom_metadata_map
+        # "yolo": raw yolo outputs, "mmdeploy": end2end dets/labels/masks outputs (see export.py)
+        self.format = self.meta.get("mudd_format", "yolo")
+        self.mean = np.array(json.loads(self.meta.get("mudd_mean", "[0, 0, 0]")), dtype=np.float32)
+        self.std = np.array(json.loads(self.meta.get("mudd_std", "[255, 255, 255]")), dtype=np.float32)
+        self.to_rgb = self.meta.get("mudd_to_rgb", "1") == "1"
+        self.names = self._load_names(model_path)
+        # session.run() is thread-safe but the input buffer is not. A and B detections run in parallel
+        self._local = threading.local()
+
+    def _load_names(self, model_path):
+        # override class names
+        classes_path = model_path.rsplit(".", 1)[0] + ".json"
+        if os.path.exists(classes_path):
+            with open(classes_path) as f:
+                return json.load(f)
+
+        # ultralytics stores class names in the metadata
+        if "names" in self.meta:
+            try:
+                names = ast.literal_eval(self.meta["names"])
+                if isinstance(names, dict):
+                    return [names[k] for k in sorted(names)]
+                return list(names)
+            except (ValueError, SyntaxError):
+                pass
+        return None
+
+    def get_buffer(self, batch):
+        """get the pre-allocated input buffer of the current thread"""
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None or buffer.shape[0] < batch:
+            buffer = self._local.buffer = np.zeros((batch, 3, self.height, self.width), dtype=np.float32)
+        return buffer[:batch]
+
+    def preprocess(self, image, buf):
+        """letterbox the image into the given buffer. return ratio, padding, resized size and input size"""
+        img = np.asarray(image.convert("RGB"))
+        if not self.to_rgb:
+            img = img[:, :, ::-1]
+        h, w = img.shape[:2]
+        ratio = min(self.height / h, self.width / w)
+        nh, nw = max(int(round(h * ratio)), 1), max(int(round(w * ratio)), 1)
+        if self.format == "mmdeploy":
+            # mmdet pads to the bottom-right with zeros
+            pad_y, pad_x = 0, 0
+            buf.fill(0.0)
+        else:
+            pad_y, pad_x = (self.height - nh) // 2, (self.width - nw) // 2
+            buf.fill(114 / 255.0)
+
+        resized = cv2.resize(img, (nw, nh), interpolation=cv2.INTER_LINEAR).astype(np.float32)
+        resized -= self.mean
+        resized /= self.std
+        buf[:, pad_y:pad_y + nh, pad_x:pad_x + nw] = resized.transpose(2, 0, 1)
+        return ratio, (pad_x, pad_y), (nw, nh), (self.width, self.height)
+
+    def run(self, images):
+        """run the session. return a list of outputs and the letterbox info of each image"""
+        batch = self.fixed_batch or len(images)
+        outputs = []
+        letterbox = []
+        for i in range(0, len(images), batch):
+            chunk = images[i:i + batch]
+            buf = self.get_buffer(batch)
+            for j, image in enumerate(chunk):
+                letterbox.append(self.preprocess(image, buf[j]))
+            out = self.session.run(self.output_names, {self.input_name: buf})
+            for j in range(len(chunk)):
+                outputs.append([o[j] for o in out])
+        return outputs, letterbox
+
+
+def get_model(model_path, intra_threads=0, inter_threads=0):
+    """get a cached session"""
+    key = (model_path, os.path.getmtime(model_path), intra_threads, inter_threads)
+    with _sessions_lock:
+        if key in _sessions:
+            _sessions.move_to_end(key)
+            metrics.inc("mudd_model_cache_hits_total", cache="onnx")
+            return _sessions[key]
+
+        metrics.inc("mudd_model_cache_misses_total", cache="onnx")
+        model = OnnxModel(model_path, intra_threads, inter_threads)
+        _sessions[key] = model
+        while len(_sessions) > MAX_SESSIONS:
+            _sessions.popitem(last=False)
+            metrics.inc("mudd_model_cache_evictions_total", cache="onnx")
+        return model
+
+
+def clear_sessions():
+    _sessions.clear()
+
+
+def _decode_yolo(pred, num_masks, conf_thres):
+    """decode raw yolo output. return bboxes (xyxy), scores, class ids and mask coefficients"""
+    # yolov8: (4 + nc + nm, N), yolov5: (N, 5 + nc + nm)
+    if pred.shape[0] < pred.shape[1]:
+        pred = pred.T
+        boxes = pred[:, :4]
+        cls_scores = pred[:, 4:pred.shape[1] - num_masks]
+    else:
+        boxes = pred[:, :4]
+        cls_scores = pred[:, 5:pred.shape[1] - num_masks] * pred[:, 4:5]
+    coefs = pred[:, pred.shape[1] - num_masks:] if num_masks > 0 else None
+
+    cls_ids = cls_scores.argmax(axis=1)
+    scores = cls_scores[np.arange(len(cls_ids)), cls_ids]
+    keep = scores >= conf_thres
+    boxes, scores, cls_ids = boxes[keep], scores[keep], cls_ids[keep]
+    if coefs is not None:
+        coefs = coefs[keep]
+
+    # cxcywh to xyxy
+    bboxes = np.empty_like(boxes)
+    bboxes[:, 0] = boxes[:, 0] - boxes[:, 2] * 0.5
+    bboxes[:, 1] = boxes[:, 1] - boxes[:, 3] * 0.5
+    bboxes[:, 2] = boxes[:, 0] + boxes[:, 2] * 0.5
+    bboxes[:, 3] = boxes[:, 1] + boxes[:, 3] * 0.5
+    return bboxes, scores, cls_ids, coefs
+
+
+def _decode_mmdeploy(outputs, conf_thres):
+    """decode mmdeploy end2end outputs. return bboxes (xyxy), scores, class ids and masks"""
+    dets = outputs["dets"]
+    cls_ids = outputs["labels"].astype(np.intp)
+    masks = outputs.get("masks", None)
+
+    keep = dets[:, 4] >= conf_thres
+    if masks is not None:
+        masks = masks[keep]
+    return dets[keep, :4], dets[keep, 4], cls_ids[keep], masks
+
+
+def _paste_masks(masks, bboxes, letterbox, size):
+    """resize mmdeploy masks (input sized or RoI sized) into full size boolean masks"""
+    ratio, (pad_x, pad_y), (nw, nh), (in_w, in_h) = letterbox
+    w, h = size
+
+    segms = []
+    for mask, bbox in zip(masks, bboxes):
+        mask = mask.astype(np.float32)
+        bx1, by1 = max(int(bbox[0]), 0), max(int(bbox[1]), 0)
+        bx2, by2 = min(int(np.ceil(bbox[2])), w), min(int(np.ceil(bbox[3])), h)
+        segm = np.zeros((h, w), dtype=bool)
+        if mask.shape == (in_h, in_w):
+            mask = cv2.resize(mask[pad_y:pad_y + nh, pad_x:pad_x + nw], (w, h), interpolation=cv2.INTER_LINEAR) > 0.5
+            segm[by1:by2, bx1:bx2] = mask[by1:by2, bx1:bx2]
+        elif bx2 > bx1 and by2 > by1:
+            # RoI mask
+            segm[by1:by2, bx1:bx2] = cv2.resize(mask, (bx2 - bx1, by2 - by1), interpolation=cv2.INTER_LINEAR) > 0.5
+        segms.append(segm)
+    return segms
+
+
+def _decode_masks(protos, coefs, bboxes, letterbox, size):
+    """decode prototype masks into full size boolean masks"""
+    ratio, (pad_x, pad_y), (nw, nh), (in_w, in_h) = letterbox
+    w, h = size
+    nm, mh, mw = protos.shape
+
+    masks = 1.0 / (1.0 + np.exp(-(coefs @ protos.reshape(nm, -1))))
+    masks = masks.reshape(-1, mh, mw)
+
+    # crop the letterbox padding in the prototype scale
+    x1, y1 = int(pad_x * mw / in_w), int(pad_y * mh / in_h)
+    x2, y2 = int(round((pad_x + nw) * mw / in_w)), int(round((pad_y + nh) * mh / in_h))
+
+    segms = []
+    for mask, bbox in zip(masks, bboxes):
+        mask = cv2.resize(mask[y1:y2, x1:x2], (w, h), interpolation=cv2.INTER_LINEAR) > 0.5
+        # zero outside of the bbox
+        bx1, by1 = max(int(bbox[0]), 0), max(int(bbox[1]), 0)
+        bx2, by2 = min(int(np.ceil(bbox[2])), w), min(int(np.ceil(bbox[3])), h)
+        segm = np.zeros((h, w), dtype=bool)
+        segm[by1:by2, bx1:bx2] = mask[by1:by2, bx1:bx2]
+        segms.append(segm)
+    return segms
+
+
+def _get_results(output, image, letterbox, model, label, conf_thres, iou_thres, classes=None, exclude_classes=None, max_per_img=100):
+    protos = coefs = masks = None
+    if model.format == "mmdeploy":
+        bboxes, scores, cls_ids, masks = _decode_mmdeploy(dict(zip(model.output_names, output)), conf_thres)
+    else:
+        protos = output[1] if len(output) > 1 and output[1].ndim == 3 else None
+        num_masks = protos.shape[0] if protos is not None else 0
+        bboxes, scores, cls_ids, coefs = _decode_yolo(output[0], num_masks, conf_thres)
+
+    names = model.names or []
+    cls_names = [names[c] if c < len(names) else str(c) for c in cls_ids]
+
+    # select classes
+    keep = np.arange(len(cls_names), dtype=np.intp)
+    if classes is not None or exclude_classes is not None:
+        keep = [j for j, name in enumerate(cls_names)
+                    if (classes is None or name in classes) and (exclude_classes is None or name not in exclude_classes)]
+        keep = np.array(keep, dtype=np.intp)
+
+    if len(keep) == 0:
+        return [[], [], [], []]
+
+    if model.format == "mmdeploy":
+        # already suppressed by the exported model
+        keep = keep[:max_per_img]
+    else:
+        # class aware nms: offset bboxes by class
+        offset = cls_ids[keep, None].astype(np.float32) * 4096.0
+        keep = keep[nms(bboxes[keep] + offset, scores[keep], iou_thres=iou_thres)[:max_per_img]]
+
+    bboxes, scores = bboxes[keep], scores[keep]
+    cls_names = [cls_names[j] for j in keep]
+
+    # undo letterbox
+    ratio, (pad_x, pad_y) = letterbox[:2]
+    w, h = image.size
+    bboxes = (bboxes - np.array([pad_x, pad_y, pad_x, pad_y], dtype=np.float32)) / ratio
+    bboxes[:, 0::2] = np.clip(bboxes[:, 0::2], 0, w)
+    bboxes[:, 1::2] = np.clip(bboxes[:, 1::2], 0, h)
+
+    segms = []
+    if protos is not None:
+        segms = _decode_masks(protos, coefs[keep], bboxes, letterbox, (w, h))
+    elif masks is not None:
+        segms = _paste_masks(masks[keep], bboxes, letterbox, (w, h))
+
+    labels = [f"{label}-{name}" for name in cls_names]
+    return [labels, list(bboxes), segms, list(scores)]
+
+
+def onnx_inference_batch(images, model_path, conf_thres, label, classes=None, exclude_classes=None, max_per_img=100, iou_thres=0.7, intra_threads=0, inter_threads=0):
+    """run ONNX Runtime detection for a list of images"""
+    model = get_model(model_path, intra_threads, inter_threads)
+    outputs, letterbox = model.run(images)
+
+    return [_get_results(output, image, lb, model, label, conf_thres, iou_thres, classes, exclude_classes, max_per_img)
+            for output, image, lb in zip(outputs, images, letterbox)]
@@ -0,0 +1,177 @@
+"""
+Sliced (tiled) inference helper for large images. (SAHI-like)
+"""
+import numpy as np
+
+
+def make_tiles(width, height, tile_size=640, overlap=0.2):
+    """get overlapping tiles (x0, y0, x1, y1) covering the whole image"""
+    tile_size = max(int(tile_size), 32)
+    overlap = min(max(overlap, 0.0), 0.9)
+    stride = max(int(tile_size * (1.0 - overlap)), 1)
+
+    def starts(length):
+        if length <= tile_size:
+            return [0]
+        pos = list(range(0, length - tile_size, stride))
+        pos.append(length - tile_size)
+        return pos
+
+    tiles = []
+    for y0 in starts(height):
+        for x0 in starts(width):
+            tiles.append((x0, y0, min(x0 + tile_size, width), min(y0 + tile_size, height)))
+    return tiles
+
+
+def bbox_iou(bbox, bboxes):
+    """IoU of a bbox against an array of bboxes"""
+    bboxes = np.asarray(bboxes, dtype=np.float32).reshape(-1, 4)
+    x1 = np.maximum(bbox[0], bboxes[:, 0])
+    y1 = np.maximum(bbox[1], bboxes[:, 1])
+    x2 = np.minimum(bbox[2], bboxes[:, 2])
+    y2 = np.minimum(bbox[3], bboxes[:, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
+    areas = (bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1])
+    return inter / np.maximum(area + areas - inter, 1e-6)
+
+
+def bbox_ios(bbox, bboxes):
+    """intersection over the smaller area of a bbox against an array of bboxes"""
+    bboxes = np.asarray(bboxes, dtype=np.float32).reshape(-1, 4)
+    x1 = np.maximum(bbox[0], bboxes[:, 0])
+    y1 = np.maximum(bbox[1], bboxes[:, 1])
+    x2 = np.minimum(bbox[2], bboxes[:, 2])
+    y2 = np.minimum(bbox[3], bboxes[:, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
+    areas = (bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1])
+    return inter / np.maximum(np.minimum(area, areas), 1e-6)
+
+
+def nms(bboxes, scores, labels=None, iou_thres=0.5):
+    """class aware non-maximum suppression. return kept indices"""
+    return list(greedy_nmm(bboxes, scores, labels, iou_thres, metric="iou"))
+
+
+def greedy_nmm(bboxes, scores, labels=None, iou_thres=0.5, metric="iou"):
+    """class aware greedy non-maximum merging. return {kept index: [merged indices]}
+
+    metric="ios" (intersection over smaller) also matches partial bboxes cut off at tile edges
+    with the whole bbox of the same object (SAHI's GREEDYNMM style)
+    """
+    if len(bboxes) == 0:
+        return {}
+
+    overlap = bbox_ios if metric == "ios" else bbox_iou
+    bboxes = np.asarray(bboxes, dtype=np.float32).reshape(-1, 4)
+    scores = np.asarray(scores, dtype=np.float32)
+    areas = (bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1])
+    # some models have no scores. prefer larger bboxes in this case
+    order = np.lexsort((-areas, -scores))
+
+    suppressed = np.zeros(len(bboxes), dtype=bool)
+    keep = {}
+    for n, i in enumerate(order):
+        if suppressed[i]:
+            continue
+        keep[int(i)] = []
+        rest = order[n + 1:]
+        rest = rest[~suppressed[rest]]
+        if labels is not None:
+            rest = np.array([j for j in rest if labels[j] == labels[i]], dtype=np.intp)
+        if len(rest) == 0:
+            continue
+        matched = rest[overlap(bboxes[i], bboxes[rest]) > iou_thres]
+        suppressed[matched] = True
+        keep[int(i)] = [int(j) for j in matched]
+
+    return keep
+
+
+def merge_results(tile_results, tiles, size, iou_thres=0.5, max_per_img=100):
+    """merge tile results into the full image coordinates and merge duplicates
+
+    duplicates of an object are matched by intersection over the smaller bbox, and merged into
+    the union bbox with the highest score. masks are kept tile local until the merge.
+    previews of tiles are dropped. landmarks are moved to the full image coordinates.
+    """
+    w, h = size
+    labels = []
+    bboxes = []
+    segms = []  # (tile local mask or None, offset)
+    scores = []
+    landmarks = []
+    has_segms = any(len(results[2]) > 0 for results in tile_results)
+    has_landmarks = any(len(results) > 5 and results[5] is not None for results in tile_results)
+
+    for results, (x0, y0, x1, y1) in zip(tile_results, tiles):
+        for i in range(len(results[1])):
+            bbox = np.array(results[1][i][:4], dtype=np.float32)
+            bbox += np.array([x0, y0, x0, y0], dtype=np.float32)
+            bbox[0::2] = np.clip(bbox[0::2], 0, w)
+            bbox[1::2] = np.clip(bbox[1::2], 0, h)
+
+            labels.append(results[0][i])
+            bboxes.append(bbox)
+            scores.append(results[3][i])
+            segms.append((results[2][i] if len(results[2]) > i else None, (x0, y0)))
+
+            points = None
+            if len(results) > 5 and results[5] is not None and len(results[5]) > i:
+                points = np.asarray(results[5][i]) + np.array([x0, y0])
+            landmarks.append(points)
+
+    keep = greedy_nmm(bboxes, scores, labels, iou_thres, metric="ios")
+    keep = list(keep.items())[:max_per_img]
+
+    def paste(mask, i):
+        segm, (x0, y0) = segms[i]
+        if segm is None:
+            bbox = bboxes[i]
+            mask[int(bbox[1]):int(bbox[3]), int(bbox[0]):int(bbox[2])] = True
+            return
+        segm = np.asarray(segm, dtype=bool)[:h - y0, :w - x0]
+        mask[y0:y0 + segm.shape[0], x0:x0 + segm.shape[1]] |= segm
+
+    merged = [[], [], [], []]
+    merged_landmarks = []
+    for i, matched in keep:
+        bbox = bboxes[i].copy()
+        for j in matched:
+            bbox[:2] = np.minimum(bbox[:2], bboxes[j][:2])
+            bbox[2:] = np.maximum(bbox[2:], bboxes[j][2:])
+
+        merged[0].append(labels[i])
+        merged[1].append(bbox)
+        if has_segms:
+            # only masks of the kept detections are allocated in the full size
+            mask = np.zeros((h, w), dtype=bool)
+            for j in [i, *matched]:
+                paste(mask, j)
+            merged[2].append(mask)
+        merged[3].append(scores[i])
+        merged_landmarks.append(next((landmarks[j] for j in [i, *matched] if landmarks[j] is not None), None))
+
+    if has_landmarks:
+        merged += [None, merged_landmarks]
+    return merged
+
+
+def sliced_inference(image, detect_batch, tile_size=640, overlap=0.2, iou_thres=0.5, full_frame=True, max_per_img=100):
+    """
+    run detection on overlapping tiles of the image
+
+    detect_batch(images) should return a list of [labels, bboxes, segms, scores] results.
+    The full frame is detected together with the tiles to keep large objects.
+    """
+    w, h = image.size
+    tiles = make_tiles(w, h, tile_size, overlap)
+    if full_frame and len(tiles) > 1:
+        tiles.append((0, 0, w, h))
+
+    crops = [image.crop(tile) for tile in tiles]
+    tile_results = detect_batch(crops)
+
+    return merge_results(tile_results, tiles, (w, h), iou_thres, max_per_img)
@@ -7,15 +7,26 @@ import numpy as np
 import torch
 import os
 
-from modules import safe
 from PIL import Image
 
+try:
+    from modules import safe
+except ImportError:
+    # standalone usage without the webui
+    safe = None
+
 def ultralytics_inference(image, model_path, conf_thres, label, classes=None, exclude_classes=None, max_per_img=100, device="cpu"):
+    return ultralytics_inference_batch([image], model_path, conf_thres, label, classes, exclude_classes, max_per_img, device)[0]
+
+
+def ultralytics_inference_batch(images, model_path, conf_thres, label, classes=None, exclude_classes=None, max_per_img=100, device="cpu"):
+    """run detection for a list of images at once"""
     from ultralytics import YOLO
 
     safe_torch_load = torch.load
     try:
-        torch.load = safe.unsafe_torch_load
+        if safe is not None:
+            torch.load = safe.unsafe_torch_load
         model = YOLO(model_path)
     finally:
         torch.load = safe_torch_load
@@ -38,8 +49,12 @@ def ultralytics_inference(image, model_path, conf_thres, label, classes=None, ex
         else:
             classes = [_classes.index(cls) for cls in classes if cls in _classes]
 
-    result = model(image, conf=conf_thres, device=device, max_det=max_per_img, classes=classes)[0]
+    results = model(images, conf=conf_thres, device=device, max_det=max_per_img, classes=classes)
+
+    return [_get_results(result, image, label, _classes, exclude_classes) for result, image in zip(results, images)]
+
 
+def _get_results(result, image, label, _classes=None, exclude_classes=None):
     bboxes = None
     scores = None
     labels = None
@@ -0,0 +1,289 @@
+"""
+Validated detailer arguments
+
+    args = DetailerArgs.from_args(*script_args)    # positional UI args
+    args = DetailerArgs.from_dict(api_args)        # API args {"enabled": True, "model a": ...}
+    args.dd_model_a, args.select_masks_a
+
+Arguments are normalized and validated once per job and shared by all images.
+Invalid arguments raise ValueError.
+"""
+from dataclasses import dataclass, field
+
+
+def parse_select_masks(line, default_lab="A"):
+    """
+    Parse selected masks line
+
+    A:1,B:2-4,A:3-7 => A:[1,3,4,5,6,7] B:[2,3,4]
+    """
+    tmp = [x.strip() for x in line.strip().split(",")]
+
+    parts = {"A": [], "B": []}
+    for x in tmp:
+        if ":" in x:
+            lab, num = x.rsplit(":", 1)
+        else:
+            lab = default_lab
+            num = x
+
+        if '-' in num:
+            nums = [
+                int(x.strip()) for x in num.split("-") if x.strip().isdigit()
+            ]
+            if len(nums) == 2:
+                nums = list(range(nums[0], nums[1] + 1))
+            else:
+                continue
+        elif num != '':
+            nums = [int(num)]
+        else:
+            continue
+
+        if lab.startswith("B"):
+            parts["B"] = parts["B"] + nums
+        elif lab.startswith("A"):
+            parts["A"] = parts["A"] + nums
+        else:
+            continue
+
+    parts["A"] = list(set(parts["A"]))
+    parts["B"] = list(set(parts["B"]))
+    return parts
+
+
+DETECT_ORDERS = ("area", "position")
+BITWISE_OPS = ("None", "A&B", "A-B")
+PREPROCESS_B = ("before", "none")
+
+# field -> (API key, default)
+API_KEYS = {
+    "enabled": ("enabled", False),
+    "use_prompt_edit": ("use prompt edit", False),
+    "use_prompt_edit_2": ("use prompt edit b", False),
+    "dd_model_a": ("model a", "None"),
+    "dd_classes_a": ("classes a", []),
+    "dd_conf_a": ("conf a", 30),
+    "dd_max_per_img_a": ("max detection a", 0),
+    "dd_detect_order_a": ("detect order a", []),
+    "dd_select_masks_a": ("select masks a", ""),
+    "dd_dilation_factor_a": ("dilation a", 4),
+    "dd_offset_x_a": ("offset x a", 0),
+    "dd_offset_y_a": ("offset y a", 0),
+    "dd_prompt": ("prompt", ""),
+    "dd_neg_prompt": ("negative prompt", ""),
+    "dd_preprocess_b": ("preprocess b", "none"),
+    "dd_bitwise_op": ("bitwise", "None"),
+    "dd_model_b": ("model b", "None"),
+    "dd_classes_b": ("classes b", []),
+    "dd_conf_b": ("conf b", 30),
+    "dd_max_per_img_b": ("max detection b", 0),
+    "dd_detect_order_b": ("detect order b", []),
+    "dd_select_masks_b": ("select masks b", ""),
+    "dd_dilation_factor_b": ("dilation b", 4),
+    "dd_offset_x_b": ("offset x b", 0),
+    "dd_offset_y_b": ("offset y b", 0),
+    "dd_prompt_2": ("prompt b", ""),
+    "dd_neg_prompt_2": ("negative prompt b", ""),
+    "dd_mask_blur": ("mask blur", 4),
+    "dd_denoising_strength": ("denoising strength", 0.4),
+    "dd_inpaint_full_res": ("inpaint full", True),
+    "dd_inpaint_full_res_padding": ("inpaint full padding", 32),
+    "dd_inpaint_width": ("inpaint width", 0),
+    "dd_inpaint_height": ("inpaint height", 0),
+    "dd_cfg_scale": ("CFG scale", 0),
+    "dd_steps": ("steps", 0),
+    "dd_noise_multiplier": ("noise multiplier", 0),
+    "dd_sampler": ("sampler", "None"),
+    "dd_scheduler": ("scheduler", "None"),
+    "dd_checkpoint": ("checkpoint", "None"),
+    "dd_vae": ("VAE", "None"),
+    "dd_clipskip": ("CLIP skip", 0),
+    "dd_states": ("options", {}),
+}
+
+
+def _classes(value, name):
+    if value is None or value == "None":
+        return None
+    if isinstance(value, str):
+        value = value.strip()
+        if value.startswith("NOT") and value.find(" ") > 0:
+            # "NOT face, hand" => NOT,face,hand
+            value = ",".join(value.split(" ", 1))
+        return tuple(x.strip() for x in value.split(",") if x.strip() != "")
+    if isinstance(value, (list, tuple)):
+        return tuple(str(x) for x in value)
+    raise ValueError(f"{name}: list of class names expected, got {type(value).__name__}")
+
+
+def _detect_order(value, name):
+    if value is None or value == "None":
+        return ()
+    if isinstance(value, str):
+        value = [x.strip() for x in value.split(",") if x.strip() != ""]
+    if not isinstance(value, (list, tuple)):
+        raise ValueError(f"{name}: list of {DETECT_ORDERS} expected, got {type(value).__name__}")
+    invalid = [x for x in value if x not in DETECT_ORDERS]
+    if len(invalid) > 0:
+        raise ValueError(f"{name}: invalid detect order {invalid}, valid orders are {DETECT_ORDERS}")
+    return tuple(dict.fromkeys(value))
+
+
+def _select_masks(value, lab, name):
+    """0-based indices of the selected detections or None"""
+    if not isinstance(value, str):
+        raise ValueError(f"{name}: string expected e.g. '1,2,3-5', got {type(value).__name__}")
+    try:
+        selected = parse_select_masks(value, lab)[lab]
+    except ValueError as e:
+        raise ValueError(f"{name}: invalid detection numbers {value!r}") from e
+    # 0 could be acceptable.
+    selected = tuple(x - 1 for x in selected if x >= 0)
+    return selected if len(selected) > 0 else None
+
+
+def _number(value, name, cast=int, minimum=None, maximum=None):
+    if isinstance(value, bool) or value is None:
+        raise ValueError(f"{name}: number expected, got {value!r}")
+    try:
+        number = cast(float(value)) if cast is int else cast(value)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"{name}: number expected, got {value!r}") from e
+    if (minimum is not None and number < minimum) or (maximum is not None and number > maximum):
+        raise ValueError(f"{name}: {number} is out of range [{minimum}, {maximum}]")
+    return number
+
+
+def _choice(value, name, choices):
+    if value not in choices:
+        raise ValueError(f"{name}: {value!r} is not one of {choices}")
+    return value
+
+
+def _string(value, name):
+    if value is None:
+        return ""
+    if not isinstance(value, str):
+        raise ValueError(f"{name}: string expected, got {type(value).__name__}")
+    return value
+
+
+@dataclass(frozen=True, slots=True)
+class DetailerArgs:
+    enabled: bool
+    use_prompt_edit: bool
+    use_prompt_edit_2: bool
+    dd_model_a: str
+    dd_classes_a: tuple
+    dd_conf_a: float
+    dd_max_per_img_a: int
+    dd_detect_order_a: tuple
+    dd_select_masks_a: str
+    dd_dilation_factor_a: int
+    dd_offset_x_a: int
+    dd_offset_y_a: int
+    dd_prompt: str
+    dd_neg_prompt: str
+    dd_preprocess_b: str
+    dd_bitwise_op: str
+    dd_model_b: str
+    dd_classes_b: tuple
+    dd_conf_b: float
+    dd_max_per_img_b: int
+    dd_detect_order_b: tuple
+    dd_select_masks_b: str
+    dd_dilation_factor_b: int
+    dd_offset_x_b: int
+    dd_offset_y_b: int
+    dd_prompt_2: str
+    dd_neg_prompt_2: str
+    dd_mask_blur: int
+    dd_denoising_strength: float
+    dd_inpaint_full_res: bool
+    dd_inpaint_full_res_padding: int
+    dd_inpaint_width: int
+    dd_inpaint_height: int
+    dd_cfg_scale: float
+    dd_steps: int
+    dd_noise_multiplier: float
+    dd_sampler: str
+    dd_scheduler: str
+    dd_checkpoint: str
+    dd_vae: str
+    dd_clipskip: int
+    dd_states: dict
+    # parsed dd_select_masks_*. 0-based indices or None
+    select_masks_a: tuple = field(init=False)
+    select_masks_b: tuple = field(init=False)
+
+    def __post_init__(self):
+        def norm(name, value):
+            object.__setattr__(self, name, value)
+
+        for name in ("enabled", "use_prompt_edit", "use_prompt_edit_2", "dd_inpaint_full_res"):
+            norm(name, bool(getattr(self, name)))
+
+        for name in ("dd_model_a", "dd_model_b", "dd_sampler", "dd_scheduler", "dd_checkpoint", "dd_vae"):
+            value = getattr(self, name)
+            norm(name, "None" if value is None else _string(value, name))
+        for name in ("dd_prompt", "dd_neg_prompt", "dd_prompt_2", "dd_neg_prompt_2"):
+            norm(name, _string(getattr(self, name), name))
+
+        preprocess_b = self.dd_preprocess_b
+        if isinstance(preprocess_b, bool) or preprocess_b in ["True", "False"]:
+            # old "preprocess b" option
+            preprocess_b = "before" if preprocess_b in [True, "True"] else "none"
+        norm("dd_preprocess_b", _choice(preprocess_b, "dd_preprocess_b", PREPROCESS_B))
+        norm("dd_bitwise_op", _choice(self.dd_bitwise_op or "None", "dd_bitwise_op", BITWISE_OPS))
+
+        for lab in ("a", "b"):
+            norm(f"dd_classes_{lab}", _classes(getattr(self, f"dd_classes_{lab}"), f"dd_classes_{lab}"))
+            norm(f"dd_detect_order_{lab}", _detect_order(getattr(self, f"dd_detect_order_{lab}"), f"dd_detect_order_{lab}"))
+            norm(f"dd_conf_{lab}", _number(getattr(self, f"dd_conf_{lab}"), f"dd_conf_{lab}", float, 0, 100))
+            norm(f"dd_max_per_img_{lab}", _number(getattr(self, f"dd_max_per_img_{lab}"), f"dd_max_per_img_{lab}", int, 0))
+            norm(f"dd_dilation_factor_{lab}", _number(getattr(self, f"dd_dilation_factor_{lab}"), f"dd_dilation_factor_{lab}", int, 0))
+            norm(f"dd_offset_x_{lab}", _number(getattr(self, f"dd_offset_x_{lab}"), f"dd_offset_x_{lab}"))
+            norm(f"dd_offset_y_{lab}", _number(getattr(self, f"dd_offset_y_{lab}"), f"dd_offset_y_{lab}"))
+
+            select_masks = _string(getattr(self, f"dd_select_masks_{lab}"), f"dd_select_masks_{lab}")
+            norm(f"dd_select_masks_{lab}", select_masks)
+            norm(f"select_masks_{lab}", _select_masks(select_masks, lab.upper(), f"dd_select_masks_{lab}"))
+
+        norm("dd_mask_blur", _number(self.dd_mask_blur, "dd_mask_blur", int, 0))
+        norm("dd_denoising_strength", _number(self.dd_denoising_strength, "dd_denoising_strength", float, 0, 1))
+        norm("dd_inpaint_full_res_padding", _number(self.dd_inpaint_full_res_padding, "dd_inpaint_full_res_padding", int, 0))
+        norm("dd_inpaint_width", _number(self.dd_inpaint_width, "dd_inpaint_width", int, 0))
+        norm("dd_inpaint_height", _number(self.dd_inpaint_height, "dd_inpaint_height", int, 0))
+        norm("dd_cfg_scale", _number(self.dd_cfg_scale, "dd_cfg_scale", float, 0))
+        norm("dd_steps", _number(self.dd_steps, "dd_steps", int, 0))
+        norm("dd_noise_multiplier", _number(self.dd_noise_multiplier, "dd_noise_multiplier", float, 0))
+        norm("dd_clipskip", _number(self.dd_clipskip, "dd_clipskip", int, 0))
+
+        states = self.dd_states if self.dd_states is not None else {}
+        if not isinstance(states, dict):
+            raise ValueError(f"dd_states: dict expected, got {type(states).__name__}")
+        norm("dd_states", states)
+
+    @classmethod
+    def from_args(cls, *args):
+        """from the positional script args. (enabled, use_prompt_edit, ..., dd_states)"""
+        if len(args) != len(API_KEYS):
+            raise ValueError(f"{len(API_KEYS)} arguments expected, got {len(args)}")
+        return cls(*args)
+
+    @classmethod
+    def from_dict(cls, args):
+        """from the API args {"enabled": True, "model a": "face_yolov8n.pt", ...}"""
+        if not isinstance(args, dict):
+            raise ValueError(f"dict expected, got {type(args).__name__}")
+        return cls(**{name: args.get(key, default) for name, (key, default) in API_KEYS.items()})
+
+    @classmethod
+    def parse(cls, args):
+        """from the script args of postprocess_image(). positional args or a single API dict"""
+        if len(args) == 1 and isinstance(args[0], cls):
+            return args[0]
+        if len(args) == 1 and isinstance(args[0], dict):
+            return cls.from_dict(args[0])
+        return cls.from_args(*args)
@@ -0,0 +1,186 @@
+"""
+Parallel, resumable model downloader with SHA-256 checks
+
+    items = [DownloadItem(url, os.path.join(path, filename), sha256=manifest.get(filename)), ...]
+    errors = download_all(items, max_workers=4, mirror="/mnt/models")
+
+Files are downloaded to "<dest>.part" and renamed atomically after the hash check.
+An interrupted download is resumed with an HTTP Range request.
+The expected SHA-256 is taken from the manifest or the X-Linked-Etag header of HuggingFace LFS files.
+A mirror could be a local directory or an URL prefix to replace the original host.
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class DownloadError(Exception):
+    pass
+
+
+class DownloadItem:
+    def __init__(self, url, dest, sha256=None):
+        self.url = url
+        self.dest = dest
+        self.sha256 = sha256.lower() if sha256 else None
+
+    @property
+    def filename(self):
+        return os.path.basename(self.dest)
+
+
+def load_manifest(path):
+    """load {filename: sha256} from a JSON file or a sha256sum style text file"""
+    if not path or not os.path.exists(path):
+        return {}
+
+    with open(path, encoding="utf8") as f:
+        text = f.read()
+    if path.endswith(".json"):
+        return {k: v.lower() for k, v in json.loads(text).items()}
+
+    manifest = {}
+    for line in text.splitlines():
+        m = re.match(r"^([0-9a-fA-F]{64})\s+\*?(.+)$", line.strip())
+        if m:
+            manifest[os.path.basename(m.group(2))] = m.group(1).lower()
+    return manifest
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def mirror_source(url, mirror):
+    """local file path or URL of the given url in the mirror. None if not found"""
+    if not mirror:
+        return url
+
+    path = urlparse(url).path.lstrip("/")
+    if mirror.startswith("http://") or mirror.startswith("https://"):
+        return f"{mirror.rstrip('/')}/{path}"
+
+    # local mirror directory with the same layout or a flat directory
+    for candidate in (os.path.join(mirror, *path.split("/")), os.path.join(mirror, os.path.basename(path))):
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def _linked_sha256(headers):
+    etag = (headers.get("X-Linked-Etag", None) or "").strip('"')
+    return etag.lower() if re.fullmatch(r"[0-9a-fA-F]{64}", etag) else None
+
+
+class _RedirectHandler(urllib.request.HTTPRedirectHandler):
+    """keep the X-Linked-Etag of the redirect response. HuggingFace redirects LFS files to the CDN"""
+    def __init__(self):
+        self.sha256 = None
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        self.sha256 = self.sha256 or _linked_sha256(headers)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+def _fetch(url, tmp, progress=None, timeout=30):
+    """download url to tmp. resume if tmp exists. return the expected sha256 given by the server if any"""
+    offset = os.path.getsize(tmp) if os.path.exists(tmp) else 0
+    request = urllib.request.Request(url, headers={"User-Agent": "uddetailer"})
+    if offset > 0:
+        request.add_header("Range", f"bytes={offset}-")
+
+    redirect = _RedirectHandler()
+    opener = urllib.request.build_opener(redirect)
+    try:
+        resp = opener.open(request, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        if e.code == 416 and offset > 0:
+            # already completed
+            return redirect.sha256 or _linked_sha256(e.headers)
+        raise
+
+    with resp:
+        if offset > 0 and resp.status != 206:
+            # range is not supported. restart
+            offset = 0
+        total = resp.headers.get("Content-Length", None)
+        total = int(total) + offset if total is not None else None
+
+        done = offset
+        with open(tmp, "ab" if offset > 0 else "wb") as f:
+            for chunk in iter(lambda: resp.read(CHUNK_SIZE), b""):
+                f.write(chunk)
+                done += len(chunk)
+                if progress is not None:
+                    progress(os.path.basename(tmp)[:-5], done, total)
+
+        if total is not None and done < total:
+            raise DownloadError(f"incomplete download {done}/{total} bytes")
+        return redirect.sha256 or _linked_sha256(resp.headers)
+
+
+def download_file(item, mirror=None, progress=None, timeout=30):
+    """download the item and return the destination path"""
+    if os.path.exists(item.dest):
+        return item.dest
+
+    source = mirror_source(item.url, mirror)
+    if source is None:
+        raise DownloadError(f"{item.filename} not found in the mirror {mirror}")
+
+    os.makedirs(os.path.dirname(item.dest), exist_ok=True)
+    tmp = f"{item.dest}.part"
+    print(f" - Downloading: {source} to {item.dest}")
+
+    expected = item.sha256
+    if os.path.isfile(source):
+        shutil.copyfile(source, tmp)
+    else:
+        linked = _fetch(source, tmp, progress, timeout)
+        expected = expected or linked
+
+    if expected is not None:
+        sha256 = file_sha256(tmp)
+        if sha256 != expected:
+            os.remove(tmp)
+            raise DownloadError(f"SHA-256 mismatched for {item.filename}: expected {expected}, got {sha256}")
+
+    os.replace(tmp, item.dest)
+    return item.dest
+
+
+def download_all(items, max_workers=4, mirror=None, progress=None, timeout=30):
+    """download items in parallel. return {dest: error} of failed items"""
+    errors = {}
+    lock = threading.Lock()
+
+    def run(item):
+        try:
+            download_file(item, mirror, progress, timeout)
+        except Exception as e:
+            print(f" - failed to download {item.filename} - {e}")
+            with lock:
+                errors[item.dest] = e
+
+    # the same destination is downloaded only once
+    items = list({item.dest: item for item in items if not os.path.exists(item.dest)}.values())
+    if len(items) == 0:
+        return errors
+
+    with ThreadPoolExecutor(max_workers=max(min(max_workers, len(items)), 1), thread_name_prefix="mudd-download") as pool:
+        list(pool.map(run, items))
+    return errors
@@ -0,0 +1,182 @@
+"""
+asyncio job queue with priorities and bounded concurrency
+
+    queue = JobQueue({"detect": (detect_handler, "cpu"), "detail": (detail_handler, "gpu")}, cpu_workers=2, max_jobs=32)
+    job = await queue.submit("detail", payload, priority=1)
+    queue.get(job.id).to_dict()
+    queue.cancel(job.id)
+
+handler(job) runs in a worker thread and appends results to job.results.
+CPU jobs run on cpu_workers threads, GPU jobs run one by one on a single thread.
+Higher priority jobs run first, and jobs of the same priority run in order of submission.
+"""
+import asyncio
+import itertools
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, kind, payload, priority=0):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.payload = payload
+        self.priority = priority
+        self.seq = 0
+        self.status = "queued"
+        self.results = []
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.cancel_requested = False
+        # called from cancel() when the job is running. e.g. interrupt the sampler
+        self.on_cancel = None
+
+    @property
+    def done(self):
+        return self.status in ["done", "failed", "cancelled"]
+
+    def check_cancelled(self):
+        """raise JobCancelled if cancel was requested. handlers call this between steps"""
+        if self.cancel_requested:
+            raise JobCancelled()
+
+    def to_dict(self, results=True):
+        data = {
+            "id": self.id,
+            "type": self.kind,
+            "priority": self.priority,
+            "status": self.status,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "progress": len(self.results),
+        }
+        if self.error is not None:
+            data["error"] = self.error
+        if results:
+            data["results"] = list(self.results)
+        return data
+
+
+class JobQueue:
+    def __init__(self, handlers, cpu_workers=2, max_jobs=32, keep_finished=300):
+        """handlers: {kind: (handler, "cpu" or "gpu")}"""
+        self.handlers = handlers
+        self.cpu_workers = max(int(cpu_workers), 1)
+        self.max_jobs = max(int(max_jobs), 1)
+        # seconds to keep finished jobs for polling
+        self.keep_finished = keep_finished
+
+        self.jobs = {}
+        self._counter = itertools.count()
+        self._queues = None
+        self._executors = None
+        self._tasks = []
+
+    def _start(self):
+        if self._queues is not None:
+            return
+
+        self._queues = {"cpu": asyncio.PriorityQueue(), "gpu": asyncio.PriorityQueue()}
+        self._executors = {
+            "cpu": ThreadPoolExecutor(max_workers=self.cpu_workers, thread_name_prefix="mudd-cpu"),
+            "gpu": ThreadPoolExecutor(max_workers=1, thread_name_prefix="mudd-gpu"),
+        }
+        loop = asyncio.get_running_loop()
+        for _ in range(self.cpu_workers):
+            self._tasks.append(loop.create_task(self._worker("cpu")))
+        self._tasks.append(loop.create_task(self._worker("gpu")))
+
+    async def _worker(self, device):
+        queue = self._queues[device]
+        loop = asyncio.get_running_loop()
+        while True:
+            _, _, job = await queue.get()
+            try:
+                if job.status != "queued":
+                    # cancelled while waiting
+                    continue
+
+                job.status = "running"
+                job.started = time.time()
+                handler = self.handlers[job.kind][0]
+                try:
+                    await loop.run_in_executor(self._executors[device], handler, job)
+                    job.status = "cancelled" if job.cancel_requested else "done"
+                except JobCancelled:
+                    job.status = "cancelled"
+                except Exception as e:
+                    print(f" - MuDDetailer job {job.id} failed - {e}")
+                    job.error = str(e)
+                    job.status = "failed"
+                job.finished = time.time()
+                # release inputs
+                job.payload = None
+            finally:
+                queue.task_done()
+
+    def pending(self, kind=None):
+        """number of queued or running jobs"""
+        return sum(1 for job in list(self.jobs.values()) if not job.done and (kind is None or job.kind == kind))
+
+    def _prune(self):
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job.done and now - job.finished > self.keep_finished:
+                del self.jobs[job_id]
+
+    async def submit(self, kind, payload, priority=0):
+        if kind not in self.handlers:
+            raise ValueError(f"unknown job type {kind}")
+
+        self._start()
+        self._prune()
+        if self.pending() >= self.max_jobs:
+            raise QueueFull()
+
+        job = Job(kind, payload, priority)
+        job.seq = next(self._counter)
+        self.jobs[job.id] = job
+        device = self.handlers[kind][1]
+        self._queues[device].put_nowait((-priority, job.seq, job))
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id, None)
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id, None)
+        if job is None or job.done:
+            return job
+
+        job.cancel_requested = True
+        if job.status == "queued":
+            job.status = "cancelled"
+            job.finished = time.time()
+            job.payload = None
+        elif job.on_cancel is not None:
+            try:
+                job.on_cancel()
+            except Exception as e:
+                print(f" - failed to cancel job {job.id} - {e}")
+        return job
+
+    def position(self, job):
+        """number of jobs to run before the given queued job"""
+        if job.status != "queued":
+            return 0
+        device = self.handlers[job.kind][1]
+        return sum(1 for other in list(self.jobs.values())
+                   if other.status == "queued" and self.handlers[other.kind][1] == device and
+                   (-other.priority, other.seq) < (-job.priority, job.seq))
@@ -0,0 +1,140 @@
+"""
+Simple in-process metrics with JSON and Prometheus text exporters
+"""
+import threading
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+_metrics = {}
+
+
+class Metric:
+    def __init__(self, name, kind, help, buckets=None):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.buckets = tuple(buckets or DEFAULT_BUCKETS) if kind == "histogram" else None
+        # labels -> value. histogram value is [bucket counts, sum, count]
+        self.values = {}
+        self.callback = None
+
+    def collect(self):
+        if self.callback is not None:
+            try:
+                values = self.callback()
+            except Exception as e:
+                print(f" - failed to collect metric {self.name} - {e}")
+                return {}
+            if not isinstance(values, dict):
+                return {(): values}
+            return values
+
+        with _lock:
+            if self.kind == "histogram":
+                return {key: (list(value[0]), value[1], value[2]) for key, value in self.values.items()}
+            return dict(self.values)
+
+
+def describe(name, kind, help, buckets=None):
+    with _lock:
+        if name not in _metrics:
+            _metrics[name] = Metric(name, kind, help, buckets)
+    return _metrics[name]
+
+
+def _labels(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name, value=1, **labels):
+    metric = _metrics[name]
+    key = _labels(labels)
+    with _lock:
+        metric.values[key] = metric.values.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    metric = _metrics[name]
+    with _lock:
+        metric.values[_labels(labels)] = value
+
+
+def gauge_callback(name, callback):
+    """collect the gauge value by callback() on export. callback() returns a value or a {labels: value} dict"""
+    _metrics[name].callback = callback
+
+
+def observe(name, value, **labels):
+    metric = _metrics[name]
+    key = _labels(labels)
+    with _lock:
+        hist = metric.values.get(key, None)
+        if hist is None:
+            hist = metric.values[key] = [[0] * len(metric.buckets), 0.0, 0]
+        for i, bound in enumerate(metric.buckets):
+            if value <= bound:
+                hist[0][i] += 1
+        hist[1] += value
+        hist[2] += 1
+
+
+def snapshot():
+    """all metrics as a JSON serializable dict"""
+    result = {}
+    for metric in list(_metrics.values()):
+        values = []
+        collected = metric.collect()
+        for key, value in collected.items():
+            item = {"labels": dict(key)}
+            if metric.kind == "histogram":
+                item.update({"buckets": dict(zip([str(b) for b in metric.buckets], value[0])), "sum": value[1], "count": value[2]})
+            else:
+                item["value"] = value
+            values.append(item)
+        result[metric.name] = {"type": metric.kind, "help": metric.help, "values": values}
+    return result
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels) + (extra or [])
+    if not items:
+        return ""
+    escape = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in items) + "}"
+
+
+def prometheus():
+    """all metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in list(_metrics.values()):
+        collected = metric.collect()
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for key, value in collected.items():
+            if metric.kind == "histogram":
+                counts, total, count = value
+                for bound, c in zip(metric.buckets, counts):
+                    lines.append(f"{metric.name}_bucket{_format_labels(key, [('le', bound)])} {c}")
+                lines.append(f"{metric.name}_bucket{_format_labels(key, [('le', '+Inf')])} {count}")
+                lines.append(f"{metric.name}_sum{_format_labels(key)} {total}")
+                lines.append(f"{metric.name}_count{_format_labels(key)} {count}")
+            else:
+                lines.append(f"{metric.name}{_format_labels(key)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+describe("mudd_detection_seconds", "histogram", "Detection latency per backend in seconds")
+describe("mudd_detections_total", "counter", "Detected objects per backend")
+describe("mudd_regions_inpainted_total", "counter", "Inpainted regions")
+describe("mudd_regions_skipped_total", "counter", "Skipped small regions")
+describe("mudd_sampler_steps_total", "counter", "Sampler steps spent on inpainting")
+describe("mudd_model_cache_hits_total", "counter", "Detector model cache hits")
+describe("mudd_model_cache_misses_total", "counter", "Detector model cache misses")
+describe("mudd_model_cache_evictions_total", "counter", "Detector model cache evictions")
+describe("mudd_detector_models_loaded", "gauge", "Loaded detector models")
+describe("mudd_detector_vram_bytes", "gauge", "Detector parameter bytes resident on the GPU")
+describe("mudd_queue_depth", "gauge", "MuDDetailer requests waiting or running")
+describe("mudd_jobs_pending", "gauge", "Queued or running API jobs")
+describe("mudd_writes_pending", "gauge", "Masks, previews and originals waiting to be saved")
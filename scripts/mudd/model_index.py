@@ -0,0 +1,220 @@
+"""
+In-memory index of detection models
+
+    index = ModelIndex(modeltitle, model_hash, old_model_hash)
+    index.refresh(paths)    # hash new or changed files only
+    entry = index.lookup("face_yolov8n.pt")
+    entry.path, entry.hash, entry.dataset
+    entry = index.resolve("face_yolov8n.pt")    # rehash if the file was changed
+
+Models are looked up by title ("yolo/face_yolov8n.pt [hash]"), title with the old style hash,
+name ("yolo/face_yolov8n.pt"), basename ("face_yolov8n.pt") or path.
+
+Hashes are cached in the index and optionally in a JSON cache file, and are trusted
+as long as (size, mtime, inode) of the file are not changed.
+"""
+import json
+import os
+import threading
+
+
+def stat_key(path):
+    """(size, mtime, inode) of the file or None"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+def model_dataset(path):
+    if "mmdet" in path and "segm" in path:
+        return "coco"
+    return "bbox"
+
+
+def model_backend(path):
+    if path.endswith(".onnx"):
+        return "onnx"
+    if "mmdet" in path:
+        return "mmdet"
+    return "ultralytics"
+
+
+class ModelEntry:
+    __slots__ = ("name", "path", "hash", "old_hash", "stat", "dataset", "backend", "classes")
+
+    def __init__(self, name, path, hash, old_hash, stat):
+        self.name = name
+        self.path = path
+        self.hash = hash
+        self.old_hash = old_hash
+        self.stat = stat
+        self.dataset = model_dataset(path)
+        self.backend = model_backend(path)
+        # class names. loaded on demand
+        self.classes = None
+
+    @property
+    def title(self):
+        return f"{self.name} [{self.hash}]"
+
+    @property
+    def old_title(self):
+        return f"{self.name} [{self.old_hash}]"
+
+    def to_dict(self):
+        return {"title": self.title, "path": self.path, "hash": self.hash, "dataset": self.dataset, "backend": self.backend}
+
+
+class ModelIndex:
+    def __init__(self, title, hasher, old_hasher=None, cache_path=None):
+        """title(path) returns the model name. hasher(path) and old_hasher(path) return short hashes"""
+        self.title = title
+        self.hasher = hasher
+        self.old_hasher = old_hasher
+        self.entries = {}  # path -> ModelEntry
+        self._lookup = {}
+        self._lock = threading.Lock()
+
+        # persistent hash cache. path -> {"stat": [size, mtime, inode], "hash": ..., "old_hash": ...}
+        self.cache_path = cache_path
+        self.cache = {}
+        self.cache_dirty = False
+        self._cache_lock = threading.Lock()
+        if cache_path is not None:
+            self.load_cache()
+
+    def load_cache(self):
+        try:
+            with open(self.cache_path, encoding="utf8") as f:
+                self.cache = json.load(f)
+        except FileNotFoundError:
+            self.cache = {}
+        except (OSError, ValueError) as e:
+            print(f" - failed to load the model hash cache {self.cache_path} - {e}")
+            self.cache = {}
+
+    def save_cache(self):
+        if self.cache_path is None or not self.cache_dirty:
+            return
+        with self._cache_lock:
+            cache = dict(self.cache)
+            self.cache_dirty = False
+        tmp = f"{self.cache_path}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            with open(tmp, "w", encoding="utf8") as f:
+                json.dump(cache, f, indent=1)
+            os.replace(tmp, self.cache_path)
+        except OSError as e:
+            print(f" - failed to save the model hash cache {self.cache_path} - {e}")
+
+    def _entry(self, path, stat, rehash=False):
+        cached = self.cache.get(path, None)
+        if not rehash and cached is not None and tuple(cached["stat"]) == stat:
+            return ModelEntry(self.title(path), path, cached["hash"], cached["old_hash"], stat)
+
+        h = self.hasher(path)
+        old_h = self.old_hasher(path) if self.old_hasher is not None else h
+        with self._cache_lock:
+            self.cache[path] = {"stat": list(stat), "hash": h, "old_hash": old_h}
+            self.cache_dirty = True
+        return ModelEntry(self.title(path), path, h, old_h, stat)
+
+    def _index(self, entry, lookup):
+        for key in (entry.title, entry.old_title, entry.name, entry.path):
+            lookup[key] = entry
+        lookup.setdefault(entry.name.split("/")[-1], entry)
+
+    def refresh(self, paths):
+        """update the index with the given model paths. unchanged files are not read again"""
+        entries = {}
+        for path in paths:
+            stat = stat_key(path)
+            if stat is None:
+                continue
+            entry = self.entries.get(path, None)
+            if entry is None or entry.stat != stat:
+                entry = self._entry(path, stat)
+            entries[path] = entry
+
+        lookup = {}
+        for entry in entries.values():
+            self._index(entry, lookup)
+
+        with self._lock:
+            self.entries = entries
+            self._lookup = lookup
+        self.save_cache()
+
+    def update(self, entry):
+        """replace the entry of the same path"""
+        with self._lock:
+            entries = dict(self.entries)
+            entries[entry.path] = entry
+            lookup = {}
+            for e in entries.values():
+                self._index(e, lookup)
+            self.entries = entries
+            self._lookup = lookup
+
+    def lookup(self, name):
+        return self._lookup.get(name, None)
+
+    def resolve(self, name):
+        """lookup the model and validate the cached hash by stat(). the file is rehashed only if it was changed"""
+        entry = self._lookup.get(name, None)
+        if entry is None:
+            return None
+
+        stat = stat_key(entry.path)
+        if stat is None:
+            return None
+        if stat != entry.stat:
+            print(f" - model {entry.name} was changed, rehashing...")
+            classes = entry.classes
+            entry = self._entry(entry.path, stat)
+            if entry.hash == self.entries[entry.path].hash:
+                entry.classes = classes
+            self.update(entry)
+            self.save_cache()
+            if name not in (entry.name, entry.path, entry.name.split("/")[-1], entry.title, entry.old_title):
+                # the hash in the given title does not match anymore
+                return None
+        return entry
+
+    def verify(self, background=True):
+        """rehash all indexed models and report mismatched hashes"""
+        def run():
+            mismatched = []
+            for entry in list(self.entries.values()):
+                stat = stat_key(entry.path)
+                if stat is None:
+                    continue
+                new = self._entry(entry.path, stat, rehash=True)
+                if new.hash != entry.hash:
+                    print(f" - model {entry.name} hash mismatched: {entry.hash} -> {new.hash}")
+                    mismatched.append(entry.path)
+                    self.update(new)
+            self.save_cache()
+            print(f" - verified {len(self.entries)} model hashes, {len(mismatched)} mismatched")
+            return mismatched
+
+        if not background:
+            return run()
+        thread = threading.Thread(target=run, name="mudd-verify-hashes", daemon=True)
+        thread.start()
+        return thread
+
+    def titles(self):
+        return [entry.title for entry in list(self.entries.values())]
+
+    def aliases(self):
+        """title -> path and path -> title aliases"""
+        aliases = {}
+        for entry in list(self.entries.values()):
+            aliases[entry.title] = entry.path
+            aliases[entry.path] = entry.title
+            aliases[entry.old_title] = entry.path
+        return aliases
@@ -0,0 +1,252 @@
+"""
+Preset stores with parsed preset cache
+
+    store = TsvPresetStore("data/presets.tsv", parse=_get_preset_params)
+    store = SQLitePresetStore("data/presets.sqlite3", parse=_get_preset_params, import_from="data/presets.tsv")
+    store.names()
+    store.get(name)       # raw preset line "Mask blur: 4, Denoising: 0.4, ..."
+    store.params(name)    # parsed params dict
+    store.save(name, line, overwrite=True)
+    store.delete(name)
+
+The TSV store is reloaded only if the file was changed, and is written atomically under a file lock.
+The SQLite store could be shared by several webui processes.
+"""
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+
+
+class PresetExists(Exception):
+    pass
+
+
+class FileLock:
+    """inter-process lock using a lock file"""
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, "a+")
+        if os.name == "nt":
+            import msvcrt
+
+            self.file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK retries for 10 seconds
+                    pass
+        else:
+            import fcntl
+
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        try:
+            if os.name == "nt":
+                import msvcrt
+
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        finally:
+            self.file.close()
+            self.file = None
+        return False
+
+
+def parse_tsv(raw):
+    """{name: line} from the presets.tsv content"""
+    presets = {}
+    for l in raw.splitlines():
+        if "\t" not in l:
+            continue
+        k, w = l.split("\t", 1)
+        presets[k.strip()] = w
+    return presets
+
+
+class PresetStore(ABC):
+    def __init__(self, parse):
+        self.parse = parse
+        self._presets = {}
+        self._params = {}
+        self._lock = threading.RLock()
+
+    @abstractmethod
+    def _reload_if_changed(self):
+        pass
+
+    def _set(self, presets):
+        self._presets = presets
+        self._params = {}
+
+    def all(self, reload=False):
+        with self._lock:
+            if reload:
+                self.invalidate()
+            self._reload_if_changed()
+            return dict(self._presets)
+
+    def names(self, reload=False):
+        return list(self.all(reload).keys())
+
+    def get(self, name):
+        with self._lock:
+            self._reload_if_changed()
+            return self._presets.get(name, None)
+
+    def params(self, name):
+        """parsed params of the preset. parsed only once until the preset is changed"""
+        with self._lock:
+            self._reload_if_changed()
+            line = self._presets.get(name, None)
+            if line is None:
+                return None
+            params = self._params.get(name, None)
+            if params is None:
+                params = self._params[name] = self.parse(line)
+            return dict(params)
+
+    @abstractmethod
+    def invalidate(self):
+        pass
+
+    @abstractmethod
+    def save(self, name, line, overwrite=False):
+        pass
+
+    @abstractmethod
+    def delete(self, name):
+        pass
+
+
+class TsvPresetStore(PresetStore):
+    def __init__(self, path, parse):
+        super().__init__(parse)
+        self.path = path
+        self._stat = None
+
+    def _file_stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+    def _read(self):
+        try:
+            with open(self.path, encoding="utf8") as f:
+                return f.read()
+        except FileNotFoundError:
+            return ""
+
+    def _reload_if_changed(self):
+        stat = self._file_stat()
+        if stat is not None and stat == self._stat:
+            return
+        self._stat = stat
+        self._set(parse_tsv(self._read()) if stat is not None else {})
+
+    def invalidate(self):
+        self._stat = None
+
+    def _update(self, update):
+        """read, update and write presets atomically under the file lock. update(presets) returns False to cancel"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._lock, FileLock(f"{self.path}.lock"):
+            # always read the latest presets under the lock
+            presets = parse_tsv(self._read())
+            if update(presets) is False:
+                return False
+
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf8") as f:
+                f.write("".join(f"{k}\t{v}\n" for k, v in presets.items()))
+            os.replace(tmp, self.path)
+
+            self._stat = self._file_stat()
+            self._set(presets)
+        return True
+
+    def save(self, name, line, overwrite=False):
+        def update(presets):
+            if name in presets and not overwrite:
+                raise PresetExists(name)
+            presets[name] = line
+        return self._update(update)
+
+    def delete(self, name):
+        def update(presets):
+            if name not in presets:
+                return False
+            del presets[name]
+        return self._update(update)
+
+
+class SQLitePresetStore(PresetStore):
+    def __init__(self, path, parse, import_from=None):
+        super().__init__(parse)
+        self.path = path
+        self._version = None
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS presets (name TEXT PRIMARY KEY, line TEXT NOT NULL, updated REAL DEFAULT (julianday('now')))")
+            count = self._conn.execute("SELECT COUNT(*) FROM presets").fetchone()[0]
+            if count == 0 and import_from is not None and os.path.isfile(import_from):
+                with open(import_from, encoding="utf8") as f:
+                    presets = parse_tsv(f.read())
+                self._conn.execute("BEGIN IMMEDIATE")
+                self._conn.executemany("INSERT OR IGNORE INTO presets (name, line) VALUES (?, ?)", presets.items())
+                self._conn.execute("COMMIT")
+                print(f" - {len(presets)} presets imported from {import_from}")
+
+    def _data_version(self):
+        # changed by commits of other connections
+        return self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def _reload_if_changed(self):
+        version = self._data_version()
+        if version == self._version:
+            return
+        self._version = version
+        self._set(dict(self._conn.execute("SELECT name, line FROM presets ORDER BY rowid")))
+
+    def invalidate(self):
+        self._version = None
+
+    def save(self, name, line, overwrite=False):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                exists = self._conn.execute("SELECT 1 FROM presets WHERE name = ?", (name,)).fetchone() is not None
+                if exists and not overwrite:
+                    raise PresetExists(name)
+                if exists:
+                    self._conn.execute("UPDATE presets SET line = ?, updated = julianday('now') WHERE name = ?", (line, name))
+                else:
+                    self._conn.execute("INSERT INTO presets (name, line) VALUES (?, ?)", (name, line))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self.invalidate()
+        return True
+
+    def delete(self, name):
+        with self._lock:
+            deleted = self._conn.execute("DELETE FROM presets WHERE name = ?", (name,)).rowcount > 0
+            self.invalidate()
+        return deleted
@@ -0,0 +1,58 @@
+"""
+Batch level scheduling of staged jobs
+
+    def stages(image):
+        ...                        # detection
+        yield (checkpoint_b, ...)  # stage key of the following inpainting
+        ...                        # inpaint B
+        yield (checkpoint_a, ...)
+        ...                        # inpaint A
+        yield None                 # barrier. finish jobs in order of submission
+        return result
+
+    results = run_grouped([stages(image) for image in batch])
+
+Stages of all jobs with the same key are run together to minimize checkpoint/VAE switches.
+The order of stages of each job is preserved, so dependent stages of the same image are never reordered.
+"""
+
+
+def run_grouped(jobs, step=None):
+    """run generator jobs grouped by the yielded stage keys. return the results of jobs in order
+
+    step(index, job) advances the job to the next stage and returns the stage key. default next(job)
+    """
+    if step is None:
+        step = lambda i, job: next(job)
+
+    results = [None] * len(jobs)
+    waiting = {}  # job index -> stage key
+
+    def advance(i):
+        try:
+            waiting[i] = step(i, jobs[i])
+        except StopIteration as e:
+            waiting.pop(i, None)
+            results[i] = e.value
+
+    # run up to the first stage of every job in order
+    for i in range(len(jobs)):
+        advance(i)
+
+    current = None
+    while len(waiting) > 0:
+        keys = [key for key in waiting.values() if key is not None]
+        if len(keys) == 0:
+            # all jobs reached the barrier
+            for i in sorted(waiting):
+                advance(i)
+            continue
+
+        if current not in keys:
+            # switch to the key with most waiting stages. the earliest job first on ties
+            current = max(dict.fromkeys(keys), key=keys.count)
+
+        for i in sorted(i for i, key in waiting.items() if key == current):
+            advance(i)
+
+    return results
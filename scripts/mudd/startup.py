@@ -0,0 +1,134 @@
+"""
+Background startup checks with progress and a per model result cache
+
+    checks = StartupChecks(cache_path)
+    checks.start(run)    # run(checks) in a background thread
+
+    def run(checks):
+        checks.step("validity", len(models))
+        for model in models:
+            checks.advance(model)
+            if checks.cached(model, (hash, config_mtime)) is None:
+                checks.record(model, (hash, config_mtime), config=True)
+
+Cached results are reused while the signature (e.g. model hash and config mtime) is not changed.
+"""
+import json
+import os
+import threading
+import time
+
+
+class StartupChecks:
+    def __init__(self, cache_path=None):
+        self.status = "idle"
+        self.stage = ""
+        self.total = 0
+        self.done = 0
+        self.current = None
+        self.error = None
+        self.started = None
+        self.finished = None
+        self.results = {}
+        self._thread = None
+        self._lock = threading.Lock()
+
+        self.cache_path = cache_path
+        self.cache = {}
+        if cache_path is not None:
+            try:
+                with open(cache_path, encoding="utf8") as f:
+                    self.cache = json.load(f)
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError) as e:
+                print(f" - failed to load the startup check cache {cache_path} - {e}")
+
+    def start(self, func):
+        """run func(self) in a background thread"""
+        if self._thread is not None and self._thread.is_alive():
+            return self._thread
+
+        def run():
+            self.status = "running"
+            self.started = time.time()
+            try:
+                func(self)
+                self.status = "done"
+            except Exception as e:
+                print(f" - MuDDetailer startup checks failed - {e}")
+                self.error = str(e)
+                self.status = "failed"
+            finally:
+                self.current = None
+                self.finished = time.time()
+                self.save_cache()
+
+        self._thread = threading.Thread(target=run, name="mudd-startup", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def wait(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def step(self, stage, total=0):
+        self.stage = stage
+        self.total = total
+        self.done = 0
+
+    def advance(self, current=None):
+        self.current = current
+        self.done += 1
+
+    def cached(self, key, signature):
+        """cached result if the signature is not changed"""
+        result = self.cache.get(key, None)
+        if result is not None and result.get("signature", None) == list(signature):
+            return result
+        return None
+
+    def record(self, key, signature, **result):
+        with self._lock:
+            self.cache[key] = {"signature": list(signature), **result}
+            self.results[key] = result
+
+    def save_cache(self):
+        if self.cache_path is None:
+            return
+        with self._lock:
+            cache = dict(self.cache)
+        tmp = f"{self.cache_path}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            with open(tmp, "w", encoding="utf8") as f:
+                json.dump(cache, f, indent=1)
+            os.replace(tmp, self.cache_path)
+        except OSError as e:
+            print(f" - failed to save the startup check cache {self.cache_path} - {e}")
+
+    def summary(self):
+        if self.status == "running":
+            progress = f" {self.done}/{self.total}" if self.total > 0 else ""
+            return f"{self.stage}{progress} {self.current or ''}".strip()
+        if self.status == "failed":
+            return f"failed - {self.error}"
+        if self.status == "done":
+            valid = sum(1 for result in self.results.values() if result.get("config", False))
+            return f"done in {self.finished - self.started:.1f}s. {valid}/{len(self.results)} valid configs"
+        return self.status
+
+    def to_dict(self):
+        with self._lock:
+            results = {key: dict(value) for key, value in self.results.items()}
+        return {
+            "status": self.status,
+            "stage": self.stage,
+            "total": self.total,
+            "done": self.done,
+            "current": self.current,
+            "error": self.error,
+            "started": self.started,
+            "finished": self.finished,
+            "results": results,
+        }
@@ -0,0 +1,129 @@
+"""
+Per-stage timing spans
+
+    timings = begin(enabled)
+    with span("detect", model=name, size=image.size) as s:
+        results = inference(...)
+        s.tag(detections=len(results[1]))
+    end()
+
+span() returns a shared no-op span when timings are disabled.
+"""
+import json
+import threading
+import time
+
+
+_local = threading.local()
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def tag(self, **tags):
+        pass
+
+
+_null_span = _NullSpan()
+
+
+class Span:
+    __slots__ = ("timings", "name", "tags", "start", "elapsed")
+
+    def __init__(self, timings, name, tags):
+        self.timings = timings
+        self.name = name
+        self.tags = tags
+        self.start = 0.0
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.elapsed = time.perf_counter() - self.start
+        self.timings.spans.append(self)
+        return False
+
+    def tag(self, **tags):
+        self.tags.update(tags)
+
+    def to_dict(self):
+        tags = {k: list(v) if isinstance(v, tuple) else v for k, v in self.tags.items()}
+        return {"name": self.name, "start_ms": round((self.start - self.timings.start) * 1000, 2), "ms": round(self.elapsed * 1000, 2), **tags}
+
+
+class Timings:
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.spans = []
+        self.start = time.perf_counter()
+        self.elapsed = 0.0
+
+    def span(self, name, **tags):
+        if not self.enabled:
+            return _null_span
+        return Span(self, name, tags)
+
+    def summary(self):
+        """total ms of each stage in the order of appearance"""
+        totals = {}
+        for s in self.spans:
+            totals[s.name] = totals.get(s.name, 0.0) + s.elapsed * 1000
+        return totals
+
+    def infotext(self):
+        """compact infotext. e.g. detect:120;masks:8;sample:3012;total:3240"""
+        totals = self.summary()
+        totals["total"] = (self.elapsed or time.perf_counter() - self.start) * 1000
+        return ";".join(f"{name}:{int(round(ms))}" for name, ms in totals.items())
+
+    def to_dict(self, **tags):
+        return {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "total_ms": round(self.elapsed * 1000, 2), **tags,
+                "spans": [s.to_dict() for s in self.spans]}
+
+    def dump(self, path, **tags):
+        """append timings to a JSON lines file"""
+        with open(path, "a", encoding="utf8") as f:
+            f.write(json.dumps(self.to_dict(**tags), default=str) + "\n")
+
+
+def begin(enabled=True):
+    """start timings of the current thread"""
+    timings = Timings(enabled)
+    _local.timings = timings
+    return timings
+
+
+def end():
+    """finish timings of the current thread"""
+    timings = getattr(_local, "timings", None)
+    _local.timings = None
+    if timings is not None:
+        timings.elapsed = time.perf_counter() - timings.start
+    return timings
+
+
+def current():
+    return getattr(_local, "timings", None)
+
+
+def activate(timings):
+    """make the given timings current and return the previous one. used to interleave jobs"""
+    prev = getattr(_local, "timings", None)
+    _local.timings = timings
+    return prev
+
+
+def span(name, **tags):
+    timings = getattr(_local, "timings", None)
+    if timings is None or not timings.enabled:
+        return _null_span
+    return Span(timings, name, tags)
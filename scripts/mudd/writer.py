@@ -0,0 +1,50 @@
+"""
+Background writer with a bounded queue
+
+    writer = BackgroundWriter(max_pending=16)
+    writer.submit(images.save_image, image, path, "", seed, prompt, "png", info=info)
+    writer.flush()    # wait for all pending writes
+
+Writes run one by one on a single thread in order of submission.
+submit() blocks while the queue is full, so pending images do not pile up in memory.
+"""
+import queue
+import threading
+
+
+class BackgroundWriter:
+    def __init__(self, max_pending=16, name="mudd-writer"):
+        self.queue = queue.Queue(maxsize=max(int(max_pending), 1))
+        self.name = name
+        self.errors = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            func, args, kwargs = self.queue.get()
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                self.errors += 1
+                print(f" - MuDDetailer background save failed - {e}")
+            finally:
+                self.queue.task_done()
+
+    def submit(self, func, *args, **kwargs):
+        """queue func(*args, **kwargs). block while the queue is full"""
+        self._start()
+        self.queue.put((func, args, kwargs))
+
+    def pending(self):
+        """number of queued or running writes"""
+        return self.queue.unfinished_tasks
+
+    def flush(self):
+        self.queue.join()
@@ -0,0 +1,135 @@
+"""
+Downloader tests against a local HTTP server
+
+usage: python -m pytest tests/test_download.py
+       python -m unittest tests.test_download
+"""
+import hashlib
+import http.server
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+import urllib.error
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from scripts.mudd.download import DownloadError, DownloadItem, download_all, download_file
+
+
+CONTENT = bytes(range(256)) * 1024
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    files = {"/models/model.pt": CONTENT}
+    ranges = True
+    requests = []
+
+    def do_GET(self):
+        self.requests.append((self.path, self.headers.get("Range", None)))
+        data = self.files.get(self.path, None)
+        if data is None:
+            self.send_error(404)
+            return
+
+        start = 0
+        value = self.headers.get("Range", None)
+        if self.ranges and value is not None and value.startswith("bytes="):
+            start = int(value[6:].split("-")[0])
+            if start >= len(data):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+        cls.url = f"http://127.0.0.1:{cls.server.server_address[1]}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dest = os.path.join(self.tmpdir, "out", "model.pt")
+        self.sha256 = hashlib.sha256(CONTENT).hexdigest()
+        _Handler.ranges = True
+        _Handler.requests = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def read(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    def write_part(self, data):
+        os.makedirs(os.path.dirname(self.dest), exist_ok=True)
+        with open(f"{self.dest}.part", "wb") as f:
+            f.write(data)
+
+    def test_download(self):
+        download_file(DownloadItem(f"{self.url}/models/model.pt", self.dest, self.sha256))
+        self.assertEqual(self.read(self.dest), CONTENT)
+        self.assertFalse(os.path.exists(f"{self.dest}.part"))
+
+    def test_resume(self):
+        self.write_part(CONTENT[:1000])
+        download_file(DownloadItem(f"{self.url}/models/model.pt", self.dest, self.sha256))
+        self.assertEqual(self.read(self.dest), CONTENT)
+        self.assertEqual(_Handler.requests, [("/models/model.pt", "bytes=1000-")])
+
+    def test_restart_stale_part(self):
+        # the server ignores the range request. the stale .part is overwritten
+        _Handler.ranges = False
+        self.write_part(b"stale" * 100)
+        download_file(DownloadItem(f"{self.url}/models/model.pt", self.dest, self.sha256))
+        self.assertEqual(self.read(self.dest), CONTENT)
+
+    def test_sha256_mismatch(self):
+        with self.assertRaises(DownloadError):
+            download_file(DownloadItem(f"{self.url}/models/model.pt", self.dest, "0" * 64))
+        self.assertFalse(os.path.exists(self.dest))
+        self.assertFalse(os.path.exists(f"{self.dest}.part"))
+
+    def test_mirror_directory(self):
+        mirror = os.path.join(self.tmpdir, "mirror")
+        os.makedirs(mirror)
+        with open(os.path.join(mirror, "model.pt"), "wb") as f:
+            f.write(CONTENT)
+
+        download_file(DownloadItem(f"{self.url}/unknown/model.pt", self.dest, self.sha256), mirror=mirror)
+        self.assertEqual(self.read(self.dest), CONTENT)
+        self.assertEqual(_Handler.requests, [])
+
+    def test_not_found(self):
+        missing = os.path.join(self.tmpdir, "out", "missing.pt")
+        errors = download_all([
+            DownloadItem(f"{self.url}/models/model.pt", self.dest, self.sha256),
+            DownloadItem(f"{self.url}/models/missing.pt", missing),
+        ])
+        self.assertEqual(list(errors), [missing])
+        self.assertIsInstance(errors[missing], urllib.error.HTTPError)
+        self.assertEqual(errors[missing].code, 404)
+        self.assertEqual(self.read(self.dest), CONTENT)
+
+
+if __name__ == "__main__":
+    unittest.main()